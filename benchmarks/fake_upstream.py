@@ -0,0 +1,98 @@
+"""A fake OpenAI Responses API that streams a fixed answer, for benchmarking the app without a real upstream.
+
+python benchmarks/fake_upstream.py --port 8081 --deltas 100 --delta-interval 0.01 --error-rate 0.01
+
+--error-rate is the share of requests that fail with a 429 (like a throttled deployment) or a 500,
+and --disconnect-rate the share of streams that are cut off halfway through the answer.
+
+Point the app at it with LOCAL_OPENAI_ENDPOINT=http://127.0.0.1:8081/v1
+"""
+
+import argparse
+import asyncio
+import json
+import random
+
+
+def sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+def create_app(deltas=100, delta_interval=0.01, first_token_delay=0.0, error_rate=0.0, disconnect_rate=0.0, seed=None):
+    """Return an ASGI app that answers every streamed response request with `deltas` deltas."""
+    rng = random.Random(seed)
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                else:
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        while (await receive()).get("more_body"):
+            pass
+        if scope["method"] != "POST" or not scope["path"].endswith("/responses"):
+            await send({"type": "http.response.start", "status": 404, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if rng.random() < error_rate:
+            status, error = rng.choice([(429, "rate_limit_exceeded"), (500, "server_error")])
+            body = json.dumps({"error": {"message": f"Injected {error}", "type": error, "code": error}}).encode()
+            # Retry-After 0 keeps the client from waiting before it retries
+            headers = [(b"content-type", b"application/json"), (b"retry-after", b"0")]
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+        disconnect_at = deltas // 2 if rng.random() < disconnect_rate else None
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+        response = {"id": "resp_fake", "object": "response", "status": "in_progress", "model": "fake", "output": []}
+        await send(
+            {
+                "type": "http.response.body",
+                "body": sse({"type": "response.created", "response": response}),
+                "more_body": True,
+            }
+        )
+        await asyncio.sleep(first_token_delay)
+        for i in range(deltas):
+            if i == disconnect_at:
+                raise ConnectionResetError("Injected disconnect")
+            event = {
+                "type": "response.output_text.delta",
+                "item_id": "msg_fake",
+                "output_index": 0,
+                "content_index": 0,
+                "delta": f" word{i}",
+                "sequence_number": i + 1,
+            }
+            await send({"type": "http.response.body", "body": sse(event), "more_body": True})
+            if delta_interval:
+                await asyncio.sleep(delta_interval)
+        completed = {"type": "response.completed", "response": {**response, "status": "completed"}}
+        await send({"type": "http.response.body", "body": sse(completed)})
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--deltas", type=int, default=100)
+    parser.add_argument("--delta-interval", type=float, default=0.01, help="seconds between deltas")
+    parser.add_argument("--first-token-delay", type=float, default=0.0, help="seconds before the first delta")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="share of streams cut off halfway")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the injected errors")
+    args = parser.parse_args()
+    app = create_app(
+        args.deltas, args.delta_interval, args.first_token_delay, args.error_rate, args.disconnect_rate, args.seed
+    )
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
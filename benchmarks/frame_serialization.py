@@ -0,0 +1,34 @@
+"""Compare the time to serialize one streamed delta frame with each frame serializer.
+
+python benchmarks/frame_serialization.py --frames 200000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from quartapp import frames  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=200000)
+    args = parser.parse_args()
+
+    deltas = {"short delta": " capital", "long delta": "The capital of France is Paris. " * 20}
+    for name, serializer in frames.FRAME_SERIALIZERS.items():
+        if name == "orjson" and frames.orjson is None:
+            print(f"{name:>8}: skipped, orjson isn't installed")
+            continue
+        timings = []
+        for label, delta in deltas.items():
+            seconds = timeit.timeit(lambda: serializer.delta(delta), number=args.frames)
+            timings.append(f"{label} {seconds * 1e9 / args.frames:.0f} ns")
+        print(f"{name:>8}: " + ", ".join(timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Measure GET / requests per second, rendering the template for every request as the app used to,
+and serving the pre-rendered page, without and with compression.
+
+python benchmarks/index_page.py --requests 5000 --users 100
+
+Requests go through Quart's test client, in process, so the numbers leave out the server and the network,
+which cost the same in every mode.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from quart import render_template  # noqa: E402
+
+import quartapp  # noqa: E402
+from quartapp import chat  # noqa: E402
+
+
+def make_header(user):
+    principal = {"auth_typ": "aad", "claims": [{"typ": "name", "val": f"User {user}"}]}
+    return base64.b64encode(json.dumps(principal).encode()).decode()
+
+
+async def render_each_time():
+    return await render_template("index.html", username=chat.extract_username(chat.request.headers))
+
+
+async def measure(client, path, requests, users, accept_encoding="identity", revalidate=False):
+    started = time.perf_counter()
+    for i in range(requests):
+        user = i % users
+        headers = {"X-MS-CLIENT-PRINCIPAL": make_header(user), "Accept-Encoding": accept_encoding}
+        if revalidate:
+            headers["If-None-Match"] = f'"{chat.bp.index_page.etag(f"User {user}")}"'
+        response = await client.get(path, headers=headers)
+        await response.get_data()
+    return requests / (time.perf_counter() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    os.environ["LOCAL_OPENAI_ENDPOINT"] = "http://127.0.0.1:9/v1"
+    app = quartapp.create_app()
+    app.add_url_rule("/render-each-time", "render_each_time", render_each_time)
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        modes = [
+            ("Template rendered for every request", "/render-each-time", "identity", False),
+            ("Pre-rendered", "/", "identity", False),
+            ("Pre-rendered, gzip", "/", "gzip", False),
+            ("Pre-rendered, revalidated (304)", "/", "identity", True),
+        ]
+        for name, path, accept_encoding, revalidate in modes:
+            os.environ["INDEX_PAGE_COMPRESSION"] = "true" if accept_encoding == "gzip" else "false"
+            async with app.app_context():
+                await chat.prerender_index()
+            # Warm up the template and the caches
+            await measure(client, path, args.users, args.users, accept_encoding, revalidate)
+            requests_per_second = await measure(client, path, args.requests, args.users, accept_encoding, revalidate)
+            print(f"{name:<40} {requests_per_second:8.0f} requests/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,239 @@
+"""Load test /chat/stream on the gunicorn/uvicorn stack of gunicorn.conf.py, against a fake Responses API upstream.
+
+python benchmarks/load_test.py --clients 200 --duration 30 --first-token-delay 0.5 --tokens-per-second 50
+
+Each client streams answers back to back. The report has the time to first byte and to first token,
+the latency between tokens, the throughput, the errors, and the memory of each gunicorn worker.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+
+import httpx
+from worker_startup import SRC, children, free_port, memory_kb
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+QUESTION = {"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+
+
+def start_upstream(port, deltas=100, delta_interval=0.01, first_token_delay=0.0, error_rate=0.0, disconnect_rate=0.0):
+    upstream = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCHMARKS, "fake_upstream.py"),
+            f"--port={port}",
+            f"--deltas={deltas}",
+            f"--delta-interval={delta_interval}",
+            f"--first-token-delay={first_token_delay}",
+            f"--error-rate={error_rate}",
+            f"--disconnect-rate={disconnect_rate}",
+        ],
+        # Injected disconnects log a traceback each
+        stderr=subprocess.DEVNULL,
+    )
+    time.sleep(1)
+    return upstream
+
+
+def start_app(port, upstream_port, workers, env=None):
+    """Start gunicorn with the app's configuration, and return once all its workers are ready."""
+    env = {
+        **os.environ,
+        "RUNNING_IN_PRODUCTION": "true",
+        "LOCAL_OPENAI_ENDPOINT": f"http://127.0.0.1:{upstream_port}/v1",
+        "GUNICORN_WORKERS": str(workers),
+        **(env or {}),
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "quartapp:create_app()", f"--bind=127.0.0.1:{port}"],
+        cwd=SRC,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    ready = 0
+    for line in server.stdout:
+        if "Application startup complete" in line:
+            ready += 1
+            if ready == workers:
+                break
+    else:
+        # The logs ended before every worker was ready: gunicorn exited
+        server.wait()
+        raise RuntimeError(f"gunicorn exited with code {server.returncode} after {ready} of {workers} workers started")
+    # Keep reading the logs, so the server never blocks on a full pipe
+    asyncio.get_running_loop().run_in_executor(None, server.stdout.read)
+    return server
+
+
+def stop(process):
+    process.send_signal(signal.SIGTERM)
+    process.wait(timeout=30)
+
+
+@dataclass
+class LoadTestResults:
+    duration: float = 0.0
+    streams: int = 0
+    tokens: int = 0
+    bytes: int = 0
+    first_byte_times: list = field(default_factory=list)
+    first_token_times: list = field(default_factory=list)
+    token_gaps: list = field(default_factory=list)
+    # Failed streams by kind: an HTTP status, "error frame", "incomplete" or the exception's name
+    errors: collections.Counter = field(default_factory=collections.Counter)
+
+
+async def run_clients(url, clients, duration, ramp_up=0.0):
+    """Run `clients` clients that each stream answers back to back for `duration` seconds.
+
+    Clients start evenly over `ramp_up` seconds, so they don't all connect in the same instant.
+    """
+    results = LoadTestResults()
+    load_started = time.perf_counter()
+    deadline = load_started + ramp_up + duration
+
+    async def stream(http):
+        started = time.perf_counter()
+        last_token = None
+        gaps = []
+        async with http.stream("POST", url, json=QUESTION) as response:
+            # Once the response's status and headers have arrived
+            first_byte = time.perf_counter() - started
+            if response.status_code != 200:
+                await response.aread()
+                return str(response.status_code)
+            async for line in response.aiter_lines():
+                now = time.perf_counter()
+                results.bytes += len(line) + 1
+                if not line:
+                    continue
+                frame = json.loads(line)
+                if frame.get("error"):
+                    return "error frame"
+                if (frame.get("delta") or {}).get("content"):
+                    if last_token is None:
+                        results.first_token_times.append(now - started)
+                    else:
+                        gaps.append(now - last_token)
+                    last_token = now
+                    results.tokens += 1
+        if last_token is None:
+            return "incomplete"
+        results.first_byte_times.append(first_byte)
+        results.token_gaps.extend(gaps)
+        results.streams += 1
+
+    async def client(http, delay):
+        await asyncio.sleep(delay)
+        while time.perf_counter() < deadline:
+            try:
+                error = await stream(http)
+            except httpx.HTTPError as e:
+                error = type(e).__name__
+            if error:
+                results.errors[error] += 1
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as http:
+        await asyncio.gather(*(client(http, ramp_up * i / clients) for i in range(clients)))
+    # Including the ramp-up, and the streams that finish after the deadline
+    results.duration = time.perf_counter() - load_started
+    return results
+
+
+def percentiles(values, scale=1000):
+    """Return the p50, p95 and p99 of values, in milliseconds."""
+    if len(values) < 2:
+        return (float("nan"),) * 3
+    quantiles = statistics.quantiles(values, n=100)
+    return tuple(quantiles[i] * scale for i in (49, 94, 98))
+
+
+def worker_memory(server):
+    """Return the PSS of the gunicorn master and of each of its workers, in MB."""
+    return memory_kb(server.pid)[1] / 1024, [memory_kb(pid)[1] / 1024 for pid in children(server.pid)]
+
+
+def format_report(results, master_pss, workers_pss):
+    lines = []
+    for name, values in (
+        ("Time to first byte", results.first_byte_times),
+        ("Time to first token", results.first_token_times),
+        ("Inter-token latency", results.token_gaps),
+    ):
+        p50, p95, p99 = percentiles(values)
+        lines.append(f"{name:<22} p50 {p50:8.1f} ms   p95 {p95:8.1f} ms   p99 {p99:8.1f} ms")
+    lines.append(
+        f"{'Throughput':<22} {results.streams / results.duration:.1f} streams/s, "
+        f"{results.tokens / results.duration:.0f} tokens/s, {results.bytes / results.duration / 1024:.0f} KB/s"
+    )
+    errors = ", ".join(f"{count} {kind}" for kind, count in results.errors.most_common()) or "none"
+    lines.append(f"{'Errors':<22} {errors}")
+    lines.append(
+        f"{'Memory (PSS)':<22} master {master_pss:.0f} MB, workers " + ", ".join(f"{pss:.0f} MB" for pss in workers_pss)
+    )
+    return "\n".join(lines)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load, after the ramp-up")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which the clients start")
+    parser.add_argument("--workers", type=int, default=None, help="gunicorn workers, by default one per CPU")
+    parser.add_argument("--deltas", type=int, default=100, help="tokens per answer")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="upstream token rate of each stream")
+    parser.add_argument("--first-token-delay", type=float, default=0.2, help="upstream time to first token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream requests that fail")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="share of upstream streams cut off")
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="app setting, like CHAT_RESPONSE_CACHE_ENABLED=true",
+    )
+    args = parser.parse_args()
+
+    if args.workers is None:
+        sys.path.insert(0, SRC)
+        from quartapp.workers import get_worker_count
+
+        args.workers = get_worker_count()
+    upstream_port = free_port()
+    upstream = start_upstream(
+        upstream_port,
+        deltas=args.deltas,
+        delta_interval=1 / args.tokens_per_second,
+        first_token_delay=args.first_token_delay,
+        error_rate=args.error_rate,
+        disconnect_rate=args.disconnect_rate,
+    )
+    try:
+        port = free_port()
+        server = start_app(port, upstream_port, args.workers, dict(setting.split("=", 1) for setting in args.env))
+        try:
+            print(f"{args.clients} clients, {args.workers} workers, {args.duration:.0f}s", flush=True)
+            results = await run_clients(
+                f"http://127.0.0.1:{port}/chat/stream", args.clients, args.duration, args.ramp_up
+            )
+            print(format_report(results, *worker_memory(server)))
+        finally:
+            stop(server)
+    finally:
+        stop(upstream)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
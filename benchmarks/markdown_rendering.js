@@ -0,0 +1,172 @@
+// Compare the CPU time of rendering a streamed answer of about 4000 tokens, converting the whole answer
+// for every delta as the page used to, and with IncrementalMarkdownRenderer.
+// It first checks that the incremental renderer's HTML is the same as converting the whole answer at once,
+// for answers with loose and nested lists, code fences and repeated headings, and exits with an error if it isn't.
+//
+// node benchmarks/markdown_rendering.js [--tokens 4000] [--deltas-per-frame 3] [--marked path/to/marked.js]
+//
+// It uses the page's converter: the vendored marked, with the page's options, unless --marked points to another build.
+// It runs headless, with stand-in elements that keep their HTML as a string, so it measures the markdown
+// conversion, not the browser's layout of the HTML, which also grows with what's rewritten.
+
+const path = require("path");
+const STATIC_DIR = path.join(__dirname, "..", "src", "quartapp", "static");
+const {IncrementalMarkdownRenderer, createMarkedConverter} = require(path.join(STATIC_DIR, "markdown-stream.js"));
+
+function option(name, fallback) {
+    const index = process.argv.indexOf(`--${name}`);
+    return index === -1 ? fallback : process.argv[index + 1];
+}
+
+const tokens = parseInt(option("tokens", "4000"));
+const deltasPerFrame = parseInt(option("deltas-per-frame", "3"));
+
+function createConverter() {
+    const markedPath = path.resolve(option("marked", path.join(STATIC_DIR, "vendor", "marked.umd.js")));
+    return {name: path.relative(process.cwd(), markedPath), ...createMarkedConverter(require(markedPath).marked)};
+}
+
+class FakeElement {
+    constructor() {
+        this.ownerDocument = {createElement: () => new FakeElement()};
+        this._innerHTML = "";
+        this.children = [];
+    }
+
+    // Like a browser, setting the HTML replaces the children, and the HTML includes theirs
+    get innerHTML() {
+        return this._innerHTML + this.children.map((child) => child.innerHTML).join("");
+    }
+
+    set innerHTML(html) {
+        this._innerHTML = html;
+        this.children = [];
+    }
+
+    appendChild(child) {
+        this.children.push(child);
+        return child;
+    }
+
+    insertAdjacentHTML(position, html) {
+        this._innerHTML += html;
+    }
+}
+
+// Answers like the model's, with the markdown that a wrong block boundary would render differently
+const CORPUS = [
+    // Loose ordered list: one <ol>, not one per item
+    "Here are the steps:\n\n1. Install the package.\n\n2. Configure the endpoint.\n\n3. Run the app.\n\nThat's it.\n",
+    // Loose bullet list, followed by a paragraph
+    "Pros:\n\n- Fast\n\n- Cheap\n\n* Simple\n\nCons: none.\n",
+    // Nested lists, with paragraphs and blank lines inside items
+    "1. First step\n\n   More about the first step.\n\n   - a detail\n\n   - another detail\n\n2. Second step\n   - tight detail\n\n10) Tenth step\n",
+    // Code fences with blank lines inside, at the top level and inside a list item
+    "Example:\n\n```python\ndef main():\n\n    return 42\n\n\nprint(main())\n```\n\n1. Run:\n\n   ```shell\n   python app.py\n\n   ```\n\n2. Done\n",
+    // Tilde fences, indented code blocks, quotes and headings
+    "# Title\n\nText\n\n~~~\n- not a list\n\n1. not a list either\n~~~\n\n    indented code\n\n    more code\n\n> quoted\n\n> another quote\n\n## End\n",
+    // A list item after a paragraph, and a paragraph that only looks like a number
+    "Items:\n\n- one\n- two\n\n2024 was a good year.\n\n- three\n",
+    // Repeated headings, in separate blocks: converting them one block at a time mustn't give them the same id
+    "## Example\n\nFirst.\n\n## Example\n\nSecond.\n\nSetext heading\n--------------\n\n## Example\n",
+];
+
+// Renders `answer` in deltas of `deltaSize` characters, a frame every `deltasPerFrame` deltas
+function renderIncrementally(converter, deltas, deltasPerFrame) {
+    const frames = [];
+    const container = new FakeElement();
+    const renderer = new IncrementalMarkdownRenderer(container, converter, {
+        requestFrame: (callback) => frames.push(callback),
+        cancelFrame: () => frames.pop(),
+    });
+    deltas.forEach((delta, i) => {
+        renderer.append(delta);
+        if ((i + 1) % deltasPerFrame == 0) {
+            frames.shift()?.();
+        }
+    });
+    renderer.finish();
+    return container.innerHTML;
+}
+
+// The whitespace between tags doesn't render
+function normalize(html) {
+    return html.replace(/>\s+</g, "><").trim();
+}
+
+function split(answer, size) {
+    return answer.match(new RegExp(`[\\s\\S]{1,${size}}`, "g"));
+}
+
+function checkEquivalence(converter) {
+    let checks = 0;
+    const failures = [];
+    for (const answer of CORPUS) {
+        const expected = normalize(converter.makeHtml(answer));
+        for (const deltaSize of [1, 3, 4, 7, 16]) {
+            for (const deltasPerFrame of [1, 2, 5]) {
+                const html = normalize(renderIncrementally(converter, split(answer, deltaSize), deltasPerFrame));
+                checks++;
+                if (html != expected) {
+                    failures.push({answer, deltaSize, deltasPerFrame, expected, html});
+                }
+            }
+        }
+    }
+    for (const {answer, deltaSize, deltasPerFrame, expected, html} of failures.slice(0, 3)) {
+        console.error(`Different HTML with deltas of ${deltaSize} characters, ${deltasPerFrame} per frame, for:`);
+        console.error(JSON.stringify(answer));
+        console.error(`  whole answer: ${expected}\n  incremental:  ${html}`);
+    }
+    console.log(`${checks - failures.length} of ${checks} renders of the corpus match the whole answer's HTML`);
+    return failures.length == 0;
+}
+
+// An answer of paragraphs, lists and code blocks, split into deltas of about one token (4 characters)
+function makeDeltas(tokens) {
+    const words = "the quick brown fox jumps over a lazy dog while **streaming** some `inline code` and more".split(" ");
+    let answer = "";
+    for (let block = 0; answer.length < tokens * 4; block++) {
+        if (block % 5 == 3) {
+            answer += "```python\ndef answer(question):\n\n    return 42\n```\n\n";
+        } else if (block % 5 == 1) {
+            const separator = block % 2 ? "\n\n" : "\n";
+            answer += [1, 2, 3, 4].map((item) => `${item}. item ${item}: ${words.slice(item, item + 6).join(" ")}`).join(separator) + "\n\n";
+        } else {
+            answer += `## Section ${block}\n\n` + Array.from({length: 40}, (_, i) => words[(block + i) % words.length]).join(" ") + "\n\n";
+        }
+    }
+    return split(answer, 4);
+}
+
+function measure(name, run) {
+    const started = process.cpuUsage();
+    run();
+    const used = process.cpuUsage(started);
+    const milliseconds = (used.user + used.system) / 1000;
+    console.log(`${name.padEnd(45)} ${milliseconds.toFixed(0).padStart(8)} ms`);
+}
+
+const converter = createConverter();
+console.log(`Converter: ${converter.name}`);
+if (!checkEquivalence(converter)) {
+    process.exit(1);
+}
+
+const deltas = makeDeltas(tokens);
+console.log(`${deltas.length} deltas, ${deltas.join("").length} characters`);
+if (normalize(renderIncrementally(converter, deltas, deltasPerFrame)) != normalize(converter.makeHtml(deltas.join("")))) {
+    console.error("The incremental renderer's HTML differs from the whole answer's");
+    process.exit(1);
+}
+
+measure("Whole answer for every delta", () => {
+    const element = new FakeElement();
+    let answer = "";
+    for (const delta of deltas) {
+        answer += delta;
+        element.innerHTML = converter.makeHtml(answer);
+    }
+});
+measure("Incremental, a render for every delta", () => renderIncrementally(converter, deltas, 1));
+measure(`Incremental, ${deltasPerFrame} deltas per animation frame`, () => renderIncrementally(converter, deltas, deltasPerFrame));
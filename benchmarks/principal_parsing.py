@@ -0,0 +1,49 @@
+"""Measure X-MS-CLIENT-PRINCIPAL header parsing throughput, with and without the principal cache.
+
+python benchmarks/principal_parsing.py --requests 200000 --users 100
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from quartapp.principal import Principal, PrincipalParser  # noqa: E402
+
+
+def make_header(user):
+    claims = [
+        {"typ": "name", "val": f"User {user}"},
+        {"typ": "http://schemas.microsoft.com/identity/claims/objectidentifier", "val": f"{user:08x}-0000"},
+        {"typ": "preferred_username", "val": f"user{user}@example.com"},
+        {"typ": "roles", "val": "reader"},
+    ] + [{"typ": f"claim{i}", "val": "x" * 40} for i in range(20)]
+    return base64.b64encode(json.dumps({"auth_typ": "aad", "claims": claims}).encode()).decode()
+
+
+def measure(parse, headers, requests):
+    started = time.perf_counter()
+    for i in range(requests):
+        parse(headers[i % len(headers)])
+    return requests / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=100, help="distinct headers, one per signed-in user")
+    args = parser.parse_args()
+
+    headers = [make_header(user) for user in range(args.users)]
+    uncached = measure(Principal.from_header, headers, args.requests)
+    cached = measure(PrincipalParser().parse, headers, args.requests)
+    print(f"uncached: {uncached:,.0f} headers/s")
+    print(f"cached:   {cached:,.0f} headers/s ({cached / uncached:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Measure how many writes and how much CPU time each streamed answer costs, with and without coalescing.
+
+Runs the app in-process against a fake upstream that streams many tiny deltas,
+and calls it directly through ASGI. Each `http.response.body` message is one
+transport write (one send syscall) in uvicorn, so the number of messages is
+the number of socket writes per answer.
+
+    python benchmarks/stream_coalescing.py --answers 50 --deltas 1000 --delta-interval 0.0005
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import quartapp  # noqa: E402
+
+
+def fake_create(deltas, delta_interval):
+    async def events():
+        for i in range(deltas):
+            if delta_interval:
+                await asyncio.sleep(delta_interval)
+            yield SimpleNamespace(type="response.output_text.delta", delta=" tok" if i else "Tok")
+        yield SimpleNamespace(type="response.completed", delta=None)
+
+    class FakeStream:
+        def __init__(self):
+            self.events = events()
+
+        def __aiter__(self):
+            return self.events
+
+        async def close(self):
+            await self.events.aclose()
+
+    async def create(*args, **kwargs):
+        return FakeStream()
+
+    return create
+
+
+async def post_chat(app, question):
+    body = json.dumps({"messages": [{"role": "user", "content": question}]}).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/chat/stream",
+        "raw_path": b"/chat/stream",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 12345),
+        "server": ("localhost", 50505),
+        "extensions": {},
+    }
+    requests = [{"type": "http.request", "body": body, "more_body": False}]
+    writes = 0
+    size = 0
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal writes, size
+        if message["type"] == "http.response.body" and message.get("body"):
+            writes += 1
+            size += len(message["body"])
+
+    await app(scope, receive, send)
+    return writes, size
+
+
+async def run(coalesce, args):
+    app = quartapp.create_app()
+    async with app.test_app():
+        chat_bp = app.blueprints["chat"]
+        chat_bp.openai_client.responses.create = fake_create(args.deltas, args.delta_interval)
+        chat_bp.stream_coalescing = (args.max_bytes, args.max_delay_ms / 1000) if coalesce else None
+
+        writes = size = 0
+        cpu_started = time.process_time()
+        wall_started = time.perf_counter()
+        for i in range(args.answers):
+            answer_writes, answer_size = await post_chat(app, f"Question {i}")
+            writes += answer_writes
+            size += answer_size
+        cpu = time.process_time() - cpu_started
+        wall = time.perf_counter() - wall_started
+    return {
+        "writes/answer": writes / args.answers,
+        "bytes/answer": size / args.answers,
+        "cpu ms/answer": cpu * 1000 / args.answers,
+        "wall ms/answer": wall * 1000 / args.answers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--answers", type=int, default=50)
+    parser.add_argument("--deltas", type=int, default=1000, help="deltas per answer")
+    parser.add_argument("--delta-interval", type=float, default=0.0, help="seconds between upstream deltas")
+    parser.add_argument("--max-bytes", type=int, default=1024)
+    parser.add_argument("--max-delay-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://benchmark.openai.azure.com")
+    os.environ.setdefault("AZURE_OPENAI_KEY", "benchmark")
+    os.environ.setdefault("AZURE_OPENAI_CHATGPT_DEPLOYMENT", "benchmark")
+
+    for coalesce in (False, True):
+        results = asyncio.run(run(coalesce, args))
+        print(f"coalescing {'on ' if coalesce else 'off'}: " + ", ".join(f"{k} {v:.1f}" for k, v in results.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Measure gunicorn's time to ready and total memory, with and without preloading the app.
+
+python benchmarks/worker_startup.py --workers 4
+"""
+
+import argparse
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def memory_kb(pid):
+    """Return the RSS and PSS of a process. PSS splits each shared page between the processes sharing it."""
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        rollup = f.read()
+    return tuple(int(re.search(rf"^{field}:\s+(\d+) kB", rollup, re.MULTILINE).group(1)) for field in ("Rss", "Pss"))
+
+
+def run(workers, preload):
+    env = {
+        **os.environ,
+        "RUNNING_IN_PRODUCTION": "true",
+        "LOCAL_OPENAI_ENDPOINT": "http://127.0.0.1:9/v1",
+        "GUNICORN_PRELOAD": "true" if preload else "false",
+    }
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "quartapp:create_app()",
+            f"--workers={workers}",
+            f"--bind=127.0.0.1:{free_port()}",
+        ],
+        cwd=SRC,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    try:
+        ready = 0
+        for line in server.stdout:
+            if "Application startup complete" in line:
+                ready += 1
+                if ready == workers:
+                    break
+        time_to_ready = time.perf_counter() - started
+        pids = [server.pid] + children(server.pid)
+        rss, pss = (sum(values) for values in zip(*(memory_kb(pid) for pid in pids)))
+        return time_to_ready, rss / 1024, pss / 1024
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.communicate(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=3, help="runs of each mode, the median is reported")
+    args = parser.parse_args()
+
+    for preload in (False, True):
+        results = sorted(run(args.workers, preload) for _ in range(args.runs))
+        time_to_ready, rss, pss = results[len(results) // 2]
+        print(
+            f"preload {'on ' if preload else 'off'}: ready in {time_to_ready:.2f}s, "
+            f"total RSS {rss:.0f} MB, total PSS {pss:.0f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Sweep gunicorn worker counts against concurrent streaming clients, with a fake upstream.
+
+python benchmarks/worker_sweep.py --workers 1 2 4 --clients 10 50 100 --duration 10
+"""
+
+import argparse
+import asyncio
+
+from load_test import percentiles, run_clients, start_app, start_upstream, stop, worker_memory
+from worker_startup import free_port
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load for each combination")
+    parser.add_argument("--deltas", type=int, default=100, help="deltas per streamed answer")
+    parser.add_argument("--delta-interval", type=float, default=0.01, help="seconds between upstream deltas")
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = start_upstream(upstream_port, deltas=args.deltas, delta_interval=args.delta_interval)
+    print("| Workers | Clients | Streams/s | p50 first byte | p95 first byte | Errors | Total PSS |")
+    print("|---------|---------|-----------|----------------|----------------|--------|-----------|")
+    try:
+        for workers in args.workers:
+            port = free_port()
+            server = start_app(port, upstream_port, workers)
+            try:
+                for clients in args.clients:
+                    results = await run_clients(f"http://127.0.0.1:{port}/chat/stream", clients, args.duration)
+                    master_pss, workers_pss = worker_memory(server)
+                    p50, p95, _ = percentiles(results.first_byte_times)
+                    print(
+                        f"| {workers} | {clients} | {results.streams / results.duration:.1f} "
+                        f"| {p50:.0f} ms | {p95:.0f} ms | {sum(results.errors.values())} "
+                        f"| {master_pss + sum(workers_pss):.0f} MB |",
+                        flush=True,
+                    )
+            finally:
+                stop(server)
+    finally:
+        stop(upstream)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
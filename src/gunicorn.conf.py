@@ -1,20 +1,46 @@
-import multiprocessing
+import gc
 import os
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-max_requests = 1000
-max_requests_jitter = 50
+from quartapp.settings import get_bool_env  # noqa: E402
+from quartapp.workers import get_worker_count  # noqa: E402
+
 log_file = "-"
 bind = "0.0.0.0:50505"
 
-if not os.getenv("RUNNING_IN_PRODUCTION"):
+# Preloading creates the app once in the master, and forks workers that share its memory copy-on-write,
+# instead of each worker importing and creating it again.
+# Reloading doesn't work with preloading, as the code is only loaded in the master.
+preload_app = get_bool_env("GUNICORN_PRELOAD")
+
+if not os.getenv("RUNNING_IN_PRODUCTION") and not preload_app:
     reload = True
 
-num_cpus = multiprocessing.cpu_count()
-workers = (num_cpus * 2) + 1
-worker_class = "uvicorn.workers.UvicornWorker"
+# One worker per CPU available to the container, and at least 2 (see get_worker_count), or GUNICORN_WORKERS
+workers = get_worker_count()
+# Recycling workers bounds any memory growth, but a single worker would take the whole app down while it restarts
+if workers > 1:
+    max_requests = 1000
+    max_requests_jitter = 50
+worker_class = "quartapp.workers.ChatWorker"
+# Concurrent connections per worker before new ones get a 503, 0 for no limit
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "0"))
 
 timeout = 120
+
+
+def when_ready(server):
+    if preload_app:
+        from quartapp.startup import preload
+
+        preload(server.app.wsgi())
+
+
+def pre_fork(server, worker):
+    if preload_app:
+        # Keep the master's objects out of the workers' garbage collections,
+        # which would otherwise write to (and so copy) the memory they share
+        gc.freeze()
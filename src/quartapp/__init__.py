@@ -3,6 +3,9 @@ import os
 
 from quart import Quart
 
+from .assets import AssetManifest
+from .startup import create_startup_report
+
 
 def create_app():
     if os.getenv("RUNNING_IN_PRODUCTION"):
@@ -10,10 +13,17 @@ def create_app():
     else:
         logging.basicConfig(level=logging.INFO)
 
+    startup_report = create_startup_report()
+    startup_report.start()
+
     app = Quart(__name__)
 
-    from . import chat  # noqa
+    with startup_report.timed("import quartapp.chat"):
+        from . import chat  # noqa
 
+    chat.bp.startup_report = startup_report
+    with startup_report.timed("load the built assets"):
+        chat.bp.asset_manifest = AssetManifest.load()
     app.register_blueprint(chat.bp)
 
     return app
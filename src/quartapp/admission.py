@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import os
+import time
+
+from .settings import get_bool_env
+
+
+class LoadShed(Exception):
+    """Raised when a request is turned away because the upstream is already at capacity."""
+
+
+class AdmissionController:
+    """Adaptive limit on the number of concurrent upstream requests.
+
+    The limit is adjusted AIMD-style, like TCP's congestion window: every request
+    whose first token arrives within `target_latency` seconds raises it by 1/limit
+    (so by about 1 per round of requests), and a throttled request (a 429 or a 5xx)
+    or a slow first token multiplies it by `backoff`. Decreases are at most once
+    per `backoff_interval` seconds, so a burst of failures from the same overload
+    only counts once.
+
+    Requests over the limit wait in a FIFO queue for up to `queue_timeout` seconds,
+    and are shed with LoadShed if the queue is full or their wait runs out,
+    rather than piling up on an upstream that is already struggling.
+    """
+
+    def __init__(
+        self,
+        initial_limit=16,
+        min_limit=1,
+        max_limit=256,
+        target_latency=5.0,
+        backoff=0.5,
+        backoff_interval=1.0,
+        queue_size=64,
+        queue_timeout=2.0,
+        clock=time.monotonic,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.backoff_interval = backoff_interval
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self.throttled = 0
+        self._last_decrease = None
+        self._waiters = collections.deque()
+
+    @property
+    def capacity(self):
+        return max(self.min_limit, int(self.limit))
+
+    async def acquire(self):
+        """Wait for a slot under the limit and return the Ticket to release it with, or raise LoadShed."""
+        if self.in_flight < self.capacity and not self.queued:
+            self.in_flight += 1
+        else:
+            if self.queued >= self.queue_size:
+                self.shed += 1
+                raise LoadShed("The service is busy, please try again in a moment")
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self.queued += 1
+            try:
+                async with asyncio.timeout(self.queue_timeout):
+                    await waiter
+            except (TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just as the wait ended, so pass it on
+                    self._release_slot()
+                else:
+                    waiter.cancel()
+                if isinstance(e, TimeoutError):
+                    self.shed += 1
+                    raise LoadShed("The service is busy, please try again in a moment") from None
+                raise
+            finally:
+                self.queued -= 1
+        self.admitted += 1
+        return Ticket(self)
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        # Hand the free slots directly to the oldest waiters, so newcomers can't jump the queue
+        while self._waiters and self.in_flight < self.capacity:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def record(self, latency=None, overloaded=False):
+        """Adjust the limit after a request, given the latency of its first token or whether it was throttled."""
+        if overloaded or (latency is not None and latency > self.target_latency):
+            if overloaded:
+                self.throttled += 1
+            now = self.clock()
+            if self._last_decrease is None or now - self._last_decrease >= self.backoff_interval:
+                self._last_decrease = now
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+        elif latency is not None:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "throttled": self.throttled,
+        }
+
+
+class Ticket:
+    """A slot held under the admission limit, released once the upstream request is over."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.started = controller.clock()
+        self.latency = None
+        self.released = False
+
+    def first_token(self):
+        if self.latency is None:
+            self.latency = self.controller.clock() - self.started
+
+    def release(self, overloaded=False):
+        """Give back the slot, and feed the request's outcome to the limit.
+
+        A request that ended before its first token without being throttled
+        (like one whose client went away) says nothing about the upstream, so it isn't counted.
+        """
+        if self.released:
+            return
+        self.released = True
+        self.controller.record(latency=self.latency, overloaded=overloaded)
+        self.controller._release_slot()
+
+
+def create_admission_controller():
+    """Create the admission controller if CHAT_ADMISSION_CONTROL_ENABLED is set, otherwise return None."""
+    if not get_bool_env("CHAT_ADMISSION_CONTROL_ENABLED"):
+        return None
+    return AdmissionController(
+        initial_limit=int(os.getenv("CHAT_ADMISSION_INITIAL_LIMIT", "16")),
+        min_limit=int(os.getenv("CHAT_ADMISSION_MIN_LIMIT", "1")),
+        max_limit=int(os.getenv("CHAT_ADMISSION_MAX_LIMIT", "256")),
+        target_latency=float(os.getenv("CHAT_ADMISSION_TARGET_LATENCY", "5")),
+        queue_size=int(os.getenv("CHAT_ADMISSION_QUEUE_SIZE", "64")),
+        queue_timeout=float(os.getenv("CHAT_ADMISSION_QUEUE_TIMEOUT", "2")),
+    )
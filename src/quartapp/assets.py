@@ -0,0 +1,225 @@
+"""Build and serve the static assets with content-hash filenames, precompressed.
+
+python -m quartapp.assets
+
+writes every asset of static to static/dist, named after a hash of its content, with gzip (and brotli,
+when it's installed) copies and a manifest.json mapping each asset to its built name. It first checks
+the vendored libraries in static/vendor against their pinned hashes, and never downloads anything,
+so it works without network access. The Dockerfile runs it at build time.
+
+python -m quartapp.assets vendor
+
+downloads the vendored libraries that aren't in static/vendor yet, and checks them against their hash in
+static/vendor/SHA256SUMS, or adds it there for a new library. Run it when adding or upgrading a library,
+and commit static/vendor.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import sys
+import urllib.request
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+BUILD_DIR = "dist"
+ASSETS_URL = "/assets"
+
+# Third-party libraries that the page loads, each with the URL of its pinned version
+VENDORED_ASSETS = {
+    "vendor/marked.umd.js": "https://cdn.jsdelivr.net/npm/marked@4.0.19/lib/marked.umd.js",
+}
+# The sha256 of each vendored library, in the format of sha256sum, so `sha256sum -c` can check them too
+VENDORED_HASHES = "vendor/SHA256SUMS"
+
+# Types that compress well, others (like images and fonts) are already compressed
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# Built names change with the content, so browsers and proxies can keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def read_vendored_hashes(static_dir=STATIC_DIR):
+    """Return the pinned sha256 of each vendored library, by its name in static_dir."""
+    hashes = {}
+    try:
+        with open(os.path.join(static_dir, VENDORED_HASHES)) as f:
+            for line in f:
+                if line.strip():
+                    digest, filename = line.split()
+                    hashes[f"vendor/{filename.lstrip('*')}"] = digest
+    except FileNotFoundError:
+        pass
+    return hashes
+
+
+def write_vendored_hashes(hashes, static_dir=STATIC_DIR):
+    with open(os.path.join(static_dir, VENDORED_HASHES), "w") as f:
+        for name, digest in sorted(hashes.items()):
+            f.write(f"{digest}  {name.removeprefix('vendor/')}\n")
+
+
+def vendor_assets(static_dir=STATIC_DIR):
+    """Download the vendored libraries that aren't in static_dir yet, and return their names.
+
+    A download whose sha256 differs from the pinned one raises ValueError, and isn't kept.
+    The hash of a library that isn't pinned yet is added to the pinned hashes.
+    """
+    hashes = read_vendored_hashes(static_dir)
+    downloaded = []
+    for name, url in VENDORED_ASSETS.items():
+        path = os.path.join(static_dir, name)
+        if os.path.exists(path):
+            continue
+        with urllib.request.urlopen(url, timeout=30) as response:
+            content = response.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if name not in hashes:
+            logger.warning("Pinning %s to sha256 %s, check it before committing it", name, digest)
+            hashes[name] = digest
+        elif digest != hashes[name]:
+            raise ValueError(f"{url} has sha256 {digest}, but {hashes[name]} is pinned for {name}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        downloaded.append(name)
+    write_vendored_hashes(hashes, static_dir)
+    return downloaded
+
+
+def verify_vendored_assets(static_dir=STATIC_DIR):
+    """Check that every vendored library is in static_dir, with its pinned sha256, or raise ValueError."""
+    hashes = read_vendored_hashes(static_dir)
+    for name in VENDORED_ASSETS:
+        path = os.path.join(static_dir, name)
+        if not os.path.exists(path) or name not in hashes:
+            raise ValueError(f"{name} isn't vendored, run python -m quartapp.assets vendor and commit static/vendor")
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if digest != hashes[name]:
+            raise ValueError(f"{name} has sha256 {digest}, but {hashes[name]} is pinned")
+
+
+def compress(content):
+    """Return the encodings worth serving for content, each mapped to its compressed content."""
+    encodings = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    try:
+        # brotli compresses text better than gzip. It's in the requirements, but a checkout without it still builds
+        import brotli
+    except ImportError:
+        pass
+    else:
+        encodings["br"] = brotli.compress(content, quality=11)
+    return {encoding: compressed for encoding, compressed in encodings.items() if len(compressed) < len(content)}
+
+
+def build_assets(static_dir=STATIC_DIR):
+    """Check the vendored libraries, write every asset of static_dir to its build directory, and return the manifest."""
+    verify_vendored_assets(static_dir)
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    shutil.rmtree(build_dir, ignore_errors=True)
+    manifest = {}
+    for directory, subdirectories, filenames in os.walk(static_dir):
+        if directory == static_dir and BUILD_DIR in subdirectories:
+            subdirectories.remove(BUILD_DIR)
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, "/")
+            if name == VENDORED_HASHES:
+                continue
+            with open(path, "rb") as f:
+                content = f.read()
+            stem, extension = os.path.splitext(name)
+            built_name = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+            built_path = os.path.join(build_dir, built_name)
+            os.makedirs(os.path.dirname(built_path), exist_ok=True)
+            with open(built_path, "wb") as f:
+                f.write(content)
+            if (mimetypes.guess_type(name)[0] or "").startswith(COMPRESSIBLE_TYPES):
+                for encoding, compressed in compress(content).items():
+                    with open(f"{built_path}.{'gz' if encoding == 'gzip' else encoding}", "wb") as f:
+                        f.write(compressed)
+            manifest[name] = built_name
+    with open(os.path.join(build_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+@dataclass
+class BuiltAsset:
+    mimetype: str
+    # The content in each encoding, "identity" for the uncompressed content
+    encodings: dict
+    # The content hash in the built name
+    version: str
+
+    def etag(self, encoding):
+        # Each encoding is a different representation, so it needs its own strong ETag
+        return self.version if encoding == "identity" else f"{self.version}-{encoding}"
+
+
+@dataclass
+class AssetManifest:
+    """The built assets, loaded in memory, and the URLs that the page loads them from.
+
+    Without a build (like when running the app from a checkout), assets are served from /static
+    without caching.
+    """
+
+    urls: dict = field(default_factory=dict)
+    assets: dict = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, static_dir=STATIC_DIR):
+        build_dir = os.path.join(static_dir, BUILD_DIR)
+        try:
+            with open(os.path.join(build_dir, "manifest.json")) as f:
+                built_names = json.load(f)
+        except FileNotFoundError:
+            logger.info("No built assets in %s, serving them from /static", build_dir)
+            built_names = {}
+        manifest = cls()
+        for name, built_name in built_names.items():
+            path = os.path.join(build_dir, built_name)
+            encodings = {}
+            for encoding, suffix in (("identity", ""), ("gzip", ".gz"), ("br", ".br")):
+                if os.path.exists(path + suffix):
+                    with open(path + suffix, "rb") as f:
+                        encodings[encoding] = f.read()
+            manifest.urls[name] = f"{ASSETS_URL}/{built_name}"
+            manifest.assets[built_name] = BuiltAsset(
+                mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream",
+                encodings=encodings,
+                version=os.path.splitext(built_name)[0].rsplit(".", 1)[-1],
+            )
+        return manifest
+
+    def url(self, name):
+        return self.urls.get(name, f"/static/{name}")
+
+    def get(self, built_name, accept_encodings):
+        """Return the asset and the encoding to serve it in, the best that the client accepts.
+
+        accept_encodings is the request's parsed Accept-Encoding header. Returns None for unknown assets.
+        """
+        asset = self.assets.get(built_name)
+        if asset is None:
+            return None
+        encoding = accept_encodings.best_match([encoding for encoding in ("br", "gzip") if encoding in asset.encodings])
+        return asset, encoding or "identity"
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["vendor"]:
+        for name in vendor_assets():
+            logger.info("Downloaded %s", name)
+    else:
+        for name, built_name in build_assets().items():
+            logger.info("Built %s as %s", name, built_name)
@@ -0,0 +1,139 @@
+import json
+import os
+import random
+import time
+
+import openai
+
+# Errors that mean a backend is overloaded or unavailable, rather than that the request itself is wrong
+UPSTREAM_OVERLOAD_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+)
+
+
+class Backend:
+    """One OpenAI-compatible deployment that chat requests can be routed to."""
+
+    def __init__(self, name, client, model, weight=1, token_provider=None):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.weight = weight
+        # The callable that the client gets its bearer token or key from, if it isn't a fixed key
+        self.token_provider = token_provider
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+        self.first_token_latency_total = 0.0
+        self.first_token_latency_count = 0
+
+    def record_first_token(self, latency):
+        self.first_token_latency_total += latency
+        self.first_token_latency_count += 1
+
+    def stats(self, now):
+        return {
+            "healthy": self.ejected_until is None or now >= self.ejected_until,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "avg_first_token_latency_seconds": (
+                round(self.first_token_latency_total / self.first_token_latency_count, 3)
+                if self.first_token_latency_count
+                else None
+            ),
+        }
+
+
+class BackendPool:
+    """Routes requests across backends, and takes the ones that fail out of rotation for a while.
+
+    With the "least_outstanding" strategy, each request goes to the backend with the fewest
+    requests in progress relative to its weight. With "weighted", backends are picked at random
+    in proportion to their weights. A backend that is throttled or fails is ejected for
+    `cooldown` seconds; if every backend is ejected, the one that comes back soonest is used.
+    """
+
+    STRATEGIES = ("least_outstanding", "weighted")
+
+    def __init__(self, backends, strategy="least_outstanding", cooldown=30.0, clock=time.monotonic, rng=None):
+        if not backends:
+            raise ValueError("A backend pool needs at least one backend")
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown routing strategy {strategy!r}, expected one of {', '.join(self.STRATEGIES)}")
+        self.backends = list(backends)
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.clock = clock
+        self.rng = rng or random.Random()
+
+    def __len__(self):
+        return len(self.backends)
+
+    def choose(self, exclude=()):
+        """Return the backend for the next request, skipping the ones in `exclude`, or None if none are left."""
+        candidates = [backend for backend in self.backends if backend not in exclude]
+        if not candidates:
+            return None
+        now = self.clock()
+        healthy = [backend for backend in candidates if backend.ejected_until is None or now >= backend.ejected_until]
+        if not healthy:
+            return min(candidates, key=lambda backend: backend.ejected_until)
+        if self.strategy == "weighted":
+            return self.rng.choices(healthy, weights=[backend.weight for backend in healthy])[0]
+        # Ties go to the backend that has had the fewest requests, so an idle pool is used round-robin
+        return min(
+            healthy, key=lambda backend: (backend.outstanding / backend.weight, backend.requests / backend.weight)
+        )
+
+    def eject(self, backend):
+        backend.failures += 1
+        backend.ejections += 1
+        backend.ejected_until = self.clock() + self.cooldown
+
+    def stats(self):
+        now = self.clock()
+        return {backend.name: backend.stats(now) for backend in self.backends}
+
+
+def get_backend_configs():
+    """Return the backends declared in OPENAI_BACKENDS (a JSON list), or None if it isn't set.
+
+    Each backend is an object with a "type" ("azure", "openai" or "local"), and:
+      azure:  "endpoint", "deployment", and optionally "api_key_env", the variable holding its key
+              (otherwise it uses the Azure credential)
+      openai: "model", and optionally "api_key_env" (OPENAICOM_API_KEY by default)
+      local:  "endpoint", and optionally "model"
+    plus an optional "name" and "weight" (1 by default).
+    """
+    value = os.getenv("OPENAI_BACKENDS", "").strip()
+    if not value:
+        return None
+    configs = json.loads(value)
+    if not isinstance(configs, list) or not configs:
+        raise ValueError("OPENAI_BACKENDS must be a non-empty JSON list of backends")
+    for index, config in enumerate(configs):
+        backend_type = config.get("type")
+        required = {"azure": ("endpoint", "deployment"), "openai": ("model",), "local": ("endpoint",)}.get(backend_type)
+        if required is None:
+            raise ValueError(f"Backend {index} in OPENAI_BACKENDS has an unknown type: {backend_type!r}")
+        for key in required:
+            if not config.get(key):
+                raise ValueError(f"Backend {index} in OPENAI_BACKENDS is missing {key!r}")
+        config.setdefault("name", f"{backend_type}-{index}")
+    return configs
+
+
+def create_backend_pool(backends):
+    """Create the pool for `backends`, with the OPENAI_ROUTING_STRATEGY and OPENAI_BACKEND_COOLDOWN settings."""
+    return BackendPool(
+        backends,
+        strategy=os.getenv("OPENAI_ROUTING_STRATEGY", "least_outstanding").strip().lower(),
+        cooldown=float(os.getenv("OPENAI_BACKEND_COOLDOWN", "30")),
+    )
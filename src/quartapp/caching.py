@@ -0,0 +1,274 @@
+import hashlib
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from .settings import get_bool_env
+
+# numpy is imported where it's used, so that workers without a semantic cache don't spend time importing it
+
+
+def normalize_messages(messages):
+    """Reduce messages to the parts that affect the answer, without leading and trailing whitespace.
+
+    Whitespace inside the content is kept, as indentation and line breaks change the meaning of code, YAML or tables.
+    """
+    return [{"role": message["role"], "content": (message.get("content") or "").strip()} for message in messages]
+
+
+def response_cache_key(model, messages):
+    payload = json.dumps([model, normalize_messages(messages)], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+@dataclass
+class CachedResponse:
+    deltas: list
+    # How long the upstream took to stream the original answer, in seconds
+    duration: float
+    expires_at: float
+    model: str = None
+
+
+class CacheStats:
+    hits = 0
+    misses = 0
+    latency_saved = 0.0
+
+    async def replay(self, response):
+        """Yield the cached deltas, then None to mark the end of the answer, like a live stream."""
+        started = time.monotonic()
+        for delta in response.deltas:
+            yield delta
+        self.latency_saved += max(response.duration - (time.monotonic() - started), 0.0)
+        yield None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "latency_saved_seconds": self.latency_saved,
+        }
+
+
+class ResponseCache(CacheStats):
+    """Exact-match cache of streamed answers, with LRU and TTL eviction.
+
+    Answers are stored as their list of text deltas, so a hit can be replayed
+    through the same NDJSON framing as a live answer.
+    """
+
+    def __init__(self, maxsize=1000, ttl=3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._responses = OrderedDict()
+
+    def __len__(self):
+        return len(self._responses)
+
+    def get(self, key):
+        response = self._responses.get(key)
+        if response is not None and response.expires_at <= self.clock():
+            del self._responses[key]
+            response = None
+        if response is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._responses.move_to_end(key)
+        return response
+
+    def put(self, key, deltas, duration):
+        self._responses[key] = CachedResponse(list(deltas), duration, self.clock() + self.ttl)
+        self._responses.move_to_end(key)
+        while len(self._responses) > self.maxsize:
+            self._responses.popitem(last=False)
+
+
+def create_response_cache():
+    """Create the response cache if CHAT_RESPONSE_CACHE_ENABLED is set, otherwise return None."""
+    if not get_bool_env("CHAT_RESPONSE_CACHE_ENABLED"):
+        return None
+    return ResponseCache(
+        maxsize=int(os.getenv("CHAT_RESPONSE_CACHE_SIZE", "1000")),
+        ttl=int(os.getenv("CHAT_RESPONSE_CACHE_TTL", "3600")),
+    )
+
+
+class BruteForceIndex:
+    """Exact nearest-neighbour search over unit vectors, as one matrix product per query."""
+
+    def __init__(self):
+        import numpy as np
+
+        self._ids = []
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, vector_id, vector):
+        import numpy as np
+
+        if not self._ids:
+            self._vectors = np.empty((0, len(vector)), dtype=np.float32)
+        self._vectors = np.vstack([self._vectors, vector])
+        self._ids.append(vector_id)
+
+    def remove(self, vector_id):
+        import numpy as np
+
+        position = self._ids.index(vector_id)
+        del self._ids[position]
+        self._vectors = np.delete(self._vectors, position, axis=0)
+
+    def search(self, vector, k=1):
+        """Return up to `k` (id, cosine similarity) pairs, most similar first."""
+        import numpy as np
+
+        if not self._ids:
+            return []
+        scores = self._vectors @ vector
+        best = np.argsort(-scores)[:k]
+        return [(self._ids[i], float(scores[i])) for i in best]
+
+
+class LSHIndex:
+    """Approximate nearest-neighbour search with random-hyperplane locality-sensitive hashing.
+
+    Vectors are bucketed by the signs of their projections on `num_planes` random hyperplanes,
+    in `num_tables` independent tables. A query is only compared to the vectors that share
+    a bucket with it in at least one table, so it scales better than brute force
+    for large caches, at the cost of sometimes missing the nearest neighbour.
+    """
+
+    def __init__(self, dimensions, num_planes=12, num_tables=4, seed=0):
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        self._planes = rng.standard_normal((num_tables, num_planes, dimensions)).astype(np.float32)
+        self._powers = 1 << np.arange(num_planes)
+        self._tables = [{} for _ in range(num_tables)]
+        self._vectors = {}
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def _buckets(self, vector):
+        signs = (self._planes @ vector) > 0
+        return (signs @ self._powers).tolist()
+
+    def add(self, vector_id, vector):
+        self._vectors[vector_id] = vector
+        for table, bucket in zip(self._tables, self._buckets(vector)):
+            table.setdefault(bucket, set()).add(vector_id)
+
+    def remove(self, vector_id):
+        vector = self._vectors.pop(vector_id)
+        for table, bucket in zip(self._tables, self._buckets(vector)):
+            table[bucket].discard(vector_id)
+            if not table[bucket]:
+                del table[bucket]
+
+    def search(self, vector, k=1):
+        candidates = set()
+        for table, bucket in zip(self._tables, self._buckets(vector)):
+            candidates.update(table.get(bucket, ()))
+        scores = sorted(((float(self._vectors[i] @ vector), i) for i in candidates), reverse=True)
+        return [(i, score) for score, i in scores[:k]]
+
+
+class SemanticCache(CacheStats):
+    """Cache of answers looked up by the embedding similarity of the user's question.
+
+    `embed` is an async function that returns the embedding of a string, so that
+    a local function can stand in for the embeddings API. Only single-question
+    conversations are cached: a follow-up question can't be answered without its context.
+    """
+
+    def __init__(self, embed, index=None, threshold=0.95, maxsize=1000, ttl=3600, clock=time.monotonic):
+        self.embed = embed
+        self.index = index if index is not None else BruteForceIndex()
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._responses = OrderedDict()
+        self._ids = itertools.count()
+
+    def __len__(self):
+        return len(self._responses)
+
+    @staticmethod
+    def question(messages):
+        user_messages = [message for message in messages if message["role"] == "user"]
+        if len(user_messages) != 1 or messages[-1] is not user_messages[0]:
+            return None
+        return user_messages[0].get("content") or None
+
+    async def embed_question(self, messages):
+        """Return the normalized embedding of the question in `messages`, or None if it can't be cached."""
+        import numpy as np
+
+        question = self.question(messages)
+        if question is None:
+            return None
+        vector = np.asarray(await self.embed(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _remove(self, vector_id):
+        self.index.remove(vector_id)
+        del self._responses[vector_id]
+
+    def get(self, model, vector):
+        now = self.clock()
+        for vector_id, score in self.index.search(vector, k=4):
+            if score < self.threshold:
+                break
+            response = self._responses[vector_id]
+            if response.expires_at <= now:
+                self._remove(vector_id)
+            elif response.model == model:
+                self.hits += 1
+                self._responses.move_to_end(vector_id)
+                return response
+        self.misses += 1
+        return None
+
+    def put(self, model, vector, deltas, duration):
+        vector_id = next(self._ids)
+        self.index.add(vector_id, vector)
+        self._responses[vector_id] = CachedResponse(list(deltas), duration, self.clock() + self.ttl, model=model)
+        while len(self._responses) > self.maxsize:
+            self._remove(next(iter(self._responses)))
+
+
+def create_semantic_cache(embed, dimensions):
+    """Create the semantic cache if CHAT_SEMANTIC_CACHE_ENABLED is set, otherwise return None.
+
+    CHAT_SEMANTIC_CACHE_INDEX selects brute-force search ("bruteforce", the default) or "lsh".
+    """
+    if not get_bool_env("CHAT_SEMANTIC_CACHE_ENABLED"):
+        return None
+    index_type = os.getenv("CHAT_SEMANTIC_CACHE_INDEX", "bruteforce").strip().lower()
+    if index_type == "bruteforce":
+        index = BruteForceIndex()
+    elif index_type == "lsh":
+        index = LSHIndex(dimensions)
+    else:
+        raise ValueError(f"Unknown CHAT_SEMANTIC_CACHE_INDEX: {index_type}")
+    return SemanticCache(
+        embed,
+        index=index,
+        threshold=float(os.getenv("CHAT_SEMANTIC_CACHE_THRESHOLD", "0.95")),
+        maxsize=int(os.getenv("CHAT_SEMANTIC_CACHE_SIZE", "1000")),
+        ttl=int(os.getenv("CHAT_SEMANTIC_CACHE_TTL", "3600")),
+    )
@@ -1,39 +1,83 @@
-import base64
-import json
+import asyncio
+import contextlib
 import os
+import time
 
-import azure.identity.aio
-from azure.keyvault.secrets.aio import SecretClient
 import openai
 from openai import AsyncOpenAI
 from quart import (
     Blueprint,
     Response,
+    abort,
     current_app,
     render_template,
     request,
     stream_with_context,
 )
 
+from .admission import create_admission_controller
+from .assets import ASSETS_URL, IMMUTABLE_CACHE_CONTROL
+from .backends import UPSTREAM_OVERLOAD_ERRORS, Backend, create_backend_pool, get_backend_configs
+from .caching import create_response_cache, create_semantic_cache, response_cache_key
+from .coalescing import create_request_coalescer
+from .conversations import create_conversation_store, new_conversation_id
+from .credentials import create_azure_credential, create_token_manager
+from .frames import get_frame_serializer
+from .history import estimate_tokens, get_history_mode, get_token_budget, trim_history
+from .keyvault import create_secret_provider
+from .metrics import create_request_metrics
+from .pages import USERNAME_MARKER, PrerenderedPage, get_page_compression
+from .principal import get_principal, principal_parser
+from .ratelimit import LeasedBody, RateLimitExceeded, create_rate_limiter
+from .settings import get_number_env
+from .streaming import coalesce_frames, get_coalescing_settings
+from .transport import create_http_client, pool_stats, warm_up
+
 bp = Blueprint("chat", __name__, template_folder="templates", static_folder="static")
 
+MAX_OUTPUT_TOKENS = 1000
+
 
 def get_azure_credential():
     if not hasattr(bp, "azure_credential"):
-        bp.azure_credential = azure.identity.aio.DefaultAzureCredential(exclude_shared_token_cache_credential=True)
+        bp.azure_credential = create_azure_credential()
     return bp.azure_credential
 
 
+def get_token_manager():
+    if bp.token_manager is None:
+        bp.token_manager = create_token_manager(get_azure_credential())
+    return bp.token_manager
+
+
 @bp.before_app_serving
 async def configure_openai():
-    client_args = {}
-    if os.getenv("LOCAL_OPENAI_ENDPOINT"):
+    configure_started = time.perf_counter()
+    # All requests to the OpenAI API share one tunable connection pool
+    bp.http_client = create_http_client()
+    bp.token_manager = None
+    bp.secret_provider = None
+    client_args = {"http_client": bp.http_client}
+    backend_configs = get_backend_configs()
+    if backend_configs:
+        # Spread requests over several deployments, which can mix regions and providers.
+        # The first one also serves embeddings.
+        current_app.logger.info("Using %d OpenAI backends", len(backend_configs))
+        # With several backends, the pool retries a throttled or failing request on the next one right away,
+        # rather than the client retrying the same backend, after waiting up to a minute for its Retry-After
+        max_retries = 0 if len(backend_configs) > 1 else openai.DEFAULT_MAX_RETRIES
+        backends = [create_backend(config, max_retries) for config in backend_configs]
+        bp.openai_client = backends[0].client
+        bp.openai_model_arg = backends[0].model
+    elif os.getenv("LOCAL_OPENAI_ENDPOINT"):
         current_app.logger.info("Using local OpenAI-compatible API with no key")
         client_args["api_key"] = "no-key-required"
         client_args["base_url"] = os.getenv("LOCAL_OPENAI_ENDPOINT")
         bp.openai_client = openai.AsyncOpenAI(
             **client_args,
         )
+        # Local servers generally serve whichever model they've loaded, whatever the name
+        bp.openai_model_arg = os.getenv("OPENAI_MODEL_NAME") or "local-model"
     elif os.getenv("AZURE_OPENAI_ENDPOINT"):
         # Use an Azure OpenAI endpoint instead,
         # either with a key or with keyless authentication
@@ -44,15 +88,12 @@ async def configure_openai():
             current_app.logger.info("Using Azure OpenAI with key")
             client_args["api_key"] = os.getenv("AZURE_OPENAI_KEY")
         else:
-            # Authenticate using the default Azure credential chain
+            # Authenticate using an Azure credential (see get_credential_chain)
             # See https://docs.microsoft.com/azure/developer/python/azure-sdk-authenticate#defaultazurecredential
             # This will *not* work inside a Docker container.
-            # This should work on ACA as long as AZURE_CLIENT_ID is set to the user-assigned managed identity
+            # On ACA, AZURE_CLIENT_ID is set to the user-assigned managed identity, so only that is tried
             current_app.logger.info("Using Azure OpenAI with default credential")
-            default_credential = get_azure_credential()
-            client_args["api_key"] = azure.identity.aio.get_bearer_token_provider(
-                default_credential, "https://cognitiveservices.azure.com/.default"
-            )
+            client_args["api_key"] = get_token_manager()
         if not os.getenv("AZURE_OPENAI_ENDPOINT"):
             raise ValueError("AZURE_OPENAI_ENDPOINT is required for Azure OpenAI")
         if not os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT"):
@@ -67,71 +108,446 @@ async def configure_openai():
         if os.getenv("OPENAICOM_API_KEY"):
             client_args["api_key"] = os.getenv("OPENAICOM_API_KEY")
         else:
-            OPENAICOM_API_KEY_SECRET_NAME = os.getenv("OPENAICOM_API_KEY_SECRET_NAME")
-            AZURE_KEY_VAULT_NAME = os.getenv("AZURE_KEY_VAULT_NAME")
-            async with SecretClient(
-                vault_url=f"https://{AZURE_KEY_VAULT_NAME}.vault.azure.net", credential=get_azure_credential()
-            ) as key_vault_client:
-                openai_api_key = (await key_vault_client.get_secret(OPENAICOM_API_KEY_SECRET_NAME)).value
-            client_args["api_key"] = openai_api_key
+            # Fetched once for all the workers, and re-read in the background so a rotated key is picked up
+            bp.secret_provider = create_secret_provider(
+                os.getenv("AZURE_KEY_VAULT_NAME"), os.getenv("OPENAICOM_API_KEY_SECRET_NAME"), get_azure_credential()
+            )
+            with bp.startup_report.timed("fetch the Key Vault secret"):
+                await bp.secret_provider.start()
+            client_args["api_key"] = bp.secret_provider
         bp.openai_client = openai.AsyncOpenAI(
             **client_args,
         )
         bp.openai_model_arg = os.getenv("OPENAI_MODEL_NAME") or "gpt-4o-mini"
     else:
         raise ValueError("No OpenAI configuration provided. Check your environment variables.")
+    if not backend_configs:
+        token_provider = client_args["api_key"] if callable(client_args.get("api_key")) else None
+        backends = [Backend("default", bp.openai_client, bp.openai_model_arg, token_provider=token_provider)]
+    bp.backend_pool = create_backend_pool(backends)
+    if bp.token_manager is not None:
+        # Fetch the token now rather than during the first request, and keep it fresh from then on
+        with bp.startup_report.timed("prefetch the Azure OpenAI token"):
+            await bp.token_manager.start()
+
+    if warmup_connections := get_number_env("OPENAI_HTTP_WARMUP_CONNECTIONS", 0, int):
+        with bp.startup_report.timed("warm up connections"):
+            await asyncio.gather(
+                *(warm_up(bp.http_client, str(backend.client.base_url), warmup_connections) for backend in backends)
+            )
+
+    bp.history_mode = get_history_mode()
+    bp.conversation_store = create_conversation_store()
+    bp.response_cache = create_response_cache()
+    bp.embedding_model = os.getenv("CHAT_EMBEDDING_MODEL") or "text-embedding-3-small"
+    bp.embedding_dimensions = int(os.getenv("CHAT_EMBEDDING_DIMENSIONS", "512"))
+    bp.semantic_cache = create_semantic_cache(embed_text, bp.embedding_dimensions)
+    bp.request_coalescer = create_request_coalescer()
+    # Upstream streams closed early because every client waiting on them went away
+    bp.cancelled_streams = 0
+    bp.output_tokens_saved = 0
+    bp.stream_coalescing = get_coalescing_settings()
+    bp.frame_serializer = get_frame_serializer(os.getenv("CHAT_FRAME_SERIALIZER") or "template")
+    bp.rate_limiter = create_rate_limiter()
+    bp.admission_controller = create_admission_controller()
+    bp.request_metrics = create_request_metrics()
+    if bp.request_metrics is not None:
+        register_stats(bp.request_metrics)
+
+    bp.startup_report.add("configure_openai", time.perf_counter() - configure_started)
+    bp.startup_report.finish()
 
 
 @bp.after_app_serving
 async def shutdown_openai():
-    await bp.openai_client.close()
+    if bp.token_manager is not None:
+        await bp.token_manager.close()
+    if bp.secret_provider is not None:
+        await bp.secret_provider.close()
+    if hasattr(bp, "azure_credential"):
+        await bp.azure_credential.close()
+        del bp.azure_credential
+    for backend in bp.backend_pool.backends:
+        await backend.client.close()
+    if bp.conversation_store is not None:
+        await bp.conversation_store.close()
+    if bp.rate_limiter is not None:
+        await bp.rate_limiter.backend.close()
+
+
+def create_backend(config, max_retries=openai.DEFAULT_MAX_RETRIES):
+    """Create the Backend for one of the entries of OPENAI_BACKENDS (see get_backend_configs)."""
+    client_args = {"http_client": bp.http_client, "max_retries": max_retries}
+    if config["type"] == "azure":
+        if config.get("api_key_env"):
+            client_args["api_key"] = os.environ[config["api_key_env"]]
+        else:
+            client_args["api_key"] = get_token_manager()
+        client_args["base_url"] = f"{config['endpoint'].rstrip('/')}/openai/v1/"
+        model = config["deployment"]
+    elif config["type"] == "openai":
+        client_args["api_key"] = os.environ[config.get("api_key_env") or "OPENAICOM_API_KEY"]
+        model = config["model"]
+    else:
+        client_args["api_key"] = "no-key-required"
+        client_args["base_url"] = config["endpoint"]
+        model = config.get("model") or "local-model"
+    return Backend(
+        config["name"],
+        openai.AsyncOpenAI(**client_args),
+        model,
+        weight=config.get("weight", 1),
+        token_provider=client_args["api_key"] if callable(client_args["api_key"]) else None,
+    )
+
+
+def register_stats(metrics):
+    """Export the stats of the app's components on /metrics."""
+    metrics.register("backend", bp.backend_pool.stats, label="backend")
+    for name, component in (
+        ("token", bp.token_manager),
+        ("response_cache", bp.response_cache),
+        ("semantic_cache", bp.semantic_cache),
+        ("coalescing", bp.request_coalescer),
+        ("admission", bp.admission_controller),
+        ("rate_limit", bp.rate_limiter),
+        ("principal_cache", principal_parser),
+    ):
+        if component is not None:
+            metrics.register(name, component.stats)
+    metrics.register("http_pool", lambda: pool_stats(bp.http_client))
+    metrics.register(
+        "cancelled",
+        lambda: {"streams": bp.cancelled_streams, "output_tokens_saved": bp.output_tokens_saved},
+    )
 
 
 # Extract the username for display from the base64 encoded header
 # X-MS-CLIENT-PRINCIPAL from the 'name' claim.
 #
-# Fallback to `default_username` if the header is not present.
+# Fallback to `default_username` if the header is not present or malformed.
 def extract_username(headers, default_username="You"):
-    if "X-MS-CLIENT-PRINCIPAL" not in headers:
+    principal = get_principal(headers)
+    if principal is None or not principal.name:
         return default_username
+    return principal.name
+
+
+# The key that rate limits are counted against: the signed-in user, or the client's address
+def get_rate_limit_user(headers):
+    principal = get_principal(headers)
+    if principal is not None and (principal.oid or principal.name):
+        return principal.oid or principal.name
+    return request.remote_addr or "anonymous"
+
+
+# The key that a conversation is stored under, so that only the user who started it can read or extend it
+def get_conversation_key(headers, conversation_id):
+    principal = get_principal(headers)
+    owner = principal.oid or principal.name if principal is not None else None
+    return f"{owner or 'anonymous'}:{conversation_id}"
+
 
-    token = json.loads(base64.b64decode(headers.get("X-MS-CLIENT-PRINCIPAL")))
-    claims = {claim["typ"]: claim["val"] for claim in token["claims"]}
-    return claims.get("name", default_username)
+# The index page only differs by the username, so it's rendered once, and each request fills in the username
+@bp.before_app_serving
+async def prerender_index():
+    html = await render_template("index.html", username=USERNAME_MARKER)
+    bp.index_page = PrerenderedPage(html, compress=get_page_compression())
 
 
 @bp.get("/")
 async def index():
     username = extract_username(request.headers)
-    return await render_template("index.html", username=username)
+    encoding = "gzip" if bp.index_page.compress and request.accept_encodings["gzip"] else "identity"
+    etag = bp.index_page.etag(username)
+    if encoding != "identity":
+        etag = f"{etag}-{encoding}"
+    # Browsers revalidate the page every time, as it's per user and its asset URLs change with each deployment
+    headers = {"Cache-Control": "private, no-cache", "ETag": f'"{etag}"', "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains_weak(etag):
+        return Response("", status=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    page = bp.index_page.render(username)
+    return Response(page.encodings[encoding], mimetype="text/html", headers=headers)
 
 
-@bp.post("/chat/stream")
-async def chat_handler():
-    request_messages = (await request.get_json())["messages"]
+@bp.app_context_processor
+def inject_asset_url():
+    return {"asset_url": bp.asset_manifest.url}
+
+
+@bp.get(f"{ASSETS_URL}/<path:filename>")
+async def asset(filename):
+    found = bp.asset_manifest.get(filename, request.accept_encodings)
+    if found is None:
+        abort(404)
+    built_asset, encoding = found
+    etag = built_asset.etag(encoding)
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL, "Vary": "Accept-Encoding", "ETag": f'"{etag}"'}
+    if request.if_none_match.contains_weak(etag):
+        return Response("", status=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(built_asset.encodings[encoding], mimetype=built_asset.mimetype, headers=headers)
 
-    @stream_with_context
-    async def response_stream():
-        # This sends all messages, so API request may exceed token limits
-        all_messages = [
-            {"role": "system", "content": "You are a helpful assistant."},
-        ] + request_messages
 
-        chat_coroutine = bp.openai_client.responses.create(
-            model=bp.openai_model_arg,
+async def embed_text(text):
+    response = await bp.openai_client.embeddings.create(
+        model=bp.embedding_model, input=text, dimensions=bp.embedding_dimensions
+    )
+    return response.data[0].embedding
+
+
+# Yield the text deltas of the answer to `all_messages`, then None once the answer is complete.
+# Answers are replayed from the response cache when it's enabled and has an exact match,
+# or from the semantic cache when it's enabled and has a similar enough question.
+# Otherwise they're streamed from upstream, sharing the stream with identical concurrent requests
+# when request coalescing is enabled.
+async def generate_deltas(all_messages, timings=None):
+    cache_key = response_cache_key(bp.openai_model_arg, all_messages)
+    if bp.response_cache is not None:
+        cached_response = bp.response_cache.get(cache_key)
+        if cached_response is not None:
+            async for delta in bp.response_cache.replay(cached_response):
+                yield delta
+            return
+
+    question_vector = None
+    if bp.semantic_cache is not None:
+        try:
+            question_vector = await bp.semantic_cache.embed_question(all_messages)
+        except Exception as e:
+            current_app.logger.warning("Skipping the semantic cache, embedding failed: %s", e)
+        if question_vector is not None:
+            cached_response = bp.semantic_cache.get(bp.openai_model_arg, question_vector)
+            if cached_response is not None:
+                async for delta in bp.semantic_cache.replay(cached_response):
+                    yield delta
+                return
+
+    def open_stream():
+        return stream_upstream(all_messages, cache_key, question_vector, timings)
+
+    if bp.request_coalescer is not None:
+        deltas = bp.request_coalescer.subscribe(cache_key, open_stream)
+    else:
+        deltas = open_stream()
+    async with contextlib.aclosing(deltas):
+        async for delta in deltas:
+            yield delta
+
+
+# When admission control is enabled, the request first waits for a slot under the adaptive limit,
+# and is shed with LoadShed if the upstream is already at capacity.
+# The request goes to the backend chosen by the pool. If that backend is throttled or unavailable,
+# it's ejected for a while and, as long as nothing has been streamed yet, the request fails over
+# to the next backend, so the client never sees the failure.
+async def stream_upstream(all_messages, cache_key, question_vector, timings=None):
+    ticket = None
+    if bp.admission_controller is not None:
+        ticket = await bp.admission_controller.acquire()
+    overloaded = False
+    tried = []
+    try:
+        while True:
+            backend = bp.backend_pool.choose(exclude=tried)
+            tried.append(backend)
+            streamed = False
+            try:
+                async for delta in stream_backend(backend, all_messages, cache_key, question_vector, timings):
+                    if ticket is not None and delta is not None:
+                        ticket.first_token()
+                    streamed = True
+                    yield delta
+                return
+            except UPSTREAM_OVERLOAD_ERRORS as e:
+                if streamed or len(tried) == len(bp.backend_pool):
+                    overloaded = True
+                    raise
+                current_app.logger.warning("Failing over from backend %s: %s", backend.name, e)
+    finally:
+        if ticket is not None:
+            ticket.release(overloaded=overloaded)
+
+
+# If the stream is closed before the answer is complete (the client went away),
+# the upstream response is closed right away so it stops generating tokens
+# and its connection goes back to the pool.
+# With `timings`, the token, upstream_connect, first_event and completion spans are recorded.
+async def stream_backend(backend, all_messages, cache_key, question_vector, timings=None):
+    started = time.monotonic()
+    deltas = []
+    completed = False
+    backend.requests += 1
+    backend.outstanding += 1
+    try:
+        if timings is not None and backend.token_provider is not None:
+            # The client gets the token again when it sends the request, from the provider's cache
+            await backend.token_provider()
+            timings.add("token", time.monotonic() - started)
+        connect_started = time.monotonic()
+        upstream = await backend.client.responses.create(
+            model=backend.model,
             input=all_messages,
-            max_output_tokens=1000,
+            max_output_tokens=MAX_OUTPUT_TOKENS,
             stream=True,
             store=False,
         )
+        connected = time.monotonic()
+        if timings is not None:
+            timings.add("upstream_connect", connected - connect_started)
         try:
-            async for event in await chat_coroutine:
+            async for event in upstream:
                 if event.type == "response.output_text.delta":
-                    yield json.dumps({"delta": {"content": event.delta}}, ensure_ascii=False) + "\n"
+                    if not deltas:
+                        first_token = time.monotonic()
+                        backend.record_first_token(first_token - started)
+                        if timings is not None:
+                            timings.add("first_event", first_token - connected)
+                    deltas.append(event.delta)
+                    yield event.delta
                 elif event.type == "response.completed":
-                    yield json.dumps({"delta": {"content": None}, "finish_reason": "stop"}, ensure_ascii=False) + "\n"
+                    completed = True
+                    duration = time.monotonic() - started
+                    if timings is not None and deltas:
+                        timings.add("completion", time.monotonic() - first_token)
+                    if bp.response_cache is not None:
+                        bp.response_cache.put(cache_key, deltas, duration)
+                    if question_vector is not None:
+                        bp.semantic_cache.put(bp.openai_model_arg, question_vector, deltas, duration)
+                    yield None
+        except (GeneratorExit, asyncio.CancelledError):
+            # Only a stream that its consumer closed saved tokens, not one that failed or ended early
+            if not completed:
+                bp.cancelled_streams += 1
+                # Estimated, as the answer could have ended before reaching the limit
+                bp.output_tokens_saved += max(MAX_OUTPUT_TOKENS - estimate_tokens("".join(deltas)), 0)
+            raise
+        finally:
+            if not completed:
+                await upstream.close()
+    except UPSTREAM_OVERLOAD_ERRORS:
+        bp.backend_pool.eject(backend)
+        raise
+    finally:
+        backend.outstanding -= 1
+
+
+@bp.get("/metrics")
+async def metrics():
+    if bp.request_metrics is None or not bp.request_metrics.export:
+        abort(404)
+    return Response(bp.request_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.post("/chat/stream")
+async def chat_handler():
+    timings = bp.request_metrics.start() if bp.request_metrics is not None else None
+    request_json = await request.get_json()
+    request_messages = request_json["messages"]
+
+    # In conversation mode ("conversation_id" is present in the request, null to start one),
+    # the server keeps the history and the client only sends the new messages.
+    conversation_id = None
+    if bp.conversation_store is None:
+        if request_json.get("conversation_id"):
+            # Answering without the history would silently lose the rest of the conversation
+            abort(400, "Conversations aren't stored, send the whole transcript")
+    elif "conversation_id" in request_json:
+        conversation_id = request_json["conversation_id"] or new_conversation_id()
+        conversation_key = get_conversation_key(request.headers, conversation_id)
+        if request_json["conversation_id"]:
+            # Conversations of other users aren't found either
+            stored_messages = await bp.conversation_store.get(conversation_key)
+            if stored_messages is None:
+                abort(404, "Conversation not found")
+            request_messages = stored_messages + request_messages
+
+    # Only send the newest messages that fit in the model's input budget,
+    # so that long conversations don't get slower and more expensive every turn
+    history = trim_history(
+        {"role": "system", "content": "You are a helpful assistant."},
+        request_messages,
+        budget=get_token_budget(bp.openai_model_arg),
+        mode=bp.history_mode,
+    )
+    if history.dropped_messages:
+        current_app.logger.info(
+            "Trimmed %d messages (%d tokens) from the conversation history",
+            history.dropped_messages,
+            history.dropped_tokens,
+        )
+    all_messages = history.messages
+    if timings is not None:
+        timings.since_start("request_parse")
+
+    # Refuse requests over the rate limits right away, rather than queueing them.
+    # The maximum output is reserved up front, and what isn't used is given back at the end.
+    lease = None
+    if bp.rate_limiter is not None:
+        try:
+            lease = await bp.rate_limiter.acquire(
+                get_rate_limit_user(request.headers), history.input_tokens + MAX_OUTPUT_TOKENS
+            )
+        except RateLimitExceeded as e:
+            if timings is not None:
+                timings.finish("rate_limited")
+            return {"error": str(e)}, 429, {"Retry-After": str(e.retry_after)}
+
+    frames = bp.frame_serializer
+
+    @stream_with_context
+    async def response_stream():
+        answer = []
+        # Until the answer completes or fails, the client went away
+        outcome = "cancelled"
+        try:
+            async with contextlib.aclosing(generate_deltas(all_messages, timings)) as deltas:
+                async for delta in deltas:
+                    if delta is not None:
+                        answer.append(delta)
+                        frame = frames.delta(delta)
+                        if timings is not None:
+                            timings.token()
+                            timings.written(frame)
+                        yield frame
+                    else:
+                        if conversation_id:
+                            # Only the messages that were sent upstream are kept, so the stored conversation
+                            # (and the work of loading and saving it every turn) stays within the token budget
+                            await bp.conversation_store.set(
+                                conversation_key,
+                                history.messages[1:] + [{"role": "assistant", "content": "".join(answer)}],
+                            )
+                        outcome = "completed"
+                        frame = frames.finish()
+                        if timings is not None:
+                            timings.written(frame)
+                        yield frame
         except Exception as e:
             current_app.logger.error(e)
-            yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+            outcome = "error"
+            frame = frames.error(str(e))
+            if timings is not None:
+                timings.written(frame)
+            yield frame
+        finally:
+            if timings is not None:
+                timings.finish(outcome)
+            if lease is not None:
+                await lease.release(unused_tokens=MAX_OUTPUT_TOKENS - estimate_tokens("".join(answer)))
 
-    return Response(response_stream())
+    headers = {
+        "X-History-Input-Tokens": str(history.input_tokens),
+        "X-History-Dropped-Tokens": str(history.dropped_tokens),
+    }
+    if conversation_id:
+        headers["X-Conversation-Id"] = conversation_id
+    body = response_stream()
+    if bp.stream_coalescing:
+        max_bytes, max_delay = bp.stream_coalescing
+        body = coalesce_frames(body, max_bytes=max_bytes, max_delay=max_delay)
+    if lease is not None:
+        body = LeasedBody(body, lease)
+    return Response(body, headers=headers)
@@ -0,0 +1,93 @@
+import asyncio
+
+from .settings import get_bool_env
+
+
+class Flight:
+    """One upstream stream, shared by every request that asked the same thing while it was running."""
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.changed = asyncio.Condition()
+
+
+class RequestCoalescer:
+    """Single-flight de-duplication of identical concurrent streams.
+
+    The first request for a key starts the upstream stream in a background task,
+    and later requests for the same key attach to it while it's running.
+    Items are kept in a shared list that each subscriber reads at its own pace,
+    so a slow subscriber never holds back the upstream stream or the others,
+    and a subscriber going away doesn't affect the others.
+    The upstream stream is cancelled once all of its subscribers have gone away.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def _run(self, key, flight, open_stream):
+        try:
+            async for item in open_stream():
+                async with flight.changed:
+                    flight.items.append(item)
+                    flight.changed.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            async with flight.changed:
+                flight.done = True
+                flight.changed.notify_all()
+
+    async def subscribe(self, key, open_stream):
+        """Yield the items of the stream returned by `open_stream()`, sharing it with concurrent subscribers."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, open_stream))
+            self.leaders += 1
+        else:
+            self.followers += 1
+
+        flight.subscribers += 1
+        position = 0
+        try:
+            while True:
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: flight.done or position < len(flight.items))
+                    items = flight.items[position:]
+                    done = flight.done
+                for item in items:
+                    yield item
+                position += len(items)
+                if done and position == len(flight.items):
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is waiting for this stream anymore, so stop it rather than pay for the rest
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+    def stats(self):
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "followers": self.followers}
+
+
+def create_request_coalescer():
+    """Create the request coalescer if CHAT_REQUEST_COALESCING_ENABLED is set, otherwise return None."""
+    if not get_bool_env("CHAT_REQUEST_COALESCING_ENABLED"):
+        return None
+    return RequestCoalescer()
@@ -0,0 +1,101 @@
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+
+def new_conversation_id():
+    return uuid.uuid4().hex
+
+
+class MemoryConversationStore:
+    """In-process conversation store with LRU and TTL eviction.
+
+    Each worker process has its own store, so with several workers a conversation
+    is only found if the request lands on the worker that created it.
+    Clients are expected to fall back to re-sending the full transcript when
+    a conversation is not found. Use an external store to share conversations.
+    """
+
+    def __init__(self, maxsize=1000, ttl=3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._conversations = OrderedDict()
+
+    def __len__(self):
+        return len(self._conversations)
+
+    async def get(self, conversation_id):
+        entry = self._conversations.get(conversation_id)
+        if entry is None:
+            return None
+        expires_at, messages = entry
+        if expires_at <= self.clock():
+            del self._conversations[conversation_id]
+            return None
+        self._conversations.move_to_end(conversation_id)
+        return list(messages)
+
+    async def set(self, conversation_id, messages):
+        self._conversations[conversation_id] = (self.clock() + self.ttl, list(messages))
+        self._conversations.move_to_end(conversation_id)
+        while len(self._conversations) > self.maxsize:
+            self._conversations.popitem(last=False)
+
+    async def close(self):
+        self._conversations.clear()
+
+
+class KeyValueConversationStore:
+    """Conversation store backed by an external key-value service.
+
+    `client` only needs async `get(key)` and `set(key, value, ex=seconds)` methods,
+    which matches `redis.asyncio.Redis`, so conversations are shared by all workers.
+    """
+
+    def __init__(self, client, ttl=3600, prefix="conversation:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get(self, conversation_id):
+        value = await self.client.get(self.prefix + conversation_id)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def set(self, conversation_id, messages):
+        await self.client.set(self.prefix + conversation_id, json.dumps(messages, ensure_ascii=False), ex=self.ttl)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def get_conversation_store_type():
+    """Return CHAT_CONVERSATION_STORE ("memory", "redis" or "none").
+
+    It defaults to "redis" when REDIS_URL is set and to "none" otherwise, as the memory store
+    only finds a conversation again when the same worker answers every turn of it.
+    """
+    default = "redis" if os.getenv("REDIS_URL") else "none"
+    return os.getenv("CHAT_CONVERSATION_STORE", "").strip().lower() or default
+
+
+def create_conversation_store():
+    """Create the conversation store selected by CHAT_CONVERSATION_STORE, or return None for "none"."""
+    store_type = get_conversation_store_type()
+    ttl = int(os.getenv("CHAT_CONVERSATION_TTL", "3600"))
+    if store_type == "none":
+        return None
+    elif store_type == "memory":
+        return MemoryConversationStore(maxsize=int(os.getenv("CHAT_CONVERSATION_MAX_COUNT", "1000")), ttl=ttl)
+    elif store_type == "redis":
+        if not os.getenv("REDIS_URL"):
+            raise ValueError("REDIS_URL is required when CHAT_CONVERSATION_STORE is redis")
+        # redis is only needed for this store, so it isn't a dependency of the app
+        import redis.asyncio
+
+        return KeyValueConversationStore(redis.asyncio.Redis.from_url(os.getenv("REDIS_URL")), ttl=ttl)
+    raise ValueError(f"Unknown CHAT_CONVERSATION_STORE: {store_type}")
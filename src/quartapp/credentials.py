@@ -0,0 +1,253 @@
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import time
+
+from azure.core.exceptions import ClientAuthenticationError
+
+logger = logging.getLogger(__name__)
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# Credential sources that AZURE_CREDENTIAL_CHAIN can list, by the azure.identity.aio class they use
+CREDENTIAL_SOURCES = {
+    "environment": "EnvironmentCredential",
+    "workload_identity": "WorkloadIdentityCredential",
+    "managed_identity": "ManagedIdentityCredential",
+    "azure_cli": "AzureCliCredential",
+    "azure_developer_cli": "AzureDeveloperCliCredential",
+    "azure_powershell": "AzurePowerShellCredential",
+    "default": "DefaultAzureCredential",
+}
+SOURCE_NAMES = {class_name: name for name, class_name in CREDENTIAL_SOURCES.items()}
+
+# The settings of the sources that also use AZURE_CLIENT_ID: a service principal (with a secret, a certificate
+# or a username) through EnvironmentCredential, and workload identity
+OTHER_CLIENT_ID_SETTINGS = (
+    "AZURE_CLIENT_SECRET",
+    "AZURE_CLIENT_CERTIFICATE_PATH",
+    "AZURE_USERNAME",
+    "AZURE_FEDERATED_TOKEN_FILE",
+)
+
+# A token this close to its expiry isn't handed out anymore, as it could expire on the way
+EXPIRY_SKEW = 30
+# Minimum time between background refreshes, including retries after a failed one
+MIN_REFRESH_DELAY = 5
+
+
+class BearerTokenManager:
+    """Keeps a bearer token for `scope` fresh, so requests don't wait for the credential.
+
+    The token is fetched before the app starts serving, then refreshed in the background
+    `refresh_margin` seconds before it expires, minus a random jitter of up to `jitter` seconds
+    so that workers started together don't all refresh at the same moment. Requests only
+    fetch a token themselves if there's no usable one (like when refreshing keeps failing),
+    and concurrent requests then share a single fetch.
+
+    An instance can be passed as the `api_key` of an AsyncOpenAI client, like the provider
+    returned by azure.identity.aio.get_bearer_token_provider.
+    """
+
+    def __init__(self, credential, scope=COGNITIVE_SERVICES_SCOPE, refresh_margin=300, jitter=60, clock=time.time):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.jitter = jitter
+        self.clock = clock
+        self.access_token = None
+        self.fetched_at = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.last_refresh_duration = None
+        self.total_refresh_duration = 0.0
+        self._fetch_task = None
+        self._refresh_task = None
+
+    async def __call__(self):
+        return await self.get_token()
+
+    async def get_token(self):
+        if self.access_token is None or self.clock() >= self.access_token.expires_on - EXPIRY_SKEW:
+            await self.refresh()
+        return self.access_token.token
+
+    async def refresh(self):
+        """Fetch a new token, sharing the fetch with any other caller that's already waiting for one."""
+        if self._fetch_task is None:
+            self._fetch_task = asyncio.create_task(self._fetch())
+        # Shielded, so a request that goes away doesn't cancel the fetch the others are waiting for
+        await asyncio.shield(self._fetch_task)
+
+    async def _fetch(self):
+        started = time.monotonic()
+        try:
+            access_token = await self.credential.get_token(self.scope)
+        except Exception:
+            self.refresh_failures += 1
+            raise
+        finally:
+            self._fetch_task = None
+        self.last_refresh_duration = time.monotonic() - started
+        self.total_refresh_duration += self.last_refresh_duration
+        self.refreshes += 1
+        self.access_token = access_token
+        self.fetched_at = self.clock()
+
+    async def start(self):
+        """Prefetch the token, and start refreshing it in the background.
+
+        If the prefetch fails, the app still starts, and the token is fetched again
+        in the background (or by the first request that needs it).
+        """
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning("Could not prefetch a token for %s: %s", self.scope, e)
+        self._refresh_task = asyncio.create_task(self._refresh_in_background())
+
+    def next_refresh_delay(self):
+        if self.access_token is None:
+            return MIN_REFRESH_DELAY
+        refresh_at = self.access_token.expires_on - self.refresh_margin - random.uniform(0, self.jitter)
+        return max(refresh_at - self.clock(), MIN_REFRESH_DELAY)
+
+    async def _refresh_in_background(self):
+        while True:
+            await asyncio.sleep(self.next_refresh_delay())
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Could not refresh the token for %s: %s", self.scope, e)
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+            self._refresh_task = None
+
+    def stats(self):
+        now = self.clock()
+        return {
+            "token_age_seconds": round(now - self.fetched_at, 1) if self.fetched_at is not None else None,
+            "expires_in_seconds": (
+                round(self.access_token.expires_on - now, 1) if self.access_token is not None else None
+            ),
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "last_refresh_seconds": (
+                round(self.last_refresh_duration, 3) if self.last_refresh_duration is not None else None
+            ),
+            "avg_refresh_seconds": round(self.total_refresh_duration / self.refreshes, 3) if self.refreshes else None,
+        }
+
+
+class ProbedCredentialChain:
+    """Tries credential sources in order, timing each probe, and sticks to the first one that works.
+
+    Later tokens come straight from that source. If it stops working,
+    the whole chain is probed again.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.selected = None
+        self.probes = []
+
+    async def get_token(self, *scopes, **kwargs):
+        if self.selected is not None:
+            name, credential = self.selected
+            try:
+                return await credential.get_token(*scopes, **kwargs)
+            except Exception as e:
+                logger.warning("Credential source %s stopped working, probing the chain again: %s", name, e)
+                self.selected = None
+        errors = []
+        for name, credential in self.sources:
+            started = time.monotonic()
+            try:
+                access_token = await credential.get_token(*scopes, **kwargs)
+            except Exception as e:
+                duration = time.monotonic() - started
+                self.probes.append({"source": name, "seconds": round(duration, 3), "succeeded": False})
+                logger.info("Credential source %s failed in %.3f seconds: %s", name, duration, e)
+                errors.append(f"{name}: {e}")
+                continue
+            duration = time.monotonic() - started
+            self.probes.append({"source": name, "seconds": round(duration, 3), "succeeded": True})
+            logger.info("Credential source %s succeeded in %.3f seconds", name, duration)
+            self.selected = (name, credential)
+            return access_token
+        raise ClientAuthenticationError(f"No credential source could get a token. {'; '.join(errors)}")
+
+    async def close(self):
+        for _, credential in self.sources:
+            await credential.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def stats(self):
+        return {"selected": self.selected[0] if self.selected else None, "probes": self.probes}
+
+
+def get_credential_chain():
+    """Return the names of the credential sources to try, in order.
+
+    AZURE_CREDENTIAL_CHAIN lists them explicitly (like "managed_identity,azure_cli").
+    Otherwise, managed identity is pinned when AZURE_CLIENT_ID is set (as on Container Apps)
+    without the settings of another source that uses it, and the sources of DefaultAzureCredential
+    are tried when it isn't.
+    """
+    value = os.getenv("AZURE_CREDENTIAL_CHAIN", "").strip()
+    if value:
+        names = [name.strip().lower() for name in value.split(",") if name.strip()]
+        for name in names:
+            if name not in CREDENTIAL_SOURCES:
+                raise ValueError(
+                    f"Unknown credential source {name!r} in AZURE_CREDENTIAL_CHAIN, "
+                    f"expected some of {', '.join(CREDENTIAL_SOURCES)}"
+                )
+        return names
+    if os.getenv("AZURE_CLIENT_ID") and not any(os.getenv(name) for name in OTHER_CLIENT_ID_SETTINGS):
+        return ["managed_identity"]
+    return ["default"]
+
+
+def create_azure_credential():
+    """Create the credential for the sources in get_credential_chain()."""
+    # Only imported when a credential is needed, as it's slow to import and most key-based setups don't
+    import azure.identity.aio
+
+    sources = []
+    for name in get_credential_chain():
+        credential_class = getattr(azure.identity.aio, CREDENTIAL_SOURCES[name])
+        if name == "managed_identity":
+            credential = credential_class(client_id=os.getenv("AZURE_CLIENT_ID"))
+        elif name == "default":
+            # Its sources are probed one by one, rather than all at once by its get_token, so each one is timed
+            default = credential_class(exclude_shared_token_cache_credential=True)
+            for credential in default.credentials:
+                class_name = type(credential).__name__
+                sources.append((SOURCE_NAMES.get(class_name, class_name), credential))
+            continue
+        else:
+            credential = credential_class()
+        sources.append((name, credential))
+    return ProbedCredentialChain(sources)
+
+
+def create_token_manager(credential):
+    """Create the token manager for Azure OpenAI, with the AZURE_TOKEN_REFRESH_* settings."""
+    return BearerTokenManager(
+        credential,
+        COGNITIVE_SERVICES_SCOPE,
+        refresh_margin=float(os.getenv("AZURE_TOKEN_REFRESH_MARGIN", "300")),
+        jitter=float(os.getenv("AZURE_TOKEN_REFRESH_JITTER", "60")),
+    )
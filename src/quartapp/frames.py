@@ -0,0 +1,81 @@
+import json
+from json.encoder import encode_basestring
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The frames streamed by /chat/stream, one JSON object per line:
+#   {"delta": {"content": "..."}}                         for each piece of the answer
+#   {"delta": {"content": null}, "finish_reason": "stop"}  once the answer is complete
+#   {"error": "..."}                                       if the answer failed
+# Every serializer produces exactly the same text as json.dumps(..., ensure_ascii=False).
+
+
+class StdlibFrames:
+    """Serializes every frame with json.dumps."""
+
+    name = "stdlib"
+
+    @staticmethod
+    def delta(content):
+        return json.dumps({"delta": {"content": content}}, ensure_ascii=False) + "\n"
+
+    @staticmethod
+    def finish():
+        return json.dumps({"delta": {"content": None}, "finish_reason": "stop"}, ensure_ascii=False) + "\n"
+
+    @staticmethod
+    def error(message):
+        return json.dumps({"error": message}, ensure_ascii=False) + "\n"
+
+
+class TemplateFrames:
+    """Fills fixed frame templates, only escaping the strings.
+
+    encode_basestring is the (C-accelerated) function json.dumps uses for strings
+    when ensure_ascii=False, so the output is byte-identical to StdlibFrames without
+    building a dict and going through the encoder for every delta.
+    """
+
+    name = "template"
+    FINISH = StdlibFrames.finish()
+
+    @staticmethod
+    def delta(content):
+        return '{"delta": {"content": ' + encode_basestring(content) + "}}\n"
+
+    @classmethod
+    def finish(cls):
+        return cls.FINISH
+
+    @staticmethod
+    def error(message):
+        return '{"error": ' + encode_basestring(message) + "}\n"
+
+
+class OrjsonFrames(TemplateFrames):
+    """Fills the frame templates with strings escaped by orjson, which escapes them like json.dumps."""
+
+    name = "orjson"
+
+    @staticmethod
+    def delta(content):
+        try:
+            return '{"delta": {"content": ' + orjson.dumps(content).decode() + "}}\n"
+        except orjson.JSONEncodeError:
+            # orjson rejects strings that aren't valid UTF-8, like lone surrogates
+            return TemplateFrames.delta(content)
+
+
+FRAME_SERIALIZERS = {serializer.name: serializer for serializer in (StdlibFrames, TemplateFrames, OrjsonFrames)}
+
+
+def get_frame_serializer(name="template"):
+    """Return the frame serializer called `name` ("template", "stdlib" or "orjson")."""
+    if name not in FRAME_SERIALIZERS:
+        raise ValueError(f"Unknown frame serializer {name!r}, expected one of {', '.join(FRAME_SERIALIZERS)}")
+    if name == "orjson" and orjson is None:
+        raise ValueError("The orjson frame serializer requires the orjson package")
+    return FRAME_SERIALIZERS[name]
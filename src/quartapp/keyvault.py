@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+
+
+def is_private(status):
+    """Return whether the file with this os.stat() result belongs to the app's user, and only it can access it."""
+    if not hasattr(os, "getuid"):  # Windows
+        return True
+    return status.st_uid == os.getuid() and not status.st_mode & 0o077
+
+
+class KeyVaultSecretProvider:
+    """Provides a Key Vault secret, fetched once for every worker on the machine and refreshed for rotation.
+
+    With a `cache_path`, the secret is kept in that file, only readable by the app's user, for
+    `refresh_interval` seconds (a file that another user owns or can access is ignored). A worker that finds the file fresh uses it, and otherwise
+    fetches the secret while holding a lock on the file, so that the workers started
+    together (by a rollout, or by max_requests recycling) only call Key Vault once.
+    Each worker re-reads the secret every `refresh_interval` seconds (with some jitter)
+    in the background, so a rotated secret is picked up without restarting.
+    Without a `cache_path`, each worker fetches the secret itself.
+
+    An instance can be passed as the `api_key` of an AsyncOpenAI client,
+    which then asks it for the current secret before each request.
+    """
+
+    def __init__(self, vault_url, secret_name, credential, cache_path=None, refresh_interval=300, clock=time.time):
+        self.vault_url = vault_url
+        self.secret_name = secret_name
+        self.credential = credential
+        self.cache_path = cache_path
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.value = None
+        self.fetches = 0
+        self.cache_reads = 0
+        self.refresh_failures = 0
+        self._refresh_task = None
+
+    async def __call__(self):
+        if self.value is None:
+            await self.load()
+        return self.value
+
+    async def _fetch(self):
+        # Only imported when a secret is needed, like the credential
+        from azure.keyvault.secrets.aio import SecretClient
+
+        async with SecretClient(vault_url=self.vault_url, credential=self.credential) as key_vault_client:
+            secret = await key_vault_client.get_secret(self.secret_name)
+        self.fetches += 1
+        return secret.value
+
+    def _read_cache(self):
+        """Return the cached secret if the cache file is fresh and only the app's user can access it, otherwise None."""
+        try:
+            # Not following symlinks, so the file can't be swapped for a link to another one
+            with open(os.open(self.cache_path, os.O_RDONLY | O_NOFOLLOW)) as cache_file:
+                if not is_private(os.fstat(cache_file.fileno())):
+                    logger.warning("Ignoring %s, as another user owns it or can access it", self.cache_path)
+                    return None
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or self.clock() - cached.get("fetched_at", 0) >= self.refresh_interval:
+            return None
+        return cached.get("value")
+
+    def _write_cache(self, value):
+        # Written to a temporary file and renamed, so other workers never read half of it
+        directory = os.path.dirname(self.cache_path) or "."
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=".secret-")
+        try:
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump({"value": value, "fetched_at": self.clock()}, cache_file)
+            os.replace(temporary_path, self.cache_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temporary_path)
+            raise
+
+    async def load(self):
+        """Load the current secret, from the cache file if it's fresh, otherwise from Key Vault."""
+        if self.cache_path is None:
+            self.value = await self._fetch()
+            return
+        value = self._read_cache()
+        if value is None:
+            lock_fd = os.open(self.cache_path + ".lock", os.O_RDWR | os.O_CREAT | O_NOFOLLOW, 0o600)
+            try:
+                if fcntl is not None:
+                    await asyncio.to_thread(fcntl.flock, lock_fd, fcntl.LOCK_EX)
+                # Another worker may have fetched it while this one waited for the lock
+                value = self._read_cache()
+                if value is None:
+                    value = await self._fetch()
+                    self._write_cache(value)
+                    self.value = value
+                    return
+            finally:
+                os.close(lock_fd)
+        self.cache_reads += 1
+        self.value = value
+
+    async def start(self):
+        """Load the secret, and start re-reading it in the background."""
+        await self.load()
+        self._refresh_task = asyncio.create_task(self._refresh_in_background())
+
+    async def _refresh_in_background(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval * random.uniform(1, 1.1))
+            try:
+                await self.load()
+            except Exception as e:
+                # The previous secret is kept, it's most likely still valid
+                self.refresh_failures += 1
+                logger.warning("Could not refresh the %s secret: %s", self.secret_name, e)
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresh_task
+            self._refresh_task = None
+
+    def stats(self):
+        return {"fetches": self.fetches, "cache_reads": self.cache_reads, "refresh_failures": self.refresh_failures}
+
+
+def get_secret_cache_path():
+    """Return the KEY_VAULT_SECRET_CACHE_FILE setting, or None if it isn't set, so that each worker fetches the secret.
+
+    The cache is opt-in, as the file holds the secret in plain text: it should be in a directory
+    that only the app's user can write to, rather than a shared one like /tmp.
+    """
+    value = os.getenv("KEY_VAULT_SECRET_CACHE_FILE", "").strip()
+    if not value or value.lower() == "none":
+        return None
+    return value
+
+
+def create_secret_provider(key_vault_name, secret_name, credential):
+    vault_url = f"https://{key_vault_name}.vault.azure.net"
+    return KeyVaultSecretProvider(
+        vault_url,
+        secret_name,
+        credential,
+        cache_path=get_secret_cache_path(),
+        refresh_interval=float(os.getenv("KEY_VAULT_SECRET_REFRESH_INTERVAL", "300")),
+    )
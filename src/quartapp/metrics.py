@@ -0,0 +1,240 @@
+import bisect
+import json
+import logging
+import math
+import os
+import time
+
+from .settings import get_bool_env
+
+timings_logger = logging.getLogger("quartapp.timings")
+
+# Spans of a chat request, in the order they happen:
+#   request_parse          reading the request, its stored conversation and trimming its history
+#   token                  getting the upstream's bearer token or key (usually cached)
+#   upstream_connect       sending the upstream request, until its response headers arrive
+#   first_event            from the response headers to the first text delta
+#   time_to_first_token    from the start of the request to its first delta, as the client sees it
+#   completion             from the first delta to the upstream's completed event
+#   total                  the whole request, until its last frame is written
+SPANS = ("request_parse", "token", "upstream_connect", "first_event", "time_to_first_token", "completion", "total")
+
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+INTER_TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """A Prometheus histogram, with a series for each combination of label values."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=SPAN_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # Label values -> [count in each bucket (not cumulative, the last one is +Inf), sum]
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        self.observe_many((value,), *labelvalues)
+
+    def observe_many(self, values, *labelvalues):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts, buckets = series[0], self.buckets
+        for value in values:
+            counts[bisect.bisect_left(buckets, value)] += 1
+        series[1] += sum(values)
+
+    def collect(self, extra=()):
+        """Return the exposition lines, with the `extra` (name, value) labels on every series."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, [*extra, ("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues, extra)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    """A Prometheus counter, with a series for each combination of label values."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._series = {}
+
+    def inc(self, amount=1, *labelvalues):
+        self._series[labelvalues] = self._series.get(labelvalues, 0) + amount
+
+    def collect(self, extra=()):
+        """Return the exposition lines, with the `extra` (name, value) labels on every series."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in sorted(self._series.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues, extra)} {_format_value(value)}")
+        return lines
+
+
+class RequestMetrics:
+    """Times the spans of chat requests, for /metrics and, when enabled, a JSON log line per request.
+
+    Metrics are kept in each worker's memory, so with several gunicorn workers, each scrape
+    of /metrics only sees the worker that answered it. Every series has a pid label, so each
+    worker's counters and histograms are separate series that never seem to reset or jump,
+    and rate() or histogram_quantile() work on them before summing over the pids.
+    The stats of the app's other components are exported as gauges, read at each scrape.
+    """
+
+    def __init__(self, export=True, log_timings=False, clock=time.perf_counter):
+        self.export = export
+        self.log_timings = log_timings
+        self.clock = clock
+        self.spans = Histogram("chat_span_seconds", "Duration of each span of chat requests", ("span",))
+        self.inter_token = Histogram(
+            "chat_inter_token_seconds", "Time between the deltas written to clients", buckets=INTER_TOKEN_BUCKETS
+        )
+        self.requests = Counter("chat_requests_total", "Chat requests by outcome", ("outcome",))
+        self.response_bytes = Counter("chat_response_bytes_total", "Bytes of NDJSON frames written to clients")
+        self._collectors = []
+
+    def start(self):
+        return RequestTimings(self)
+
+    def register(self, name, stats, label=None):
+        """Export the numbers that stats() returns as chat_<name>_<key> gauges.
+
+        With a label, stats() returns a dict of stats for each value of the label, like each backend.
+        """
+        self._collectors.append((name, stats, label))
+
+    def _collect_stats(self, extra):
+        lines = []
+        for name, stats, label in self._collectors:
+            results = stats()
+            series = results.items() if label else [(None, results)]
+            gauges = {}
+            for labelvalue, values in series:
+                for key, value in values.items():
+                    if isinstance(value, bool):
+                        value = int(value)
+                    if not isinstance(value, (int, float)):
+                        continue
+                    labels = _format_labels((label,) if label else (), (labelvalue,) if label else (), extra)
+                    gauges.setdefault(f"chat_{name}_{key}", []).append(f"{labels} {_format_value(value)}")
+            for gauge, samples in gauges.items():
+                lines.append(f"# TYPE {gauge} gauge")
+                lines.extend(gauge + sample for sample in samples)
+        return lines
+
+    def render(self):
+        extra = [("pid", os.getpid())]
+        lines = [
+            "# HELP chat_worker_info The worker that answered this scrape",
+            "# TYPE chat_worker_info gauge",
+            f"chat_worker_info{_format_labels((), (), extra)} 1",
+        ]
+        for metric in (self.spans, self.inter_token, self.requests, self.response_bytes):
+            lines.extend(metric.collect(extra))
+        lines.extend(self._collect_stats(extra))
+        return "\n".join(lines) + "\n"
+
+
+class RequestTimings:
+    """The spans of one chat request, recorded into its RequestMetrics when the request finishes."""
+
+    __slots__ = ("metrics", "clock", "started", "spans", "last_token", "gaps", "bytes", "finished")
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.clock = metrics.clock
+        self.started = self.clock()
+        self.spans = {}
+        self.last_token = None
+        # The time between each delta and the next, added to the histogram when the request finishes,
+        # to keep the work done for each delta to a minimum
+        self.gaps = []
+        self.bytes = 0
+        self.finished = False
+
+    def add(self, span, seconds):
+        self.spans[span] = seconds
+
+    def since_start(self, span):
+        self.spans[span] = self.clock() - self.started
+
+    @property
+    def tokens(self):
+        return len(self.gaps) + 1 if self.last_token is not None else 0
+
+    def token(self):
+        """Record that a delta was written to the client."""
+        now = self.clock()
+        if self.last_token is None:
+            self.spans["time_to_first_token"] = now - self.started
+        else:
+            self.gaps.append(now - self.last_token)
+        self.last_token = now
+
+    def written(self, frame):
+        # str.isascii() is O(1), so only frames with non-ASCII text are encoded to count their bytes
+        self.bytes += len(frame) if frame.isascii() else len(frame.encode())
+
+    def finish(self, outcome):
+        if self.finished:
+            return
+        self.finished = True
+        self.since_start("total")
+        metrics = self.metrics
+        if metrics.export:
+            for span, seconds in self.spans.items():
+                metrics.spans.observe(seconds, span)
+            if self.gaps:
+                metrics.inter_token.observe_many(self.gaps)
+            metrics.requests.inc(1, outcome)
+            metrics.response_bytes.inc(self.bytes)
+        if metrics.log_timings:
+            record = {"event": "chat_request", "outcome": outcome, "tokens": self.tokens, "bytes": self.bytes}
+            for span in SPANS:
+                if span in self.spans:
+                    record[f"{span}_ms"] = round(self.spans[span] * 1000, 2)
+            if self.gaps:
+                record["max_inter_token_ms"] = round(max(self.gaps) * 1000, 2)
+            timings_logger.info(json.dumps(record))
+
+
+def create_request_metrics():
+    """Create the request metrics if CHAT_METRICS_ENABLED or CHAT_TIMING_LOGS is set, otherwise return None.
+
+    CHAT_METRICS_ENABLED exports them on /metrics, and CHAT_TIMING_LOGS logs a JSON line per request.
+    """
+    export = get_bool_env("CHAT_METRICS_ENABLED")
+    log_timings = get_bool_env("CHAT_TIMING_LOGS")
+    if not export and not log_timings:
+        return None
+    if log_timings:
+        # The app only logs warnings in production, but these lines are the point of the setting
+        timings_logger.setLevel(logging.INFO)
+    return RequestMetrics(export=export, log_timings=log_timings)
@@ -0,0 +1,57 @@
+import gzip
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from markupsafe import escape
+
+from .settings import get_bool_env
+
+# Rendered in place of the username, to find where each page's username goes
+USERNAME_MARKER = "username-4f1c9e2b7d3a"
+
+
+@dataclass
+class RenderedPage:
+    etag: str
+    # The page in each encoding, "identity" for the uncompressed page
+    encodings: dict
+
+
+class PrerenderedPage:
+    """A page rendered once, split around its username, so that serving it only fills in the username.
+
+    Pages are kept for the most recent users (with their compressed copy when compression
+    is enabled), and their ETag only depends on the rendered page and the username,
+    so a conditional request can be answered without filling anything in.
+    """
+
+    def __init__(self, html, compress=False, maxsize=1000):
+        self.parts = html.split(USERNAME_MARKER)
+        self.version = hashlib.sha256(html.encode()).hexdigest()[:12]
+        self.compress = compress
+        self.maxsize = maxsize
+        self._pages = OrderedDict()
+
+    def etag(self, username):
+        return f"{self.version}-{hashlib.sha256(username.encode()).hexdigest()[:16]}"
+
+    def render(self, username):
+        page = self._pages.get(username)
+        if page is not None:
+            self._pages.move_to_end(username)
+            return page
+        body = str(escape(username)).join(self.parts).encode()
+        encodings = {"identity": body}
+        if self.compress:
+            encodings["gzip"] = gzip.compress(body, compresslevel=6, mtime=0)
+        page = RenderedPage(etag=self.etag(username), encodings=encodings)
+        self._pages[username] = page
+        if len(self._pages) > self.maxsize:
+            self._pages.popitem(last=False)
+        return page
+
+
+def get_page_compression():
+    """Return whether to gzip pages for clients that accept it, from INDEX_PAGE_COMPRESSION."""
+    return get_bool_env("INDEX_PAGE_COMPRESSION")
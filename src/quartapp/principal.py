@@ -0,0 +1,110 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PRINCIPAL_HEADER = "X-MS-CLIENT-PRINCIPAL"
+
+# Claim types used when the principal doesn't say which ones hold the name and the roles
+DEFAULT_NAME_CLAIM = "name"
+DEFAULT_ROLE_CLAIM = "roles"
+OID_CLAIMS = ("http://schemas.microsoft.com/identity/claims/objectidentifier", "oid")
+
+# Cached result for headers that couldn't be parsed, so they aren't parsed again either
+_INVALID = object()
+
+
+class Principal:
+    """The signed-in user, as described by the X-MS-CLIENT-PRINCIPAL header that Container Apps authentication adds."""
+
+    __slots__ = ("name", "oid", "roles")
+
+    def __init__(self, name=None, oid=None, roles=()):
+        self.name = name
+        self.oid = oid
+        self.roles = tuple(roles)
+
+    def __eq__(self, other):
+        if not isinstance(other, Principal):
+            return NotImplemented
+        return (self.name, self.oid, self.roles) == (other.name, other.oid, other.roles)
+
+    def __hash__(self):
+        return hash((self.name, self.oid, self.roles))
+
+    def __repr__(self):
+        return f"Principal(name={self.name!r}, oid={self.oid!r}, roles={self.roles!r})"
+
+    @classmethod
+    def from_header(cls, header):
+        """Decode a base64-encoded X-MS-CLIENT-PRINCIPAL header. Raises ValueError if it's malformed."""
+        try:
+            token = json.loads(base64.b64decode(header, validate=True))
+            claims = token["claims"]
+            name_claim = token.get("name_typ") or DEFAULT_NAME_CLAIM
+            role_claim = token.get("role_typ") or DEFAULT_ROLE_CLAIM
+            name = oid = None
+            roles = []
+            for claim in claims:
+                claim_type, value = claim["typ"], claim["val"]
+                if claim_type == DEFAULT_NAME_CLAIM or (claim_type == name_claim and name is None):
+                    name = value
+                elif claim_type in OID_CLAIMS:
+                    oid = value
+                if claim_type in (role_claim, DEFAULT_ROLE_CLAIM):
+                    roles.append(value)
+        except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError, TypeError, KeyError, AttributeError) as e:
+            raise ValueError(f"Malformed {PRINCIPAL_HEADER} header: {e!r}") from e
+        return cls(name=name, oid=oid, roles=roles)
+
+
+class PrincipalParser:
+    """Parses X-MS-CLIENT-PRINCIPAL headers, with a bounded LRU cache keyed by a digest of the header.
+
+    The same user sends the same header with every request, so it only needs
+    to be decoded once. Malformed headers are logged and parsed as None.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._principals = OrderedDict()
+
+    def __len__(self):
+        return len(self._principals)
+
+    def parse(self, header):
+        if not header:
+            return None
+        key = hashlib.blake2b(header.encode(), digest_size=16).digest()
+        principal = self._principals.get(key)
+        if principal is not None:
+            self.hits += 1
+            self._principals.move_to_end(key)
+        else:
+            self.misses += 1
+            try:
+                principal = Principal.from_header(header)
+            except ValueError as e:
+                logger.warning("Ignoring the client principal: %s", e)
+                principal = _INVALID
+            self._principals[key] = principal
+            if len(self._principals) > self.maxsize:
+                self._principals.popitem(last=False)
+        return None if principal is _INVALID else principal
+
+    def stats(self):
+        return {"size": len(self._principals), "hits": self.hits, "misses": self.misses}
+
+
+principal_parser = PrincipalParser()
+
+
+def get_principal(headers):
+    """Return the Principal of the signed-in user, or None if there isn't one (or its header is malformed)."""
+    return principal_parser.parse(headers.get(PRINCIPAL_HEADER))
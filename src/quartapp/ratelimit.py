@@ -0,0 +1,289 @@
+import math
+import os
+import time
+import uuid
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """A bucket of `capacity` tokens that refills at `rate` tokens per second."""
+
+    def __init__(self, capacity, rate, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount):
+        """Take `amount` tokens and return 0, or return how many seconds until there will be enough of them.
+
+        A request bigger than the whole bucket is let through once the bucket is full,
+        so that it isn't refused forever.
+        """
+        self._refill()
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            self.tokens -= amount
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def refund(self, amount):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def is_full(self):
+        return self.tokens + (self.clock() - self.updated) * self.rate >= self.capacity
+
+
+class MemoryRateLimitBackend:
+    """Keeps rate limit state in this process, so each worker enforces the limits on its own.
+
+    Buckets that have refilled are the same as new ones, so they're forgotten every
+    `evict_interval` seconds, and there's only a bucket for each recently active user.
+    """
+
+    def __init__(self, clock=time.monotonic, evict_interval=60):
+        self.clock = clock
+        self.evict_interval = evict_interval
+        self._buckets = {}
+        self._slots = {}
+        self._evicted = clock()
+
+    def _evict_full_buckets(self):
+        self._evicted = self.clock()
+        for key in [key for key, bucket in self._buckets.items() if bucket.is_full()]:
+            del self._buckets[key]
+
+    async def take_tokens(self, key, amount, per_minute):
+        if self.clock() - self._evicted >= self.evict_interval:
+            self._evict_full_buckets()
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.capacity != per_minute:
+            bucket = self._buckets[key] = TokenBucket(per_minute, per_minute / 60, clock=self.clock)
+        return bucket.take(amount)
+
+    async def refund_tokens(self, key, amount):
+        if key in self._buckets:
+            self._buckets[key].refund(amount)
+
+    async def acquire_slot(self, key, limit, lease_id):
+        if self._slots.get(key, 0) >= limit:
+            return False
+        self._slots[key] = self._slots.get(key, 0) + 1
+        return True
+
+    async def release_slot(self, key, lease_id):
+        self._slots[key] -= 1
+        if not self._slots[key]:
+            del self._slots[key]
+
+    async def close(self):
+        pass
+
+
+# Atomically refills and takes from a token bucket stored as a Redis hash.
+# KEYS[1]: bucket, ARGV: amount, capacity, rate (tokens/second), now (seconds)
+# Returns 0 if the tokens were taken, otherwise the seconds to wait (as a string, to keep the fraction)
+TOKEN_BUCKET_SCRIPT = """
+local amount, capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local needed = math.min(amount, capacity)
+local wait = 0
+if tokens >= needed then
+  tokens = tokens - amount
+else
+  wait = (needed - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+# Atomically takes a concurrency slot, kept as a member of a sorted set scored by when it expires.
+# KEYS[1]: slots, ARGV: limit, lease id, now (seconds), ttl (seconds)
+# Returns 1 if the slot was taken, 0 if `limit` slots are already held
+SLOT_SCRIPT = """
+local limit, lease, now, ttl = tonumber(ARGV[1]), ARGV[2], tonumber(ARGV[3]), tonumber(ARGV[4])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now)
+if redis.call("ZCARD", KEYS[1]) >= limit then
+  return 0
+end
+redis.call("ZADD", KEYS[1], now + ttl, lease)
+redis.call("EXPIRE", KEYS[1], math.ceil(ttl))
+return 1
+"""
+
+
+class RedisRateLimitBackend:
+    """Keeps rate limit state in Redis, so the limits apply across every worker and replica.
+
+    Each concurrency slot is held by a lease, and expires `slot_ttl` seconds after it was taken,
+    so slots held by a worker that died are given back even while other streams keep starting.
+    Streams that last longer than that stop counting towards the limits.
+    """
+
+    def __init__(self, client, prefix="ratelimit:", slot_ttl=600):
+        self.client = client
+        self.prefix = prefix
+        self.slot_ttl = slot_ttl
+        self._take = client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._acquire_slot = client.register_script(SLOT_SCRIPT)
+
+    async def take_tokens(self, key, amount, per_minute):
+        wait = await self._take(
+            keys=[f"{self.prefix}tokens:{key}"], args=[amount, per_minute, per_minute / 60, time.time()]
+        )
+        return float(wait)
+
+    async def refund_tokens(self, key, amount):
+        await self.client.hincrbyfloat(f"{self.prefix}tokens:{key}", "tokens", amount)
+
+    async def acquire_slot(self, key, limit, lease_id):
+        acquired = await self._acquire_slot(
+            keys=[f"{self.prefix}slots:{key}"], args=[limit, lease_id, time.time(), self.slot_ttl]
+        )
+        return bool(int(acquired))
+
+    async def release_slot(self, key, lease_id):
+        # Removing a slot that already expired is a no-op, so it can't free up a slot held by another lease
+        await self.client.zrem(f"{self.prefix}slots:{key}", lease_id)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class RateLimiter:
+    """Per-user and global limits on concurrent streams and on tokens per minute.
+
+    A limit of 0 means unlimited. Requests over a limit are refused right away
+    with RateLimitExceeded, rather than queued.
+    """
+
+    def __init__(
+        self,
+        backend,
+        max_streams=0,
+        max_streams_per_user=0,
+        tokens_per_minute=0,
+        tokens_per_minute_per_user=0,
+    ):
+        self.backend = backend
+        self.max_streams = max_streams
+        self.max_streams_per_user = max_streams_per_user
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens_per_minute_per_user = tokens_per_minute_per_user
+        self.rejected = 0
+
+    async def acquire(self, user, tokens):
+        """Reserve a stream slot and `tokens` tokens for `user`, and return the Lease to release them with."""
+        lease = Lease(self, user)
+        try:
+            for key, limit in (("user:" + user, self.max_streams_per_user), ("global", self.max_streams)):
+                if limit:
+                    if not await self.backend.acquire_slot(key, limit, lease.id):
+                        raise RateLimitExceeded("Too many concurrent chats, try again when one has finished", 1)
+                    lease.slots.append(key)
+            for key, per_minute in (
+                ("user:" + user, self.tokens_per_minute_per_user),
+                ("global", self.tokens_per_minute),
+            ):
+                if per_minute:
+                    wait = await self.backend.take_tokens(key, tokens, per_minute)
+                    if wait:
+                        raise RateLimitExceeded("Too many tokens used in the last minute", max(1, math.ceil(wait)))
+                    lease.buckets.append(key)
+        except RateLimitExceeded:
+            self.rejected += 1
+            await lease.release(tokens)
+            raise
+        return lease
+
+    def stats(self):
+        return {"rejected": self.rejected}
+
+
+class Lease:
+    def __init__(self, limiter, user):
+        self.limiter = limiter
+        self.user = user
+        # Identifies the slots this lease holds, in backends that keep track of each of them
+        self.id = uuid.uuid4().hex
+        self.slots = []
+        self.buckets = []
+        self.released = False
+
+    async def release(self, unused_tokens=0):
+        """Give back the stream slots, and the tokens that were reserved but not used."""
+        if self.released:
+            return
+        self.released = True
+        for key in self.slots:
+            await self.limiter.backend.release_slot(key, self.id)
+        if unused_tokens > 0:
+            for key in self.buckets:
+                await self.limiter.backend.refund_tokens(key, unused_tokens)
+
+
+class LeasedBody:
+    """A response body that releases its lease when the response is closed.
+
+    Unlike a generator's finally block, this also runs for responses whose stream never started.
+    """
+
+    def __init__(self, body, lease):
+        self.body = body
+        self.lease = lease
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.body.__anext__()
+
+    async def aclose(self):
+        try:
+            await self.body.aclose()
+        finally:
+            await self.lease.release()
+
+
+def create_rate_limiter():
+    """Create the rate limiter from the CHAT_MAX_* and CHAT_TOKENS_PER_MINUTE* settings, or None if none are set.
+
+    CHAT_RATE_LIMIT_BACKEND selects where the state is kept: "memory" (per worker, the default) or "redis".
+    """
+    limits = {
+        "max_streams": int(os.getenv("CHAT_MAX_CONCURRENT_STREAMS", "0")),
+        "max_streams_per_user": int(os.getenv("CHAT_MAX_CONCURRENT_STREAMS_PER_USER", "0")),
+        "tokens_per_minute": int(os.getenv("CHAT_TOKENS_PER_MINUTE", "0")),
+        "tokens_per_minute_per_user": int(os.getenv("CHAT_TOKENS_PER_MINUTE_PER_USER", "0")),
+    }
+    if not any(limits.values()):
+        return None
+    backend_type = os.getenv("CHAT_RATE_LIMIT_BACKEND", "memory").strip().lower()
+    if backend_type == "memory":
+        backend = MemoryRateLimitBackend()
+    elif backend_type == "redis":
+        if not os.getenv("REDIS_URL"):
+            raise ValueError("REDIS_URL is required when CHAT_RATE_LIMIT_BACKEND is redis")
+        # redis is only needed for this backend, so it isn't a dependency of the app
+        import redis.asyncio
+
+        backend = RedisRateLimitBackend(redis.asyncio.Redis.from_url(os.getenv("REDIS_URL")))
+    else:
+        raise ValueError(f"Unknown CHAT_RATE_LIMIT_BACKEND: {backend_type}")
+    return RateLimiter(backend, **limits)
@@ -0,0 +1,17 @@
+import os
+
+
+def get_bool_env(name, default=False):
+    """Return whether the `name` setting is on ("1", "true" or "yes"), or `default` when it's unset or empty."""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() in ("1", "true", "yes")
+
+
+def get_number_env(name, default, type=float):
+    """Return the `name` setting converted with `type`, or `default` when it's unset or empty."""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    return type(value.strip())
@@ -0,0 +1,146 @@
+import contextlib
+import importlib
+import importlib.machinery
+import logging
+import os
+import sys
+import time
+
+from .conversations import get_conversation_store_type
+from .settings import get_bool_env
+
+logger = logging.getLogger(__name__)
+
+# Loaders that are created for each module, so that one of their methods can be wrapped without affecting others
+_PER_MODULE_LOADERS = (
+    importlib.machinery.SourceFileLoader,
+    importlib.machinery.SourcelessFileLoader,
+    importlib.machinery.ExtensionFileLoader,
+)
+
+
+class _ImportTimer:
+    """Import hook that times how long each module takes to execute, like python -X importtime."""
+
+    def __init__(self, report):
+        self.report = report
+        # Cumulative time of the imports nested in each import in progress, to work out their own time
+        self._nested = []
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if isinstance(spec.loader, _PER_MODULE_LOADERS):
+            spec.loader.exec_module = self._timed(fullname, spec.loader)
+        return spec
+
+    def _timed(self, fullname, loader):
+        exec_module = loader.exec_module
+
+        def timed_exec_module(module):
+            started = time.perf_counter()
+            self._nested.append(0.0)
+            try:
+                exec_module(module)
+            finally:
+                del loader.exec_module
+                nested = self._nested.pop()
+                cumulative = time.perf_counter() - started
+                if self._nested:
+                    self._nested[-1] += cumulative
+                self.report.imports.append((fullname, cumulative - nested, cumulative))
+
+        return timed_exec_module
+
+
+class StartupReport:
+    """Times the phases of a worker's startup and, when enabled, every module it imports.
+
+    Phases are always timed, as it's cheap. Imports are only timed when the report is
+    enabled, from start() until finish(), which then prints the report to stderr.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.phases = []
+        self.imports = []
+        self._import_timer = None
+
+    def start(self):
+        if self.enabled and self._import_timer is None:
+            self._import_timer = _ImportTimer(self)
+            sys.meta_path.insert(0, self._import_timer)
+
+    def add(self, phase, seconds):
+        self.phases.append([phase, seconds])
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        entry = [phase, None]
+        # Added when the phase starts, so phases are listed in the order they started
+        self.phases.append(entry)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry[1] = time.perf_counter() - started
+
+    def format(self, top=15):
+        lines = [f"Startup report (pid {os.getpid()}), ready after {time.perf_counter() - self.started:.3f}s"]
+        for phase, seconds in self.phases:
+            lines.append(f"  {phase:<50} {seconds or 0:8.3f}s")
+        if self.imports:
+            lines.append(f"  Slowest of {len(self.imports)} imports (self / cumulative):")
+            for module, self_seconds, cumulative in sorted(self.imports, key=lambda item: item[1], reverse=True)[:top]:
+                lines.append(f"    {module:<48} {self_seconds:8.3f}s {cumulative:8.3f}s")
+        return "\n".join(lines)
+
+    def finish(self):
+        if self._import_timer is not None:
+            sys.meta_path.remove(self._import_timer)
+            self._import_timer = None
+        if self.enabled:
+            print(self.format(), file=sys.stderr, flush=True)
+
+
+def create_startup_report():
+    """Create the startup report, enabled by STARTUP_REPORT."""
+    return StartupReport(enabled=get_bool_env("STARTUP_REPORT"))
+
+
+def get_preload_modules():
+    """Return the modules that the configured setup imports lazily (or on first use), to import them up front."""
+    modules = ["openai.resources.responses", "openai.resources.embeddings"]
+    keyless = os.getenv("AZURE_OPENAI_ENDPOINT") and not os.getenv("AZURE_OPENAI_KEY")
+    key_vault = os.getenv("OPENAICOM_API_KEY_SECRET_NAME") and not os.getenv("OPENAICOM_API_KEY")
+    if keyless or key_vault or os.getenv("OPENAI_BACKENDS"):
+        modules.append("azure.identity.aio")
+    if key_vault:
+        modules.append("azure.keyvault.secrets.aio")
+    if get_bool_env("CHAT_SEMANTIC_CACHE_ENABLED"):
+        modules.append("numpy")
+    if "redis" in (get_conversation_store_type(), os.getenv("CHAT_RATE_LIMIT_BACKEND", "")):
+        modules.append("redis.asyncio")
+    return modules
+
+
+def preload(app):
+    """Load the modules and templates that workers need, so that workers forked afterwards share them.
+
+    Only code and templates are loaded: the OpenAI clients, credentials and other async resources
+    hold sockets and event loop state that can't cross a fork, so each worker still creates its own
+    when it starts serving, in configure_openai.
+    """
+    for module in get_preload_modules():
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.warning("Could not preload %s: %s", module, e)
+    app.jinja_env.get_template("index.html")
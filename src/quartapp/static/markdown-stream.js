@@ -0,0 +1,111 @@
+// Matches a line that starts a list item, without indentation
+const LIST_ITEM = /^([*+-]|\d{1,9}[.)])(\s|$)/;
+
+// Renders a streamed markdown answer incrementally.
+//
+// Converting the whole answer again for every chunk costs O(n²) over an answer, so the answer is split
+// into blocks at blank lines (outside of code fences): finished blocks are converted once and appended,
+// and only the trailing, unfinished block is converted again. Renders are batched per animation frame,
+// however many chunks arrive in between.
+//
+// A blank line only ends a block when the next line starts a new one, so that the HTML is the same as
+// converting the whole answer at once: not when it's indented (like a list item's next paragraph),
+// and not when it's a list item, as "1. …\n\n2. …" is a single loose list.
+class IncrementalMarkdownRenderer {
+    constructor(container, converter, {onRender = null, requestFrame = null, cancelFrame = null} = {}) {
+        this.container = container;
+        this.converter = converter;
+        this.onRender = onRender;
+        this.requestFrame = requestFrame || ((callback) => requestAnimationFrame(callback));
+        this.cancelFrame = cancelFrame || ((frame) => cancelAnimationFrame(frame));
+        this.source = "";
+        // End of the finished blocks, which are already rendered
+        this.committed = 0;
+        // End of the lines scanned for block boundaries, and whether they end inside a code fence
+        this.scanned = 0;
+        this.inFence = false;
+        // End of the last blank line seen outside of a code fence, until the next line shows if it ends a block
+        this.blankLineEnd = null;
+        this.frame = null;
+        this.finishedElement = null;
+        this.tailElement = null;
+    }
+
+    append(text) {
+        this.source += text;
+        if (this.frame === null) {
+            this.frame = this.requestFrame(() => {
+                this.frame = null;
+                this.render();
+            });
+        }
+    }
+
+    // Renders what's left right away, at the end of the answer
+    finish() {
+        this.cancel();
+        this.render();
+    }
+
+    cancel() {
+        if (this.frame !== null) {
+            this.cancelFrame(this.frame);
+            this.frame = null;
+        }
+    }
+
+    render() {
+        if (this.tailElement === null) {
+            this.container.innerHTML = "";
+            this.finishedElement = this.container.appendChild(this.container.ownerDocument.createElement("div"));
+            this.tailElement = this.container.appendChild(this.container.ownerDocument.createElement("div"));
+        }
+        const boundary = this.scan();
+        if (boundary > this.committed) {
+            const html = this.converter.makeHtml(this.source.slice(this.committed, boundary));
+            this.finishedElement.insertAdjacentHTML("beforeend", html);
+            this.committed = boundary;
+        }
+        this.tailElement.innerHTML = this.converter.makeHtml(this.source.slice(this.committed));
+        if (this.onRender) {
+            this.onRender();
+        }
+    }
+
+    // Scans the complete lines that arrived since the last render, and returns where the finished
+    // blocks end: after a blank line outside of a code fence, once the next line has arrived and
+    // neither continues the block (indented) nor continues a list (a list item)
+    scan() {
+        let boundary = this.committed;
+        let end;
+        while ((end = this.source.indexOf("\n", this.scanned)) !== -1) {
+            const line = this.source.slice(this.scanned, end);
+            if (line.trim() === "") {
+                if (!this.inFence) {
+                    this.blankLineEnd = end + 1;
+                }
+            } else {
+                if (this.blankLineEnd !== null && !/^\s/.test(line) && !LIST_ITEM.test(line)) {
+                    boundary = this.blankLineEnd;
+                }
+                this.blankLineEnd = null;
+                if (/^ {0,3}(```|~~~)/.test(line)) {
+                    this.inFence = !this.inFence;
+                }
+            }
+            this.scanned = end + 1;
+        }
+        return boundary;
+    }
+}
+
+// Adapts marked to the converter that IncrementalMarkdownRenderer takes. Heading ids are off, as they're
+// only unique within each conversion, and so is the obfuscation of email addresses, which is random
+function createMarkedConverter(marked) {
+    const options = {headerIds: false, mangle: false};
+    return {makeHtml: (markdown) => marked.parse(markdown, options)};
+}
+
+if (typeof module !== "undefined") {
+    module.exports = {IncrementalMarkdownRenderer, createMarkedConverter};
+}
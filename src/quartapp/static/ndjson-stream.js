@@ -0,0 +1,32 @@
+// Reads a stream of newline-delimited JSON, like the body of a /chat/stream response, and yields each
+// object as soon as its line is complete, however the lines are split across chunks.
+async function* readNDJSONStream(stream) {
+    const reader = stream.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    try {
+        while (true) {
+            const {done, value} = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += value;
+            const lines = buffer.split("\n");
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (line.trim()) {
+                    yield JSON.parse(line);
+                }
+            }
+        }
+        if (buffer.trim()) {
+            yield JSON.parse(buffer);
+        }
+    } finally {
+        // Stops reading the response when the caller stops early, like on an error frame
+        await reader.cancel();
+    }
+}
+
+if (typeof module !== "undefined") {
+    module.exports = {readNDJSONStream};
+}
@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import os
+
+_END = object()
+
+
+def get_coalescing_settings():
+    """Return (max_bytes, max_delay) for coalescing streamed frames, or None if it's disabled.
+
+    Coalescing is enabled by setting CHAT_STREAM_COALESCE_BYTES and/or CHAT_STREAM_COALESCE_MS.
+    """
+    max_bytes = int(os.getenv("CHAT_STREAM_COALESCE_BYTES", "0"))
+    max_delay_ms = float(os.getenv("CHAT_STREAM_COALESCE_MS", "0"))
+    if not max_bytes and not max_delay_ms:
+        return None
+    return (max_bytes or 1024, (max_delay_ms or 20) / 1000)
+
+
+async def coalesce_frames(frames, max_bytes=1024, max_delay=0.02):
+    """Join the frames of an NDJSON stream into fewer, larger chunks.
+
+    Frames are buffered until there are `max_bytes` of them (counted as characters),
+    or until the oldest one has waited `max_delay` seconds, whichever comes first,
+    so that tiny deltas don't each cost a separate write. Frames are never split
+    or reordered, so the stream's content is exactly the same as without coalescing.
+    """
+    # Frames are read in a separate task, so that waiting for the next frame
+    # can time out without cancelling the frames generator itself.
+    queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async with contextlib.aclosing(frames):
+                async for frame in frames:
+                    await queue.put(frame)
+        except Exception as e:
+            await queue.put(e)
+        await queue.put(_END)
+
+    pump_task = asyncio.create_task(pump())
+    loop = asyncio.get_running_loop()
+    buffer = []
+    buffered_bytes = 0
+    deadline = None
+    try:
+        while True:
+            item = None
+            if not queue.empty():
+                item = queue.get_nowait()
+            elif deadline is None:
+                item = await queue.get()
+            else:
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        item = await queue.get()
+                except TimeoutError:
+                    pass
+            if item is _END or isinstance(item, Exception):
+                if buffer:
+                    yield "".join(buffer)
+                if item is _END:
+                    return
+                raise item
+            if item is not None:
+                if not buffer:
+                    deadline = loop.time() + max_delay
+                buffer.append(item)
+                buffered_bytes += len(item)
+            if buffer and (item is None or buffered_bytes >= max_bytes or loop.time() >= deadline):
+                yield "".join(buffer)
+                buffer = []
+                buffered_bytes = 0
+                deadline = None
+    finally:
+        pump_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await pump_task
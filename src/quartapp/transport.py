@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+import httpx
+import openai
+
+from .settings import get_bool_env, get_number_env
+
+logger = logging.getLogger(__name__)
+
+
+def get_http_settings():
+    """Connection pool settings for the OpenAI client, from OPENAI_HTTP_* environment variables.
+
+    Anything not set keeps the SDK's default: every stream holds its connection for the whole answer,
+    so lower limits would make the streams beyond them wait for a connection, and then fail.
+    """
+    limits, timeout = openai.DEFAULT_CONNECTION_LIMITS, openai.DEFAULT_TIMEOUT
+    return {
+        "limits": httpx.Limits(
+            max_connections=get_number_env("OPENAI_HTTP_MAX_CONNECTIONS", limits.max_connections, int),
+            max_keepalive_connections=get_number_env(
+                "OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS", limits.max_keepalive_connections, int
+            ),
+            keepalive_expiry=get_number_env("OPENAI_HTTP_KEEPALIVE_EXPIRY", limits.keepalive_expiry),
+        ),
+        "timeout": httpx.Timeout(
+            connect=get_number_env("OPENAI_HTTP_CONNECT_TIMEOUT", timeout.connect),
+            read=get_number_env("OPENAI_HTTP_READ_TIMEOUT", timeout.read),
+            write=get_number_env("OPENAI_HTTP_WRITE_TIMEOUT", timeout.write),
+            pool=get_number_env("OPENAI_HTTP_POOL_TIMEOUT", timeout.pool),
+        ),
+        "http2": get_bool_env("OPENAI_HTTP2"),
+    }
+
+
+def create_http_client():
+    """Create the HTTP client shared by every request to the OpenAI API.
+
+    DefaultAsyncHttpxClient keeps the SDK's defaults (like redirects)
+    for anything not set here.
+    """
+    return openai.DefaultAsyncHttpxClient(**get_http_settings())
+
+
+async def warm_up(http_client, url, connections=1):
+    """Open `connections` pooled connections to `url`, so the first requests skip the TCP and TLS handshakes.
+
+    The responses don't matter (they're usually 401 or 404), only the connections they leave in the pool.
+    """
+
+    async def open_connection():
+        try:
+            await http_client.head(url)
+        except httpx.HTTPError as e:
+            logger.warning("Could not warm up a connection to %s: %s", url, e)
+
+    await asyncio.gather(*(open_connection() for _ in range(connections)))
+
+
+def pool_stats(http_client):
+    """Return the number of open and idle connections, and of requests using or waiting for one."""
+    # httpx doesn't expose its connection pool publicly, so this reads httpcore's pool directly
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    requests = list(getattr(pool, "_requests", []))
+    return {
+        "connections": len(connections),
+        "idle": sum(1 for connection in connections if connection.is_idle()),
+        "http2": sum(1 for connection in connections if "HTTP/2" in connection.info()),
+        "active_requests": sum(1 for pool_request in requests if not pool_request.is_queued()),
+        "queued_requests": sum(1 for pool_request in requests if pool_request.is_queued()),
+    }
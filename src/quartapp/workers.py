@@ -0,0 +1,68 @@
+import math
+import os
+
+from uvicorn.workers import UvicornWorker
+
+
+def read_cgroup_cpu_quota(root="/sys/fs/cgroup"):
+    """Return the CPU quota of the container (like 1.5 for 1.5 CPUs), or None if it doesn't have one."""
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>" without a quota
+        with open(os.path.join(root, "cpu.max")) as f:
+            quota, period = f.read().split()
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1: a quota of -1 means there's none
+        with open(os.path.join(root, "cpu", "cpu.cfs_quota_us")) as f:
+            quota = int(f.read())
+        with open(os.path.join(root, "cpu", "cpu.cfs_period_us")) as f:
+            period = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return quota / period if quota > 0 and period > 0 else None
+
+
+def get_cpu_limit(cgroup_root="/sys/fs/cgroup"):
+    """Return how many CPUs this process can use, given its CPU affinity and its container's CPU quota.
+
+    Unlike multiprocessing.cpu_count(), which counts every CPU of the host.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS and Windows
+        cpus = os.cpu_count() or 1
+    quota = read_cgroup_cpu_quota(cgroup_root)
+    return min(cpus, quota) if quota else cpus
+
+
+def get_worker_count(cgroup_root="/sys/fs/cgroup"):
+    """Return the number of workers to run, from GUNICORN_WORKERS (or WEB_CONCURRENCY) or the CPU limit.
+
+    The app spends most of its time waiting for upstream streams, which one event loop
+    handles concurrently, so one worker per CPU is enough to use them all,
+    unlike the (CPUs * 2) + 1 workers that suit synchronous servers.
+    There are at least 2 workers though, so that one keeps serving while the other
+    is recycled by max_requests, even on containers with less than one CPU.
+    """
+    workers = os.getenv("GUNICORN_WORKERS") or os.getenv("WEB_CONCURRENCY")
+    if workers:
+        return int(workers)
+    return max(2, math.ceil(get_cpu_limit(cgroup_root)))
+
+
+class ChatWorker(UvicornWorker):
+    """UvicornWorker that limits each worker's concurrent connections to gunicorn's worker_connections setting.
+
+    Requests over the limit get a 503 right away, rather than slowing down every stream of an overloaded worker.
+    A worker_connections of 0 means no limit.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.cfg.worker_connections:
+            # uvicorn counts the new connection itself when checking its limit
+            self.config.limit_concurrency = self.cfg.worker_connections + 1
@@ -1,3 +1,4 @@
+import hashlib
 import os
 from unittest import mock
 
@@ -10,6 +11,21 @@ import quartapp
 from . import mock_cred
 
 
+class FakeClock:
+    """A stand-in for time.monotonic or time.time that only moves when a test sets `now`."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
 @pytest.fixture
 def mock_openai_responses(monkeypatch):
     class MockResponseEvent:
@@ -41,6 +57,9 @@ def mock_openai_responses(monkeypatch):
             else:
                 raise StopAsyncIteration
 
+        async def close(self):
+            self.event_index = len(self.events)
+
     async def mock_acreate(*args, **kwargs):
         last_message = kwargs.get("input", [])[-1]["content"]
         if last_message == "What is the capital of France?":
@@ -53,9 +72,30 @@ def mock_openai_responses(monkeypatch):
     monkeypatch.setattr("openai.resources.responses.AsyncResponses.create", mock_acreate)
 
 
+@pytest.fixture
+def mock_openai_embeddings(monkeypatch):
+    class MockEmbedding:
+        def __init__(self, embedding):
+            self.embedding = embedding
+
+    class MockEmbeddingsResponse:
+        def __init__(self, embedding):
+            self.data = [MockEmbedding(embedding)]
+
+    async def mock_acreate(*args, **kwargs):
+        # A bag-of-words embedding: texts that share most of their words are similar
+        dimensions = kwargs.get("dimensions") or 64
+        embedding = [0.0] * dimensions
+        for word in "".join(c for c in kwargs["input"].lower() if c.isalnum() or c.isspace()).split():
+            embedding[int(hashlib.md5(word.encode()).hexdigest(), 16) % dimensions] += 1.0
+        return MockEmbeddingsResponse(embedding)
+
+    monkeypatch.setattr("openai.resources.embeddings.AsyncEmbeddings.create", mock_acreate)
+
+
 @pytest.fixture
 def mock_defaultazurecredential(monkeypatch):
-    monkeypatch.setattr("azure.identity.aio.DefaultAzureCredential", mock_cred.MockAzureCredential)
+    monkeypatch.setattr("azure.identity.aio.DefaultAzureCredential", mock_cred.MockDefaultAzureCredential)
     monkeypatch.setattr("azure.identity.aio.ManagedIdentityCredential", mock_cred.MockAzureCredential)
 
 
@@ -73,7 +113,7 @@ def mock_keyvault_secretclient(monkeypatch):
 
 
 @pytest_asyncio.fixture
-async def client(monkeypatch, mock_openai_responses, mock_defaultazurecredential):
+async def client(monkeypatch, mock_openai_responses, mock_openai_embeddings, mock_defaultazurecredential):
     with mock.patch.dict(os.environ, clear=True):
         monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "test-openai-service.openai.azure.com")
         monkeypatch.setenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT", "gpt-5.2")
@@ -1,3 +1,6 @@
+import time
+
+import azure.core.credentials
 import azure.core.credentials_async
 
 
@@ -5,6 +8,14 @@ class MockAzureCredential(azure.core.credentials_async.AsyncTokenCredential):
     def __init__(self, *args, **kwargs):
         pass
 
+    async def get_token(self, *scopes, **kwargs):
+        return azure.core.credentials.AccessToken("mock-token", int(time.time()) + 3600)
+
+
+class MockDefaultAzureCredential(MockAzureCredential):
+    def __init__(self, *args, **kwargs):
+        self.credentials = (MockAzureCredential(),)
+
 
 class MockKeyVaultSecret:
     def __init__(self, value):
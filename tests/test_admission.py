@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from quartapp.admission import AdmissionController, LoadShed
+
+
+@pytest.mark.asyncio
+async def test_limit_increases_additively(clock):
+    controller = AdmissionController(initial_limit=4, target_latency=1, clock=clock)
+    for _ in range(4):
+        ticket = await controller.acquire()
+        clock.now += 0.5
+        ticket.first_token()
+        ticket.release()
+    # +1/limit per fast request, so about +1 after a full round of requests
+    assert 4.9 < controller.limit < 5
+    assert controller.stats()["admitted"] == 4
+
+
+@pytest.mark.asyncio
+async def test_limit_decreases_multiplicatively(clock):
+    controller = AdmissionController(initial_limit=16, target_latency=1, backoff_interval=1, clock=clock)
+    tickets = [await controller.acquire() for _ in range(3)]
+    tickets[0].release(overloaded=True)
+    assert controller.limit == 8
+    # Failures from the same overload only count once
+    tickets[1].release(overloaded=True)
+    assert controller.limit == 8
+    # A first token slower than the target latency is a sign of overload too
+    clock.now += 3
+    tickets[2].first_token()
+    tickets[2].release()
+    assert controller.limit == 4
+    assert controller.stats()["throttled"] == 2
+
+    for _ in range(10):
+        clock.now += 1
+        ticket = await controller.acquire()
+        ticket.release(overloaded=True)
+    assert controller.limit == controller.min_limit
+
+
+@pytest.mark.asyncio
+async def test_cancelled_requests_do_not_change_the_limit():
+    controller = AdmissionController(initial_limit=4)
+    ticket = await controller.acquire()
+    ticket.release()
+    ticket.release()
+    assert controller.limit == 4
+    assert controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_queued_requests_get_slots_in_order():
+    controller = AdmissionController(initial_limit=1, queue_timeout=5)
+    ticket = await controller.acquire()
+    order = []
+
+    async def wait(name):
+        queued_ticket = await controller.acquire()
+        order.append(name)
+        return queued_ticket
+
+    first = asyncio.create_task(wait("first"))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(wait("second"))
+    await asyncio.sleep(0)
+    assert controller.stats()["queued"] == 2
+
+    ticket.release()
+    (await first).release()
+    (await second).release()
+    assert order == ["first", "second"]
+    assert controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_sheds_when_queue_is_full_or_wait_runs_out():
+    controller = AdmissionController(initial_limit=1, queue_size=1, queue_timeout=0.05)
+    ticket = await controller.acquire()
+    waiting = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+    with pytest.raises(LoadShed):
+        await controller.acquire()
+    with pytest.raises(LoadShed):
+        await waiting
+    assert controller.stats()["shed"] == 2
+    assert controller.queued == 0
+
+    ticket.release()
+    assert controller.in_flight == 0
+    (await controller.acquire()).release()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_leak_its_slot():
+    controller = AdmissionController(initial_limit=1, queue_timeout=5)
+    ticket = await controller.acquire()
+    waiting = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+    # The slot is handed over and the waiter is cancelled before it resumes
+    ticket.release()
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert controller.in_flight == 0
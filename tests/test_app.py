@@ -1,20 +1,90 @@
+import asyncio
+import base64
+import gzip
+import json
 from unittest import mock
 import os
 
+import httpx
+import openai
 import pytest
 from openai import AsyncOpenAI
 
 import quartapp
+from quartapp import chat
+from quartapp.admission import AdmissionController
+from quartapp.caching import ResponseCache, SemanticCache
+from quartapp.coalescing import RequestCoalescer
+from quartapp.conversations import MemoryConversationStore
+from quartapp.metrics import RequestMetrics
+from quartapp.ratelimit import MemoryRateLimitBackend, RateLimiter
 
 from . import mock_cred
 
 
+def make_principal_header(oid):
+    principal = {"auth_typ": "aad", "claims": [{"typ": "oid", "val": oid}]}
+    return base64.b64encode(json.dumps(principal).encode()).decode()
+
+
 @pytest.mark.asyncio
 async def test_index(client):
     response = await client.get("/")
     assert response.status_code == 200
 
 
+@pytest.mark.asyncio
+async def test_index_username(client):
+    principal = {"auth_typ": "aad", "claims": [{"typ": "name", "val": "Ada Lovelace"}]}
+    response = await client.get(
+        "/", headers={"X-MS-CLIENT-PRINCIPAL": base64.b64encode(json.dumps(principal).encode()).decode()}
+    )
+    assert response.status_code == 200
+    assert "Ada Lovelace" in await response.get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_index_conditional_get(client):
+    response = await client.get("/")
+    assert response.headers["Cache-Control"] == "private, no-cache"
+    etag = response.headers["ETag"]
+    response = await client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert await response.get_data() == b""
+
+    # Another user's page has another ETag
+    principal = {"auth_typ": "aad", "claims": [{"typ": "name", "val": "Ada Lovelace"}]}
+    response = await client.get(
+        "/",
+        headers={
+            "X-MS-CLIENT-PRINCIPAL": base64.b64encode(json.dumps(principal).encode()).decode(),
+            "If-None-Match": etag,
+        },
+    )
+    assert response.status_code == 200
+    assert "Ada Lovelace" in await response.get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_index_compressed(client, monkeypatch):
+    monkeypatch.setenv("INDEX_PAGE_COMPRESSION", "true")
+    async with client.app.app_context():
+        await chat.prerender_index()
+    response = await client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert b"</html>" in gzip.decompress(await response.get_data())
+    response = await client.get("/")
+    assert "Content-Encoding" not in response.headers
+    assert "</html>" in await response.get_data(as_text=True)
+
+
+@pytest.mark.asyncio
+async def test_index_malformed_principal(client):
+    response = await client.get("/", headers={"X-MS-CLIENT-PRINCIPAL": "not a principal"})
+    assert response.status_code == 200
+    assert "You" in await response.get_data(as_text=True)
+
+
 @pytest.mark.asyncio
 async def test_chat_stream_text(client, snapshot):
     response = await client.post(
@@ -75,17 +145,24 @@ async def test_azure_openai_managedidentity(monkeypatch):
         async with quart_app.test_app():
             assert isinstance(quart_app.blueprints["chat"].openai_client, AsyncOpenAI)
             assert "/openai/v1/" in str(quart_app.blueprints["chat"].openai_client.base_url)
+            # Only the managed identity was tried, and the token was fetched before serving
+            assert quart_app.blueprints["chat"].azure_credential.stats()["selected"] == "managed_identity"
+            assert len(quart_app.blueprints["chat"].azure_credential.stats()["probes"]) == 1
 
 
 @pytest.mark.asyncio
-async def test_openaicom_key(monkeypatch, mock_keyvault_secretclient):
+async def test_openaicom_key(monkeypatch, mock_keyvault_secretclient, tmp_path):
     with mock.patch.dict(os.environ, clear=True):
         monkeypatch.setenv("OPENAICOM_API_KEY_SECRET_NAME", "my_secret_name")
+        monkeypatch.setenv("KEY_VAULT_SECRET_CACHE_FILE", str(tmp_path / "secret.json"))
 
         quart_app = quartapp.create_app()
 
         async with quart_app.test_app():
+            # The key is provided before each request, so a rotated key is picked up
+            await quart_app.blueprints["chat"].openai_client._refresh_api_key()
             assert quart_app.blueprints["chat"].openai_client.api_key == "mysecret"
+            assert quart_app.blueprints["chat"].secret_provider.stats()["fetches"] == 1
             assert isinstance(quart_app.blueprints["chat"].openai_client, AsyncOpenAI)
 
 
@@ -100,3 +177,490 @@ async def test_openai_local(monkeypatch):
             assert quart_app.blueprints["chat"].openai_client.api_key == "no-key-required"
             assert quart_app.blueprints["chat"].openai_client.base_url == "http://localhost:8080"
             assert isinstance(quart_app.blueprints["chat"].openai_client, AsyncOpenAI)
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_trims_history(client, monkeypatch):
+    monkeypatch.setenv("CHAT_HISTORY_MAX_TOKENS", "100")
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [
+                {"role": "user", "content": "Tell me a long story. " * 50},
+                {"role": "assistant", "content": "Once upon a time. " * 50},
+                {"role": "user", "content": "What is the capital of France?"},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    assert int(response.headers["X-History-Dropped-Tokens"]) > 0
+    assert int(response.headers["X-History-Input-Tokens"]) <= 100
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_conversation(client, snapshot):
+    client.app.blueprints["chat"].conversation_store = MemoryConversationStore()
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "conversation_id": None,
+            "messages": [{"role": "user", "content": "What is the capital of France?"}],
+        },
+    )
+    assert response.status_code == 200
+    await response.get_data()
+    conversation_id = response.headers["X-Conversation-Id"]
+
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "conversation_id": conversation_id,
+            "messages": [{"role": "user", "content": "What is the capital of Germany?"}],
+        },
+    )
+    assert response.status_code == 200
+    assert response.headers["X-Conversation-Id"] == conversation_id
+    result = await response.get_data()
+    snapshot.assert_match(result, "result.jsonlines")
+
+    stored_messages = await client.app.blueprints["chat"].conversation_store.get(f"anonymous:{conversation_id}")
+    assert stored_messages == [
+        {"role": "user", "content": "What is the capital of France?"},
+        {"role": "assistant", "content": "The capital of France is Paris."},
+        {"role": "user", "content": "What is the capital of Germany?"},
+        {"role": "assistant", "content": "The capital of Germany is Berlin."},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_conversation_stores_trimmed_history(client, monkeypatch):
+    monkeypatch.setenv("CHAT_HISTORY_MAX_TOKENS", "100")
+    client.app.blueprints["chat"].conversation_store = MemoryConversationStore()
+    question = {"role": "user", "content": "What is the capital of France?"}
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "conversation_id": None,
+            "messages": [
+                {"role": "user", "content": "Tell me a long story. " * 50},
+                {"role": "assistant", "content": "Once upon a time. " * 50},
+                question,
+            ],
+        },
+    )
+    await response.get_data()
+    assert int(response.headers["X-History-Dropped-Tokens"]) > 0
+
+    conversation_id = response.headers["X-Conversation-Id"]
+    stored_messages = await client.app.blueprints["chat"].conversation_store.get(f"anonymous:{conversation_id}")
+    assert stored_messages == [question, {"role": "assistant", "content": "The capital of France is Paris."}]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_unknown_conversation(client):
+    client.app.blueprints["chat"].conversation_store = MemoryConversationStore()
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "conversation_id": "does-not-exist",
+            "messages": [{"role": "user", "content": "What is the capital of France?"}],
+        },
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_conversation_of_another_user(client):
+    client.app.blueprints["chat"].conversation_store = MemoryConversationStore()
+    question = {"role": "user", "content": "What is the capital of France?"}
+    response = await client.post(
+        "/chat/stream",
+        json={"conversation_id": None, "messages": [question]},
+        headers={"X-MS-CLIENT-PRINCIPAL": make_principal_header(oid="owner")},
+    )
+    await response.get_data()
+    conversation_id = response.headers["X-Conversation-Id"]
+
+    response = await client.post(
+        "/chat/stream",
+        json={"conversation_id": conversation_id, "messages": [question]},
+        headers={"X-MS-CLIENT-PRINCIPAL": make_principal_header(oid="someone-else")},
+    )
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_conversation_without_store(client):
+    assert client.app.blueprints["chat"].conversation_store is None
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "conversation_id": "abc",
+            "messages": [{"role": "user", "content": "What is the capital of Germany?"}],
+        },
+    )
+    assert response.status_code == 400
+
+    # Starting a conversation without a store is just a stateless request
+    response = await client.post(
+        "/chat/stream",
+        json={"conversation_id": None, "messages": [{"role": "user", "content": "What is the capital of France?"}]},
+    )
+    assert response.status_code == 200
+    assert "X-Conversation-Id" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_stateless_has_no_conversation(client):
+    response = await client.post(
+        "/chat/stream",
+        json={"messages": [{"role": "user", "content": "What is the capital of France?"}]},
+    )
+    assert response.status_code == 200
+    assert "X-Conversation-Id" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_response_cache(client, monkeypatch):
+    chat_bp = client.app.blueprints["chat"]
+    chat_bp.response_cache = ResponseCache()
+    upstream_calls = []
+    create = chat_bp.openai_client.responses.create
+
+    async def counting_create(*args, **kwargs):
+        upstream_calls.append(kwargs)
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(chat_bp.openai_client.responses, "create", counting_create)
+
+    request_json = {"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+    first = await (await client.post("/chat/stream", json=request_json)).get_data()
+    second = await (await client.post("/chat/stream", json=request_json)).get_data()
+    assert first == second
+    assert len(upstream_calls) == 1
+    assert chat_bp.response_cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_semantic_cache(client):
+    chat_bp = client.app.blueprints["chat"]
+    chat_bp.semantic_cache = SemanticCache(chat.embed_text, threshold=0.9)
+
+    first = await client.post(
+        "/chat/stream", json={"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+    )
+    # The mocked upstream doesn't know this question, so it can only be answered from the cache
+    second = await client.post(
+        "/chat/stream", json={"messages": [{"role": "user", "content": "what is the capital of france"}]}
+    )
+    assert await first.get_data() == await second.get_data()
+    assert chat_bp.semantic_cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_request_coalescing(client, snapshot):
+    chat_bp = client.app.blueprints["chat"]
+    chat_bp.request_coalescer = RequestCoalescer()
+    request_json = {"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+    responses = await asyncio.gather(*(client.post("/chat/stream", json=request_json) for _ in range(3)))
+    results = [await response.get_data() for response in responses]
+    assert results[0] == results[1] == results[2]
+    snapshot.assert_match(results[0], "result.jsonlines")
+    assert chat_bp.request_coalescer.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_client_disconnect_closes_upstream(client, monkeypatch):
+    chat_bp = client.app.blueprints["chat"]
+    upstream_closed = asyncio.Event()
+    next_event = asyncio.Event()
+
+    class SlowResponseStream:
+        def __init__(self):
+            self.sent = 0
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if self.sent:
+                # Never produces a second event: the client has to go away first
+                await next_event.wait()
+            self.sent += 1
+            return mock.Mock(type="response.output_text.delta", delta="The")
+
+        async def close(self):
+            upstream_closed.set()
+
+    async def slow_create(*args, **kwargs):
+        return SlowResponseStream()
+
+    monkeypatch.setattr(chat_bp.openai_client.responses, "create", slow_create)
+
+    body = json.dumps({"messages": [{"role": "user", "content": "What is the capital of France?"}]}).encode()
+    async with client.request(
+        "/chat/stream", method="POST", headers={"Content-Type": "application/json"}
+    ) as connection:
+        await connection.send(body)
+        await connection.send_complete()
+        assert json.loads(await connection.receive()) == {"delta": {"content": "The"}}
+        await connection.disconnect()
+        await asyncio.wait_for(upstream_closed.wait(), timeout=5)
+
+    assert chat_bp.cancelled_streams == 1
+    assert chat_bp.output_tokens_saved == chat.MAX_OUTPUT_TOKENS - 1
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_upstream_failure_isnt_cancelled(client, monkeypatch):
+    chat_bp = client.app.blueprints["chat"]
+    upstream_closed = asyncio.Event()
+
+    class FailingResponseStream:
+        def __init__(self):
+            self.events = [
+                mock.Mock(type="response.output_text.delta", delta="The"),
+                mock.Mock(type="response.incomplete"),
+            ]
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if not self.events:
+                raise StopAsyncIteration
+            return self.events.pop(0)
+
+        async def close(self):
+            upstream_closed.set()
+
+    async def failing_create(*args, **kwargs):
+        return FailingResponseStream()
+
+    monkeypatch.setattr(chat_bp.openai_client.responses, "create", failing_create)
+    response = await client.post(
+        "/chat/stream", json={"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+    )
+    await response.get_data()
+    assert upstream_closed.is_set()
+    # The client didn't go away, so nothing was saved
+    assert chat_bp.cancelled_streams == 0
+    assert chat_bp.output_tokens_saved == 0
+
+
+@pytest.mark.asyncio
+async def test_openai_client_uses_shared_http_client(monkeypatch):
+    with mock.patch.dict(os.environ, clear=True):
+        monkeypatch.setenv("LOCAL_OPENAI_ENDPOINT", "http://localhost:8080")
+        monkeypatch.setenv("OPENAI_HTTP_MAX_CONNECTIONS", "42")
+
+        quart_app = quartapp.create_app()
+
+        async with quart_app.test_app():
+            chat_bp = quart_app.blueprints["chat"]
+            assert chat_bp.openai_client._client is chat_bp.http_client
+            assert chat_bp.http_client._transport._pool._max_connections == 42
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_coalesced(client, snapshot):
+    client.app.blueprints["chat"].stream_coalescing = (1024, 0.02)
+    response = await client.post(
+        "/chat/stream",
+        json={"messages": [{"role": "user", "content": "What is the capital of France?"}]},
+    )
+    assert response.status_code == 200
+    result = await response.get_data()
+    snapshot.assert_match(result, "result.jsonlines")
+
+
+@pytest.mark.asyncio
+async def test_metrics(client):
+    response = await client.get("/metrics")
+    assert response.status_code == 404
+
+    chat.bp.request_metrics = RequestMetrics()
+    chat.register_stats(chat.bp.request_metrics)
+    response = await client.post(
+        "/chat/stream",
+        json={"messages": [{"role": "user", "content": "What is the capital of France?"}]},
+    )
+    result = await response.get_data()
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    exposition = await response.get_data(as_text=True)
+    pid = os.getpid()
+    for span in ("request_parse", "token", "upstream_connect", "first_event", "time_to_first_token", "completion"):
+        assert f'chat_span_seconds_count{{span="{span}",pid="{pid}"}} 1' in exposition
+    # 6 deltas, so 5 gaps between them
+    assert f'chat_inter_token_seconds_count{{pid="{pid}"}} 5' in exposition
+    assert f'chat_requests_total{{outcome="completed",pid="{pid}"}} 1' in exposition
+    assert f'chat_response_bytes_total{{pid="{pid}"}} {len(result)}' in exposition
+    assert f'chat_backend_requests{{backend="default",pid="{pid}"}} 1' in exposition
+    assert f'chat_token_refreshes{{pid="{pid}"}} 1' in exposition
+    assert f'chat_http_pool_queued_requests{{pid="{pid}"}} 0' in exposition
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_rate_limited(client):
+    client.app.blueprints["chat"].rate_limiter = RateLimiter(MemoryRateLimitBackend(), tokens_per_minute_per_user=1500)
+    request_json = {
+        "messages": [
+            {"role": "user", "content": "Tell me a long story. " * 200},
+            {"role": "assistant", "content": "Once upon a time."},
+            {"role": "user", "content": "What is the capital of France?"},
+        ]
+    }
+    response = await client.post("/chat/stream", json=request_json)
+    assert response.status_code == 200
+    await response.get_data()
+
+    response = await client.post("/chat/stream", json=request_json)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert "error" in await response.get_json()
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_admission_backs_off_when_throttled(client, monkeypatch):
+    chat_bp = client.app.blueprints["chat"]
+    chat_bp.admission_controller = AdmissionController(initial_limit=8)
+
+    async def throttled_create(*args, **kwargs):
+        request = httpx.Request("POST", "https://test-openai-service.openai.azure.com/openai/v1/responses")
+        raise openai.RateLimitError("Too many requests", response=httpx.Response(429, request=request), body=None)
+
+    monkeypatch.setattr(chat_bp.openai_client.responses, "create", throttled_create)
+    response = await client.post(
+        "/chat/stream", json={"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+    )
+    assert "error" in json.loads(await response.get_data())
+    assert chat_bp.admission_controller.stats() == {
+        "limit": 4,
+        "in_flight": 0,
+        "queued": 0,
+        "admitted": 1,
+        "shed": 0,
+        "throttled": 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_admission_sheds_load(client):
+    chat_bp = client.app.blueprints["chat"]
+    chat_bp.admission_controller = AdmissionController(initial_limit=1, queue_size=0)
+    ticket = await chat_bp.admission_controller.acquire()
+
+    request_json = {"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+    response = await client.post("/chat/stream", json=request_json)
+    assert json.loads(await response.get_data()) == {"error": "The service is busy, please try again in a moment"}
+
+    ticket.release()
+    response = await client.post("/chat/stream", json=request_json)
+    assert (await response.get_data(as_text=True)).endswith('"finish_reason": "stop"}\n')
+    assert chat_bp.admission_controller.stats()["shed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_openai_backend_pool(monkeypatch, mock_openai_responses, mock_defaultazurecredential):
+    with mock.patch.dict(os.environ, clear=True):
+        monkeypatch.setenv("OPENAICOM_API_KEY", "test-key")
+        monkeypatch.setenv(
+            "OPENAI_BACKENDS",
+            json.dumps(
+                [
+                    {"type": "azure", "endpoint": "https://east.openai.azure.com", "deployment": "gpt-east"},
+                    {"type": "openai", "model": "gpt-4o-mini", "name": "openai", "weight": 2},
+                ]
+            ),
+        )
+
+        quart_app = quartapp.create_app()
+
+        async with quart_app.test_app() as test_app:
+            chat_bp = quart_app.blueprints["chat"]
+            east, openaicom = chat_bp.backend_pool.backends
+            assert east.client.base_url == "https://east.openai.azure.com/openai/v1/"
+            assert openaicom.client.api_key == "test-key"
+            assert chat_bp.openai_client is east.client
+            assert chat_bp.openai_model_arg == "gpt-east"
+
+            async def throttled_create(*args, **kwargs):
+                request = httpx.Request("POST", "https://east.openai.azure.com/openai/v1/responses")
+                raise openai.RateLimitError(
+                    "Too many requests", response=httpx.Response(429, request=request), body=None
+                )
+
+            monkeypatch.setattr(east.client.responses, "create", throttled_create)
+            response = await test_app.test_client().post(
+                "/chat/stream", json={"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+            )
+            result = await response.get_data(as_text=True)
+            assert "error" not in result
+            assert result.endswith('"finish_reason": "stop"}\n')
+
+            stats = chat_bp.backend_pool.stats()
+            assert stats["azure-0"]["healthy"] is False
+            assert stats["azure-0"]["ejections"] == 1
+            assert stats["openai"]["healthy"] is True
+            assert stats["openai"]["requests"] == 1
+            assert stats["openai"]["avg_first_token_latency_seconds"] is not None
+
+
+@pytest.mark.asyncio
+async def test_openai_backend_pool_fails_over_without_retrying(monkeypatch):
+    requests = []
+
+    def upstream(request):
+        requests.append(request.url.host)
+        if request.url.host == "east.test":
+            return httpx.Response(429, headers={"Retry-After": "30"}, json={"error": {"message": "Too many requests"}})
+        events = [
+            {"type": "response.output_text.delta", "delta": "Paris", "sequence_number": 1},
+            {"type": "response.completed", "sequence_number": 2, "response": {"id": "resp", "output": []}},
+        ]
+        body = "".join(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n" for event in events)
+        return httpx.Response(200, headers={"Content-Type": "text/event-stream"}, text=body)
+
+    monkeypatch.setattr(
+        chat, "create_http_client", lambda: openai.DefaultAsyncHttpxClient(transport=httpx.MockTransport(upstream))
+    )
+    with mock.patch.dict(os.environ, clear=True):
+        monkeypatch.setenv(
+            "OPENAI_BACKENDS",
+            json.dumps(
+                [
+                    {"type": "local", "endpoint": "http://east.test/v1", "name": "east", "weight": 2},
+                    {"type": "local", "endpoint": "http://west.test/v1", "name": "west"},
+                ]
+            ),
+        )
+
+        quart_app = quartapp.create_app()
+
+        async with quart_app.test_app() as test_app:
+            chat_bp = quart_app.blueprints["chat"]
+            assert [backend.client.max_retries for backend in chat_bp.backend_pool.backends] == [0, 0]
+            response = await test_app.test_client().post(
+                "/chat/stream", json={"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+            )
+            result = await response.get_data(as_text=True)
+
+    assert result.endswith('"finish_reason": "stop"}\n')
+    assert "Paris" in result
+    # The throttled backend got a single request, without waiting for its Retry-After
+    assert requests == ["east.test", "west.test"]
+
+
+@pytest.mark.asyncio
+async def test_azure_openai_token_prefetched(client):
+    chat_bp = client.app.blueprints["chat"]
+    # The token was fetched before serving, so requests don't wait for the credential
+    assert chat_bp.token_manager.refreshes == 1
+    assert await chat_bp.token_manager.get_token() == "mock-token"
+    response = await client.post(
+        "/chat/stream", json={"messages": [{"role": "user", "content": "What is the capital of France?"}]}
+    )
+    await response.get_data()
+    assert chat_bp.token_manager.refreshes == 1
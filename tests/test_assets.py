@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+
+import pytest
+from werkzeug.datastructures import Accept
+
+import quartapp
+from quartapp.assets import (
+    IMMUTABLE_CACHE_CONTROL,
+    STATIC_DIR,
+    VENDORED_ASSETS,
+    AssetManifest,
+    build_assets,
+    read_vendored_hashes,
+    vendor_assets,
+    verify_vendored_assets,
+    write_vendored_hashes,
+)
+
+VENDORED_CONTENT = {
+    "vendor/marked.umd.js": b"var marked = {};\n" * 100,
+}
+
+
+@pytest.fixture
+def static_dir(tmp_path):
+    (tmp_path / "styles.css").write_text("body { color: black; }\n" * 100)
+    (tmp_path / "vendor").mkdir()
+    for name, content in VENDORED_CONTENT.items():
+        (tmp_path / name).write_bytes(content)
+    write_vendored_hashes(
+        {name: hashlib.sha256(content).hexdigest() for name, content in VENDORED_CONTENT.items()}, str(tmp_path)
+    )
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG" + os.urandom(100))
+    return tmp_path
+
+
+@pytest.fixture
+def cdn(monkeypatch):
+    downloads = []
+
+    def urlopen(url, timeout):
+        downloads.append(url)
+        name = next(name for name, vendored_url in VENDORED_ASSETS.items() if vendored_url == url)
+        return io.BytesIO(VENDORED_CONTENT[name])
+
+    monkeypatch.setattr("urllib.request.urlopen", urlopen)
+    return downloads
+
+
+def test_build_assets(static_dir):
+    manifest = build_assets(str(static_dir))
+    assert set(manifest) == {"styles.css", "logo.png", *VENDORED_ASSETS}
+    built = static_dir / "dist" / manifest["styles.css"]
+    assert built.read_bytes() == (static_dir / "styles.css").read_bytes()
+    assert gzip.decompress((static_dir / "dist" / (manifest["styles.css"] + ".gz")).read_bytes()) == built.read_bytes()
+    # Images are already compressed
+    assert not (static_dir / "dist" / (manifest["logo.png"] + ".gz")).exists()
+    assert json.loads((static_dir / "dist" / "manifest.json").read_text()) == manifest
+
+    # The name only changes with the content, and a rebuild doesn't pick up its own output
+    assert build_assets(str(static_dir)) == manifest
+    (static_dir / "styles.css").write_text("body { color: red; }\n")
+    assert build_assets(str(static_dir))["styles.css"] != manifest["styles.css"]
+
+
+def test_manifest_urls(static_dir):
+    manifest = build_assets(str(static_dir))
+    assets = AssetManifest.load(str(static_dir))
+    assert assets.url("styles.css") == f"/assets/{manifest['styles.css']}"
+    assert assets.url("vendor/marked.umd.js") == f"/assets/{manifest['vendor/marked.umd.js']}"
+    # Without a build, assets are served from /static, vendored libraries included
+    unbuilt = AssetManifest.load(str(static_dir / "vendor"))
+    assert unbuilt.url("styles.css") == "/static/styles.css"
+    assert unbuilt.url("vendor/marked.umd.js") == "/static/vendor/marked.umd.js"
+
+
+def test_vendor_assets_pins_new_libraries(tmp_path, cdn):
+    assert vendor_assets(str(tmp_path)) == list(VENDORED_ASSETS)
+    assert read_vendored_hashes(str(tmp_path)) == {
+        name: hashlib.sha256(content).hexdigest() for name, content in VENDORED_CONTENT.items()
+    }
+    verify_vendored_assets(str(tmp_path))
+    # Libraries already vendored aren't downloaded again
+    assert vendor_assets(str(tmp_path)) == []
+    assert len(cdn) == len(VENDORED_ASSETS)
+
+
+def test_vendor_assets_checks_pinned_hashes(tmp_path, cdn):
+    (tmp_path / "vendor").mkdir()
+    write_vendored_hashes({name: "0" * 64 for name in VENDORED_ASSETS}, str(tmp_path))
+    with pytest.raises(ValueError, match="is pinned"):
+        vendor_assets(str(tmp_path))
+    assert not (tmp_path / "vendor" / "marked.umd.js").exists()
+
+
+def test_vendored_assets_are_committed():
+    # The build fails without them, and the page doesn't work without a build
+    verify_vendored_assets(STATIC_DIR)
+
+
+def test_build_checks_vendored_assets(static_dir):
+    (static_dir / "vendor" / "marked.umd.js").write_text("var marked = tampered;\n")
+    with pytest.raises(ValueError, match="is pinned"):
+        build_assets(str(static_dir))
+    (static_dir / "vendor" / "marked.umd.js").unlink()
+    with pytest.raises(ValueError, match="isn't vendored"):
+        build_assets(str(static_dir))
+
+
+def test_manifest_encodings(static_dir):
+    manifest = build_assets(str(static_dir))
+    assets = AssetManifest.load(str(static_dir))
+    built_name = manifest["styles.css"]
+    asset, encoding = assets.get(built_name, Accept([("gzip", 1), ("deflate", 1)]))
+    assert encoding == "gzip"
+    assert asset.etag("gzip") != asset.etag("identity")
+    assert assets.get(built_name, Accept([]))[1] == "identity"
+    assert assets.get(built_name, Accept([("gzip", 0)]))[1] == "identity"
+    assert assets.get("styles.css", Accept([])) is None
+
+
+@pytest.mark.asyncio
+async def test_serve_asset(static_dir, client):
+    manifest = build_assets(str(static_dir))
+    quartapp.chat.bp.asset_manifest = AssetManifest.load(str(static_dir))
+    async with client.app.app_context():
+        await quartapp.chat.prerender_index()
+    url = f"/assets/{manifest['styles.css']}"
+
+    response = await client.get("/")
+    assert url in await response.get_data(as_text=True)
+
+    response = await client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == IMMUTABLE_CACHE_CONTROL
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.mimetype == "text/css"
+    assert gzip.decompress(await response.get_data()) == (static_dir / "styles.css").read_bytes()
+
+    response = await client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert await response.get_data() == b""
+
+    response = await client.get(url, headers={"If-None-Match": '"stale"'})
+    assert response.status_code == 200
+    assert "Content-Encoding" not in response.headers
+
+    response = await client.get("/assets/styles.css")
+    assert response.status_code == 404
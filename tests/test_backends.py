@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from quartapp.backends import Backend, BackendPool, get_backend_configs
+
+
+def make_backends(*weights):
+    return [Backend(f"backend-{i}", client=None, model="gpt", weight=weight) for i, weight in enumerate(weights)]
+
+
+def test_least_outstanding_routing():
+    backends = make_backends(1, 2)
+    pool = BackendPool(backends)
+    backends[0].outstanding = 1
+    backends[1].outstanding = 1
+    # Relative to its weight, the second backend is less loaded
+    assert pool.choose() is backends[1]
+    backends[1].outstanding = 3
+    assert pool.choose() is backends[0]
+
+
+def test_idle_pool_is_used_round_robin():
+    backends = make_backends(1, 1, 1)
+    pool = BackendPool(backends)
+    chosen = []
+    for _ in range(6):
+        backend = pool.choose()
+        backend.requests += 1
+        chosen.append(backend.name)
+    assert chosen == ["backend-0", "backend-1", "backend-2"] * 2
+
+
+def test_weighted_routing():
+    backends = make_backends(3, 1)
+    pool = BackendPool(backends, strategy="weighted", rng=random.Random(0))
+    chosen = [pool.choose().name for _ in range(1000)]
+    assert 700 < chosen.count("backend-0") < 800
+
+
+def test_ejected_backend_comes_back_after_cooldown(clock):
+    backends = make_backends(1, 1)
+    pool = BackendPool(backends, cooldown=30, clock=clock)
+    pool.eject(backends[0])
+    assert pool.choose() is backends[1]
+    assert pool.stats()["backend-0"]["healthy"] is False
+    clock.now = 30
+    backends[1].outstanding = 1
+    assert pool.choose() is backends[0]
+    assert pool.stats()["backend-0"] == {
+        "healthy": True,
+        "outstanding": 0,
+        "requests": 0,
+        "failures": 1,
+        "ejections": 1,
+        "avg_first_token_latency_seconds": None,
+    }
+
+
+def test_all_ejected_uses_the_one_back_soonest(clock):
+    backends = make_backends(1, 1)
+    pool = BackendPool(backends, cooldown=30, clock=clock)
+    pool.eject(backends[1])
+    clock.now = 10
+    pool.eject(backends[0])
+    assert pool.choose() is backends[1]
+    assert pool.choose(exclude=[backends[1]]) is backends[0]
+    assert pool.choose(exclude=backends) is None
+
+
+def test_first_token_latency():
+    backend = make_backends(1)[0]
+    backend.record_first_token(0.5)
+    backend.record_first_token(1.0)
+    assert backend.stats(now=0)["avg_first_token_latency_seconds"] == 0.75
+
+
+def test_backend_configs(monkeypatch):
+    monkeypatch.delenv("OPENAI_BACKENDS", raising=False)
+    assert get_backend_configs() is None
+    monkeypatch.setenv(
+        "OPENAI_BACKENDS",
+        '[{"type": "azure", "endpoint": "https://east.openai.azure.com", "deployment": "gpt-4o", "weight": 2},'
+        ' {"type": "local", "endpoint": "http://localhost:8080/v1", "name": "ollama"}]',
+    )
+    assert [config["name"] for config in get_backend_configs()] == ["azure-0", "ollama"]
+
+    monkeypatch.setenv("OPENAI_BACKENDS", '[{"type": "azure", "endpoint": "https://east.openai.azure.com"}]')
+    with pytest.raises(ValueError, match="missing 'deployment'"):
+        get_backend_configs()
+    monkeypatch.setenv("OPENAI_BACKENDS", '[{"type": "anthropic"}]')
+    with pytest.raises(ValueError, match="unknown type"):
+        get_backend_configs()
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        BackendPool(make_backends(1), strategy="random")
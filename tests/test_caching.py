@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from quartapp.caching import (
+    BruteForceIndex,
+    LSHIndex,
+    ResponseCache,
+    SemanticCache,
+    create_response_cache,
+    response_cache_key,
+)
+
+MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "What is the capital of France?"},
+]
+
+
+def test_response_cache_key_normalizes_messages():
+    key = response_cache_key("gpt-4o-mini", MESSAGES)
+    assert key == response_cache_key(
+        "gpt-4o-mini",
+        [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "  What is the capital of France?\n", "extra": "ignored"},
+        ],
+    )
+    assert key != response_cache_key(
+        "gpt-4o-mini", MESSAGES[:1] + [{"role": "user", "content": "What is the capital   of France?"}]
+    )
+    assert key != response_cache_key("gpt-4o", MESSAGES)
+    assert key != response_cache_key("gpt-4o-mini", MESSAGES[:1] + [{"role": "user", "content": "And Germany?"}])
+
+
+def test_response_cache_key_keeps_indentation():
+    code = "Fix this:\n```yaml\na:\n  b: 1\n```"
+    key = response_cache_key("gpt-4o-mini", [{"role": "user", "content": code}])
+    assert key != response_cache_key("gpt-4o-mini", [{"role": "user", "content": code.replace("  b", "b")}])
+    assert key != response_cache_key("gpt-4o-mini", [{"role": "user", "content": " ".join(code.split())}])
+
+
+def test_response_cache_eviction(clock):
+    cache = ResponseCache(maxsize=2, ttl=60, clock=clock)
+    cache.put("a", ["A"], 1.0)
+    cache.put("b", ["B"], 1.0)
+    assert cache.get("a").deltas == ["A"]
+    cache.put("c", ["C"], 1.0)
+    assert cache.get("b") is None
+    assert cache.get("c").deltas == ["C"]
+
+    clock.now = 61
+    assert cache.get("a") is None
+    assert len(cache) == 1
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["hit_rate"] == 0.5
+
+
+@pytest.mark.asyncio
+async def test_response_cache_replay():
+    cache = ResponseCache()
+    cache.put("a", ["The", " capital"], 2.0)
+    deltas = [delta async for delta in cache.replay(cache.get("a"))]
+    assert deltas == ["The", " capital", None]
+    assert 1.9 < cache.stats()["latency_saved_seconds"] <= 2.0
+
+
+def test_create_response_cache(monkeypatch):
+    monkeypatch.delenv("CHAT_RESPONSE_CACHE_ENABLED", raising=False)
+    assert create_response_cache() is None
+    monkeypatch.setenv("CHAT_RESPONSE_CACHE_ENABLED", "true")
+    monkeypatch.setenv("CHAT_RESPONSE_CACHE_SIZE", "10")
+    assert create_response_cache().maxsize == 10
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.mark.parametrize("index", [BruteForceIndex(), LSHIndex(dimensions=3, num_planes=2, num_tables=8)])
+def test_vector_index_search(index):
+    index.add("x", unit([1, 0, 0]))
+    index.add("y", unit([0, 1, 0]))
+    index.add("xy", unit([1, 1, 0]))
+    results = index.search(unit([1, 0.1, 0]), k=2)
+    assert results[0][0] == "x"
+    assert results[0][1] > 0.99
+    index.remove("x")
+    assert len(index) == 2
+    assert index.search(unit([1, 0.1, 0]))[0][0] == "xy"
+
+
+async def fake_embed(text):
+    return {"capital of france": [1, 0, 0], "france capital": [0.98, 0.2, 0], "pizza": [0, 0, 1]}[text]
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache(clock):
+    cache = SemanticCache(fake_embed, threshold=0.95, maxsize=2, ttl=60, clock=clock)
+    vector = await cache.embed_question([{"role": "user", "content": "capital of france"}])
+    assert cache.get("gpt-4o-mini", vector) is None
+    cache.put("gpt-4o-mini", vector, ["Paris"], 1.0)
+
+    similar = await cache.embed_question([{"role": "user", "content": "france capital"}])
+    assert cache.get("gpt-4o-mini", similar).deltas == ["Paris"]
+    assert cache.get("gpt-4o", similar) is None
+    different = await cache.embed_question([{"role": "user", "content": "pizza"}])
+    assert cache.get("gpt-4o-mini", different) is None
+    assert cache.stats()["hits"] == 1
+
+    clock.now = 61
+    assert cache.get("gpt-4o-mini", similar) is None
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_skips_follow_up_questions():
+    cache = SemanticCache(fake_embed)
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "pizza"},
+        {"role": "assistant", "content": "Pizza is great."},
+        {"role": "user", "content": "capital of france"},
+    ]
+    assert await cache.embed_question(messages) is None
+    assert await cache.embed_question(messages[:2]) is not None
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from quartapp.coalescing import RequestCoalescer
+
+
+class FakeUpstream:
+    def __init__(self, items, error=None):
+        self.items = items
+        self.error = error
+        self.opened = 0
+        self.release = asyncio.Event()
+
+    async def stream(self):
+        self.opened += 1
+        for item in self.items:
+            await self.release.wait()
+            yield item
+        if self.error:
+            raise self.error
+
+
+async def collect(stream, limit=None):
+    items = []
+    async for item in stream:
+        items.append(item)
+        if limit and len(items) == limit:
+            await stream.aclose()
+            break
+    return items
+
+
+@pytest.mark.asyncio
+async def test_concurrent_subscribers_share_one_stream():
+    coalescer = RequestCoalescer()
+    upstream = FakeUpstream(["The", " capital", None])
+    first = asyncio.create_task(collect(coalescer.subscribe("key", upstream.stream)))
+    second = asyncio.create_task(collect(coalescer.subscribe("key", upstream.stream)))
+    other_upstream = FakeUpstream([None])
+    other = asyncio.create_task(collect(coalescer.subscribe("other", other_upstream.stream)))
+    await asyncio.sleep(0)
+    upstream.release.set()
+    other_upstream.release.set()
+
+    assert await first == ["The", " capital", None]
+    assert await second == ["The", " capital", None]
+    await other
+    assert upstream.opened == 1
+    assert coalescer.stats() == {"in_flight": 0, "leaders": 2, "followers": 1}
+
+
+@pytest.mark.asyncio
+async def test_subscriber_leaving_does_not_cancel_others():
+    coalescer = RequestCoalescer()
+    upstream = FakeUpstream(["a", "b", "c", None])
+    quitter = asyncio.create_task(collect(coalescer.subscribe("key", upstream.stream), limit=1))
+    stayer = asyncio.create_task(collect(coalescer.subscribe("key", upstream.stream)))
+    await asyncio.sleep(0)
+    upstream.release.set()
+
+    assert await quitter == ["a"]
+    assert await stayer == ["a", "b", "c", None]
+
+
+@pytest.mark.asyncio
+async def test_late_subscriber_gets_items_from_the_start():
+    coalescer = RequestCoalescer()
+    items = asyncio.Queue()
+
+    async def upstream():
+        while (item := await items.get()) is not None:
+            yield item
+        yield None
+
+    first = coalescer.subscribe("key", upstream)
+    items.put_nowait("a")
+    assert await anext(first) == "a"
+    late = asyncio.create_task(collect(coalescer.subscribe("key", upstream)))
+    await asyncio.sleep(0)
+    items.put_nowait("b")
+    items.put_nowait(None)
+    assert await collect(first) == ["b", None]
+    assert await late == ["a", "b", None]
+    assert coalescer.stats()["leaders"] == 1
+
+
+@pytest.mark.asyncio
+async def test_upstream_error_reaches_every_subscriber():
+    coalescer = RequestCoalescer()
+    upstream = FakeUpstream(["a"], error=ValueError("upstream failed"))
+    first = asyncio.create_task(collect(coalescer.subscribe("key", upstream.stream)))
+    second = asyncio.create_task(collect(coalescer.subscribe("key", upstream.stream)))
+    await asyncio.sleep(0)
+    upstream.release.set()
+
+    for task in (first, second):
+        with pytest.raises(ValueError, match="upstream failed"):
+            await task
+    assert len(coalescer) == 0
+
+
+@pytest.mark.asyncio
+async def test_upstream_cancelled_when_all_subscribers_leave():
+    coalescer = RequestCoalescer()
+    closed = asyncio.Event()
+
+    async def upstream():
+        try:
+            yield "a"
+            await asyncio.Event().wait()
+            yield None
+        finally:
+            closed.set()
+
+    stream = coalescer.subscribe("key", upstream)
+    assert await anext(stream) == "a"
+    await stream.aclose()
+    await asyncio.wait_for(closed.wait(), timeout=1)
+    assert len(coalescer) == 0
@@ -0,0 +1,78 @@
+import pytest
+
+from quartapp.conversations import KeyValueConversationStore, MemoryConversationStore, get_conversation_store_type
+
+MESSAGES = [
+    {"role": "user", "content": "What is the capital of France?"},
+    {"role": "assistant", "content": "The capital of France is Paris."},
+]
+
+
+class FakeKeyValueClient:
+    def __init__(self):
+        self.values = {}
+        self.closed = False
+
+    async def get(self, key):
+        return self.values.get(key, (None, None))[0]
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = (value, ex)
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_memory_store_ttl(clock):
+    store = MemoryConversationStore(ttl=60, clock=clock)
+    await store.set("abc", MESSAGES)
+    assert await store.get("abc") == MESSAGES
+    assert await store.get("missing") is None
+
+    clock.now = 61
+    assert await store.get("abc") is None
+    assert len(store) == 0
+
+
+@pytest.mark.asyncio
+async def test_memory_store_lru():
+    store = MemoryConversationStore(maxsize=2)
+    await store.set("first", MESSAGES[:1])
+    await store.set("second", MESSAGES[:1])
+    await store.get("first")
+    await store.set("third", MESSAGES[:1])
+    assert await store.get("second") is None
+    assert await store.get("first") == MESSAGES[:1]
+    assert await store.get("third") == MESSAGES[:1]
+
+
+@pytest.mark.asyncio
+async def test_memory_store_returns_copies():
+    store = MemoryConversationStore()
+    await store.set("abc", MESSAGES)
+    messages = await store.get("abc")
+    messages.append({"role": "user", "content": "And Germany?"})
+    assert await store.get("abc") == MESSAGES
+
+
+@pytest.mark.asyncio
+async def test_key_value_store():
+    client = FakeKeyValueClient()
+    store = KeyValueConversationStore(client, ttl=120)
+    await store.set("abc", MESSAGES)
+    assert client.values["conversation:abc"][1] == 120
+    assert await store.get("abc") == MESSAGES
+    assert await store.get("missing") is None
+    await store.close()
+    assert client.closed
+
+
+def test_conversation_store_type(monkeypatch):
+    monkeypatch.delenv("CHAT_CONVERSATION_STORE", raising=False)
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    assert get_conversation_store_type() == "none"
+    monkeypatch.setenv("REDIS_URL", "redis://localhost")
+    assert get_conversation_store_type() == "redis"
+    monkeypatch.setenv("CHAT_CONVERSATION_STORE", "Memory")
+    assert get_conversation_store_type() == "memory"
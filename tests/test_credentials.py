@@ -0,0 +1,188 @@
+import asyncio
+import time
+
+import pytest
+from azure.core.credentials import AccessToken
+from azure.core.exceptions import ClientAuthenticationError
+
+from quartapp import credentials
+from quartapp.credentials import (
+    OTHER_CLIENT_ID_SETTINGS,
+    BearerTokenManager,
+    ProbedCredentialChain,
+    create_azure_credential,
+    get_credential_chain,
+)
+
+
+class FakeCredential:
+    def __init__(self, lifetime=3600, delay=0, error=None):
+        self.lifetime = lifetime
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return AccessToken(f"token-{self.calls}", time.time() + self.lifetime)
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_start_prefetches_the_token():
+    credential = FakeCredential()
+    manager = BearerTokenManager(credential)
+    await manager.start()
+    try:
+        assert await manager() == "token-1"
+        assert await manager.get_token() == "token-1"
+        assert credential.calls == 1
+        stats = manager.stats()
+        assert stats["refreshes"] == 1
+        assert stats["token_age_seconds"] < 1
+        assert 3590 < stats["expires_in_seconds"] <= 3600
+        assert stats["last_refresh_seconds"] is not None
+    finally:
+        await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_fetch():
+    credential = FakeCredential(delay=0.05)
+    manager = BearerTokenManager(credential)
+    tokens = await asyncio.gather(*(manager.get_token() for _ in range(10)))
+    assert tokens == ["token-1"] * 10
+    assert credential.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_expired_token_is_fetched_again():
+    credential = FakeCredential(lifetime=credentials.EXPIRY_SKEW - 1)
+    manager = BearerTokenManager(credential)
+    assert await manager.get_token() == "token-1"
+    assert await manager.get_token() == "token-2"
+
+
+@pytest.mark.asyncio
+async def test_refresh_is_jittered_before_expiry():
+    manager = BearerTokenManager(FakeCredential(), refresh_margin=300, jitter=60)
+    await manager.refresh()
+    delays = [manager.next_refresh_delay() for _ in range(100)]
+    assert all(3600 - 360 - 1 < delay <= 3600 - 300 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+@pytest.mark.asyncio
+async def test_refreshes_in_background(monkeypatch):
+    monkeypatch.setattr(credentials, "MIN_REFRESH_DELAY", 0.01)
+    credential = FakeCredential(lifetime=300.02)
+    manager = BearerTokenManager(credential, refresh_margin=300, jitter=0)
+    await manager.start()
+    try:
+        await asyncio.sleep(0.2)
+        assert credential.calls > 1
+        assert await manager.get_token() == f"token-{credential.calls}"
+    finally:
+        await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_prefetch_failure_does_not_stop_startup():
+    credential = FakeCredential(error=RuntimeError("No credential available"))
+    manager = BearerTokenManager(credential)
+    await manager.start()
+    try:
+        assert manager.stats()["refresh_failures"] == 1
+        with pytest.raises(RuntimeError):
+            await manager.get_token()
+        credential.error = None
+        assert await manager.get_token() == "token-3"
+    finally:
+        await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_chain_remembers_the_source_that_worked():
+    cli = FakeCredential(error=ClientAuthenticationError("Not logged in"))
+    managed_identity = FakeCredential()
+    chain = ProbedCredentialChain([("azure_cli", cli), ("managed_identity", managed_identity)])
+    assert (await chain.get_token("scope")).token == "token-1"
+    assert (await chain.get_token("scope")).token == "token-2"
+    assert cli.calls == 1
+    stats = chain.stats()
+    assert stats["selected"] == "managed_identity"
+    assert [(probe["source"], probe["succeeded"]) for probe in stats["probes"]] == [
+        ("azure_cli", False),
+        ("managed_identity", True),
+    ]
+
+    # If the remembered source stops working, the chain is probed again
+    managed_identity.error = ClientAuthenticationError("Identity removed")
+    cli.error = None
+    assert (await chain.get_token("scope")).token == "token-2"
+    assert chain.stats()["selected"] == "azure_cli"
+
+
+@pytest.mark.asyncio
+async def test_chain_fails_when_no_source_works():
+    chain = ProbedCredentialChain([("azure_cli", FakeCredential(error=ClientAuthenticationError("Not logged in")))])
+    with pytest.raises(ClientAuthenticationError, match="azure_cli: Not logged in"):
+        await chain.get_token("scope")
+
+
+def test_credential_chain_settings(monkeypatch):
+    monkeypatch.delenv("AZURE_CREDENTIAL_CHAIN", raising=False)
+    for name in ("AZURE_CLIENT_ID",) + OTHER_CLIENT_ID_SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+    assert get_credential_chain() == ["default"]
+    monkeypatch.setenv("AZURE_CLIENT_ID", "client-id")
+    assert get_credential_chain() == ["managed_identity"]
+    # A service principal or workload identity also sets AZURE_CLIENT_ID
+    for name in ("AZURE_CLIENT_SECRET", "AZURE_FEDERATED_TOKEN_FILE"):
+        monkeypatch.setenv(name, "value")
+        assert get_credential_chain() == ["default"]
+        monkeypatch.delenv(name)
+    monkeypatch.setenv("AZURE_CREDENTIAL_CHAIN", "Azure_CLI, managed_identity")
+    assert get_credential_chain() == ["azure_cli", "managed_identity"]
+    monkeypatch.setenv("AZURE_CREDENTIAL_CHAIN", "azure_cli,shared_token_cache")
+    with pytest.raises(ValueError, match="shared_token_cache"):
+        get_credential_chain()
+
+
+def test_managed_identity_is_pinned_with_client_id(monkeypatch):
+    created = []
+
+    class RecordingCredential:
+        def __init__(self, **kwargs):
+            created.append(kwargs)
+
+    monkeypatch.delenv("AZURE_CREDENTIAL_CHAIN", raising=False)
+    monkeypatch.setenv("AZURE_CLIENT_ID", "client-id")
+    monkeypatch.setattr("azure.identity.aio.ManagedIdentityCredential", RecordingCredential)
+    chain = create_azure_credential()
+    assert [name for name, _ in chain.sources] == ["managed_identity"]
+    assert created == [{"client_id": "client-id"}]
+
+
+def test_default_sources_are_probed_one_by_one(monkeypatch):
+    for name in ("AZURE_CREDENTIAL_CHAIN", "AZURE_CLIENT_ID") + OTHER_CLIENT_ID_SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+
+    class EnvironmentCredential(FakeCredential):
+        pass
+
+    class AzureCliCredential(FakeCredential):
+        pass
+
+    class FakeDefaultAzureCredential:
+        def __init__(self, **kwargs):
+            self.credentials = (EnvironmentCredential(), AzureCliCredential())
+
+    monkeypatch.setattr("azure.identity.aio.DefaultAzureCredential", FakeDefaultAzureCredential)
+    chain = create_azure_credential()
+    assert [name for name, _ in chain.sources] == ["environment", "azure_cli"]
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from quartapp import frames
+from quartapp.frames import StdlibFrames, get_frame_serializer
+
+TRICKY_STRINGS = [
+    "",
+    " capital",
+    'He said "Paris"',
+    "back\\slash",
+    "line\nbreak\r\n\ttab",
+    "".join(chr(i) for i in range(0x20)) + "\x7f",
+    "café, 東京, emoji 🎉, separators   ",
+    "</script><!--",
+]
+
+SERIALIZERS = ["stdlib", "template"] + (["orjson"] if frames.orjson is not None else [])
+
+
+@pytest.mark.parametrize("name", SERIALIZERS)
+@pytest.mark.parametrize("content", TRICKY_STRINGS)
+def test_frames_match_json_dumps(name, content):
+    serializer = get_frame_serializer(name)
+    assert serializer.delta(content) == json.dumps({"delta": {"content": content}}, ensure_ascii=False) + "\n"
+    assert serializer.error(content) == json.dumps({"error": content}, ensure_ascii=False) + "\n"
+    assert serializer.finish() == StdlibFrames.finish()
+
+
+def test_finish_frame():
+    assert get_frame_serializer().finish() == '{"delta": {"content": null}, "finish_reason": "stop"}\n'
+
+
+def test_get_frame_serializer_unknown():
+    with pytest.raises(ValueError):
+        get_frame_serializer("pickle")
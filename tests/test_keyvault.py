@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+
+import pytest
+from azure.keyvault.secrets.aio import SecretClient
+
+from quartapp.keyvault import KeyVaultSecretProvider, get_secret_cache_path
+
+from . import mock_cred
+
+
+@pytest.fixture
+def clock(clock):
+    # Far enough from 0 that a cached secret without its fetch time is stale
+    clock.now = 1000.0
+    return clock
+
+
+@pytest.fixture
+def key_vault(monkeypatch):
+    state = {"value": "key-1", "calls": 0}
+
+    async def get_secret(self, name):
+        state["calls"] += 1
+        await asyncio.sleep(0.05)
+        return mock_cred.MockKeyVaultSecret(state["value"])
+
+    monkeypatch.setattr(SecretClient, "get_secret", get_secret)
+    return state
+
+
+def make_provider(cache_path, clock, refresh_interval=300):
+    return KeyVaultSecretProvider(
+        "https://my_key_vault.vault.azure.net",
+        "my_secret_name",
+        mock_cred.MockAzureCredential(),
+        cache_path=cache_path,
+        refresh_interval=refresh_interval,
+        clock=clock,
+    )
+
+
+@pytest.mark.asyncio
+async def test_workers_share_one_fetch(key_vault, tmp_path, clock):
+    cache_path = str(tmp_path / "secret.json")
+    workers = [make_provider(cache_path, clock) for _ in range(5)]
+    values = await asyncio.gather(*(worker() for worker in workers))
+    assert values == ["key-1"] * 5
+    assert key_vault["calls"] == 1
+    assert sum(worker.stats()["cache_reads"] for worker in workers) == 4
+    assert oct(os.stat(cache_path).st_mode & 0o777) == "0o600"
+
+
+@pytest.mark.asyncio
+async def test_rotated_secret_is_picked_up(key_vault, tmp_path, clock):
+    provider = make_provider(str(tmp_path / "secret.json"), clock)
+    assert await provider() == "key-1"
+
+    key_vault["value"] = "key-2"
+    await provider.load()
+    # The cached secret is still fresh
+    assert await provider() == "key-1"
+    clock.now += 300
+    await provider.load()
+    assert await provider() == "key-2"
+    assert key_vault["calls"] == 2
+
+
+@pytest.mark.asyncio
+async def test_refreshes_in_background(key_vault, clock):
+    provider = make_provider(None, clock, refresh_interval=0.05)
+    await provider.start()
+    try:
+        key_vault["value"] = "key-2"
+        await asyncio.sleep(0.3)
+        assert await provider() == "key-2"
+    finally:
+        await provider.close()
+
+
+@pytest.mark.asyncio
+async def test_refresh_failure_keeps_the_previous_secret(key_vault, monkeypatch, clock):
+    provider = make_provider(None, clock, refresh_interval=0.01)
+    await provider.start()
+
+    async def failing_get_secret(self, name):
+        raise RuntimeError("Key Vault unavailable")
+
+    monkeypatch.setattr(SecretClient, "get_secret", failing_get_secret)
+    try:
+        await asyncio.sleep(0.1)
+        assert await provider() == "key-1"
+        assert provider.stats()["refresh_failures"] > 0
+    finally:
+        await provider.close()
+
+
+def test_secret_cache_path(monkeypatch):
+    # Opt-in, as the file holds the secret
+    monkeypatch.delenv("KEY_VAULT_SECRET_CACHE_FILE", raising=False)
+    assert get_secret_cache_path() is None
+    monkeypatch.setenv("KEY_VAULT_SECRET_CACHE_FILE", "/run/quartapp/secret.json")
+    assert get_secret_cache_path() == "/run/quartapp/secret.json"
+    monkeypatch.setenv("KEY_VAULT_SECRET_CACHE_FILE", "none")
+    assert get_secret_cache_path() is None
+
+
+@pytest.mark.asyncio
+async def test_cache_that_others_can_access_is_ignored(key_vault, tmp_path, clock):
+    cache_path = tmp_path / "secret.json"
+    cache_path.write_text(json.dumps({"value": "planted", "fetched_at": clock()}))
+    cache_path.chmod(0o644)
+    assert await make_provider(str(cache_path), clock)() == "key-1"
+    # Replaced by the fetched secret, only readable by the app's user
+    assert oct(os.stat(cache_path).st_mode & 0o777) == "0o600"
+
+
+@pytest.mark.asyncio
+async def test_cache_symlink_is_not_followed(key_vault, tmp_path, clock):
+    target = tmp_path / "elsewhere.json"
+    target.write_text(json.dumps({"value": "planted", "fetched_at": clock()}))
+    target.chmod(0o600)
+    cache_path = tmp_path / "secret.json"
+    cache_path.symlink_to(target)
+    assert await make_provider(str(cache_path), clock)() == "key-1"
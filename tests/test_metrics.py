@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+
+from quartapp.metrics import Counter, Histogram, RequestMetrics, create_request_metrics
+
+
+def test_histogram_exposition():
+    histogram = Histogram("latency_seconds", "Latency", ("span",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "a")
+    histogram.observe(0.5, "a")
+    histogram.observe(5.0, "a")
+    histogram.observe(0.1, "b")
+    assert histogram.collect() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{span="a",le="0.1"} 1',
+        'latency_seconds_bucket{span="a",le="1.0"} 2',
+        'latency_seconds_bucket{span="a",le="+Inf"} 3',
+        'latency_seconds_sum{span="a"} 5.55',
+        'latency_seconds_count{span="a"} 3',
+        'latency_seconds_bucket{span="b",le="0.1"} 1',
+        'latency_seconds_bucket{span="b",le="1.0"} 1',
+        'latency_seconds_bucket{span="b",le="+Inf"} 1',
+        'latency_seconds_sum{span="b"} 0.1',
+        'latency_seconds_count{span="b"} 1',
+    ]
+
+
+def test_counter_exposition():
+    counter = Counter("requests_total", "Requests", ("outcome",))
+    counter.inc(1, "completed")
+    counter.inc(2, 'say "hi"')
+    assert counter.collect()[2:] == [
+        'requests_total{outcome="completed"} 1',
+        'requests_total{outcome="say \\"hi\\""} 2',
+    ]
+
+
+def test_request_timings(caplog, clock):
+    metrics = RequestMetrics(export=True, log_timings=True, clock=clock)
+    timings = metrics.start()
+    clock.now = 0.002
+    timings.since_start("request_parse")
+    timings.add("upstream_connect", 0.3)
+    clock.now = 0.5
+    timings.token()
+    frames = ['{"delta": {"content": "Paris"}}\n', '{"delta": {"content": "Élysée"}}\n']
+    timings.written(frames[0])
+    clock.now = 0.52
+    timings.token()
+    timings.written(frames[1])
+    clock.now = 0.6
+    with caplog.at_level(logging.INFO, logger="quartapp.timings"):
+        timings.finish("completed")
+        timings.finish("completed")
+
+    record = json.loads(caplog.records[-1].message)
+    assert len(caplog.records) == 1
+    assert record["outcome"] == "completed"
+    assert record["tokens"] == 2
+    assert record["bytes"] == len("".join(frames).encode()) == 67
+    assert record["request_parse_ms"] == 2.0
+    assert record["time_to_first_token_ms"] == 500.0
+    assert record["max_inter_token_ms"] == 20.0
+    assert record["total_ms"] == 600.0
+
+    exposition = metrics.render()
+    pid = os.getpid()
+    assert f'chat_span_seconds_count{{span="time_to_first_token",pid="{pid}"}} 1' in exposition
+    assert f'chat_inter_token_seconds_bucket{{pid="{pid}",le="0.025"}} 1' in exposition
+    assert f'chat_requests_total{{outcome="completed",pid="{pid}"}} 1' in exposition
+    assert f'chat_response_bytes_total{{pid="{pid}"}} 67' in exposition
+
+
+def test_registered_stats():
+    metrics = RequestMetrics()
+    metrics.register("cache", lambda: {"hits": 3, "hit_rate": 0.75, "model": "gpt", "age": None})
+    metrics.register("backend", lambda: {"east": {"healthy": True}, "west": {"healthy": False}}, label="backend")
+    exposition = metrics.render()
+    pid = os.getpid()
+    assert f'chat_cache_hits{{pid="{pid}"}} 3\n' in exposition
+    assert f'chat_cache_hit_rate{{pid="{pid}"}} 0.75\n' in exposition
+    assert "chat_cache_model" not in exposition
+    assert "chat_cache_age" not in exposition
+    assert (
+        f'chat_backend_healthy{{backend="east",pid="{pid}"}} 1\n'
+        f'chat_backend_healthy{{backend="west",pid="{pid}"}} 0\n'
+    ) in exposition
+
+
+def test_every_series_has_a_pid_label(clock):
+    metrics = RequestMetrics(clock=clock)
+    metrics.register("cache", lambda: {"hits": 3})
+    metrics.start().finish("completed")
+    samples = [line for line in metrics.render().splitlines() if not line.startswith("#")]
+    assert samples
+    assert all(f'pid="{os.getpid()}"' in line for line in samples)
+
+
+def test_create_request_metrics(monkeypatch):
+    monkeypatch.delenv("CHAT_METRICS_ENABLED", raising=False)
+    monkeypatch.delenv("CHAT_TIMING_LOGS", raising=False)
+    assert create_request_metrics() is None
+    monkeypatch.setenv("CHAT_METRICS_ENABLED", "true")
+    metrics = create_request_metrics()
+    assert metrics.export and not metrics.log_timings
+    monkeypatch.setenv("CHAT_METRICS_ENABLED", "false")
+    monkeypatch.setenv("CHAT_TIMING_LOGS", "true")
+    metrics = create_request_metrics()
+    assert not metrics.export and metrics.log_timings
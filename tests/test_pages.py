@@ -0,0 +1,28 @@
+import gzip
+
+from quartapp.pages import USERNAME_MARKER, PrerenderedPage
+
+
+def test_render_fills_in_the_username():
+    page = PrerenderedPage(f"<nav>{USERNAME_MARKER}</nav><strong>{USERNAME_MARKER}</strong>")
+    assert page.render("Ada").encodings == {"identity": b"<nav>Ada</nav><strong>Ada</strong>"}
+    assert page.render("<b>Eve</b>").encodings["identity"].startswith(b"<nav>&lt;b&gt;Eve&lt;/b&gt;</nav>")
+
+
+def test_etag():
+    page = PrerenderedPage(f"<nav>{USERNAME_MARKER}</nav>")
+    assert page.render("Ada").etag == page.etag("Ada")
+    assert page.etag("Ada") != page.etag("Eve")
+    # A new deployment's page gets new ETags
+    assert PrerenderedPage(f"<nav>{USERNAME_MARKER}</nav>!").etag("Ada") != page.etag("Ada")
+
+
+def test_compression_and_eviction():
+    page = PrerenderedPage(f"<nav>{USERNAME_MARKER}</nav>", compress=True, maxsize=2)
+    ada = page.render("Ada")
+    assert gzip.decompress(ada.encodings["gzip"]) == b"<nav>Ada</nav>"
+    page.render("Eve")
+    assert page.render("Ada") is ada
+    page.render("Bob")
+    # Eve was the least recently used
+    assert list(page._pages) == ["Ada", "Bob"]
@@ -0,0 +1,64 @@
+import base64
+import json
+
+import pytest
+
+from quartapp.principal import Principal, PrincipalParser
+
+
+def encode_principal(claims, **extra):
+    return base64.b64encode(json.dumps({"auth_typ": "aad", "claims": claims, **extra}).encode()).decode()
+
+
+HEADER = encode_principal(
+    [
+        {"typ": "name", "val": "Ada Lovelace"},
+        {"typ": "http://schemas.microsoft.com/identity/claims/objectidentifier", "val": "1234"},
+        {"typ": "roles", "val": "admin"},
+        {"typ": "roles", "val": "reader"},
+    ]
+)
+
+
+def test_principal_from_header():
+    principal = Principal.from_header(HEADER)
+    assert principal == Principal(name="Ada Lovelace", oid="1234", roles=("admin", "reader"))
+    assert not hasattr(principal, "__dict__")
+
+
+def test_principal_from_header_uses_declared_claim_types():
+    header = encode_principal(
+        [{"typ": "preferred_username", "val": "ada@example.com"}, {"typ": "app_role", "val": "admin"}],
+        name_typ="preferred_username",
+        role_typ="app_role",
+    )
+    assert Principal.from_header(header) == Principal(name="ada@example.com", roles=["admin"])
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        "not base64!",
+        base64.b64encode(b"not json").decode(),
+        base64.b64encode(b"[1, 2]").decode(),
+        encode_principal([{"type": "name"}]),
+        base64.b64encode(json.dumps({"auth_typ": "aad"}).encode()).decode(),
+    ],
+)
+def test_principal_from_malformed_header(header):
+    with pytest.raises(ValueError):
+        Principal.from_header(header)
+    assert PrincipalParser().parse(header) is None
+
+
+def test_principal_parser_cache():
+    parser = PrincipalParser(maxsize=1)
+    assert parser.parse(HEADER).name == "Ada Lovelace"
+    assert parser.parse(HEADER) is parser.parse(HEADER)
+    assert parser.stats() == {"size": 1, "hits": 2, "misses": 1}
+    assert parser.parse(None) is None
+
+    parser.parse(encode_principal([{"typ": "name", "val": "Grace Hopper"}]))
+    assert len(parser) == 1
+    parser.parse(HEADER)
+    assert parser.misses == 3
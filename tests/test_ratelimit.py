@@ -0,0 +1,148 @@
+import pytest
+
+from quartapp.ratelimit import (
+    SLOT_SCRIPT,
+    LeasedBody,
+    MemoryRateLimitBackend,
+    RateLimiter,
+    RateLimitExceeded,
+    RedisRateLimitBackend,
+    TokenBucket,
+)
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(capacity=60, rate=1, clock=clock)
+    assert bucket.take(50) == 0
+    assert bucket.take(20) == 10
+    clock.now = 10
+    assert bucket.take(20) == 0
+    bucket.refund(100)
+    assert bucket.tokens == 60
+
+
+def test_token_bucket_oversized_request(clock):
+    bucket = TokenBucket(capacity=60, rate=1, clock=clock)
+    # Bigger than the bucket: only allowed when it's full, and leaves it in debt
+    assert bucket.take(100) == 0
+    assert bucket.take(1) == 41
+
+
+@pytest.mark.asyncio
+async def test_concurrent_stream_limits():
+    limiter = RateLimiter(MemoryRateLimitBackend(), max_streams=3, max_streams_per_user=2)
+    first = await limiter.acquire("ada", 10)
+    await limiter.acquire("ada", 10)
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await limiter.acquire("ada", 10)
+    assert exc_info.value.retry_after == 1
+
+    await limiter.acquire("grace", 10)
+    with pytest.raises(RateLimitExceeded):
+        await limiter.acquire("alan", 10)
+    assert limiter.stats()["rejected"] == 2
+
+    await first.release()
+    await first.release()
+    await limiter.acquire("ada", 10)
+
+
+@pytest.mark.asyncio
+async def test_tokens_per_minute_limits(clock):
+    limiter = RateLimiter(MemoryRateLimitBackend(clock=clock), tokens_per_minute=900, tokens_per_minute_per_user=600)
+    lease = await limiter.acquire("ada", 500)
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await limiter.acquire("ada", 500)
+    # 400 more tokens are needed, at 10 tokens/second
+    assert exc_info.value.retry_after == 40
+
+    await limiter.acquire("grace", 300)
+    with pytest.raises(RateLimitExceeded):
+        await limiter.acquire("grace", 200)
+
+    # Unused tokens are given back to every bucket they were taken from
+    await lease.release(unused_tokens=400)
+    await limiter.acquire("ada", 400)
+
+
+@pytest.mark.asyncio
+async def test_full_buckets_are_evicted(clock):
+    backend = MemoryRateLimitBackend(clock=clock, evict_interval=60)
+    limiter = RateLimiter(backend, tokens_per_minute_per_user=600)
+    for user in ("ada", "grace", "alan"):
+        await limiter.acquire(user, 300)
+    assert len(backend._buckets) == 3
+
+    # After a minute, the idle buckets have refilled, and only the new user's bucket is left
+    clock.now = 61
+    await limiter.acquire("ada", 300)
+    clock.now = 62
+    await limiter.acquire("edsger", 300)
+    assert set(backend._buckets) == {"user:ada", "user:edsger"}
+
+
+@pytest.mark.asyncio
+async def test_leased_body_releases_on_close():
+    limiter = RateLimiter(MemoryRateLimitBackend(), max_streams_per_user=1)
+
+    async def frames():
+        yield "frame"
+
+    # Closed without ever being iterated, like the response of a client that went away right away
+    body = LeasedBody(frames(), await limiter.acquire("ada", 10))
+    await body.aclose()
+    body = LeasedBody(frames(), await limiter.acquire("ada", 10))
+    assert [frame async for frame in body] == ["frame"]
+    await body.aclose()
+    await limiter.acquire("ada", 10)
+
+
+class FakeRedisClient:
+    """Runs SLOT_SCRIPT on sorted sets kept in a dict, with the same steps as the Lua script."""
+
+    def __init__(self):
+        self.sorted_sets = {}
+
+    def register_script(self, script):
+        async def run(keys, args):
+            if script != SLOT_SCRIPT:
+                raise NotImplementedError
+            limit, lease_id, now, ttl = args
+            slots = self.sorted_sets.setdefault(keys[0], {})
+            for member in [member for member, expires in slots.items() if expires <= now]:
+                del slots[member]
+            if len(slots) >= limit:
+                return 0
+            slots[lease_id] = now + ttl
+            return 1
+
+        return run
+
+    async def zrem(self, key, member):
+        self.sorted_sets.get(key, {}).pop(member, None)
+
+
+@pytest.mark.asyncio
+async def test_redis_slots_expire_per_lease(monkeypatch, clock):
+    monkeypatch.setattr("time.time", clock)
+    client = FakeRedisClient()
+    limiter = RateLimiter(RedisRateLimitBackend(client, slot_ttl=600), max_streams=2)
+
+    # A lease that's never released, like one of a worker that was killed
+    await limiter.acquire("alice", 10)
+    clock.now = 300
+    lease = await limiter.acquire("bob", 10)
+    with pytest.raises(RateLimitExceeded):
+        await limiter.acquire("carol", 10)
+
+    # The leaked slot expires on its own, even though streams kept starting since
+    clock.now = 601
+    carol = await limiter.acquire("carol", 10)
+    assert set(client.sorted_sets["ratelimit:slots:global"]) == {lease.id, carol.id}
+
+    # Releasing a slot after it expired leaves the other slots counted
+    clock.now = 1000
+    await lease.release()
+    await limiter.acquire("dave", 10)
+    with pytest.raises(RateLimitExceeded):
+        await limiter.acquire("erin", 10)
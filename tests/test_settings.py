@@ -0,0 +1,30 @@
+import pytest
+
+from quartapp.settings import get_bool_env, get_number_env
+
+
+@pytest.mark.parametrize(
+    "value, expected", [("true", True), (" Yes ", True), ("1", True), ("false", False), ("0", False)]
+)
+def test_get_bool_env(monkeypatch, value, expected):
+    monkeypatch.setenv("TEST_SETTING", value)
+    assert get_bool_env("TEST_SETTING") is expected
+
+
+def test_get_bool_env_default(monkeypatch):
+    monkeypatch.delenv("TEST_SETTING", raising=False)
+    assert get_bool_env("TEST_SETTING") is False
+    # Empty values, like the ones that azd and .env templates write, are the same as unset ones
+    monkeypatch.setenv("TEST_SETTING", " ")
+    assert get_bool_env("TEST_SETTING", default=True) is True
+
+
+def test_get_number_env(monkeypatch):
+    monkeypatch.setenv("TEST_SETTING", " 4 ")
+    assert get_number_env("TEST_SETTING", 0, int) == 4
+    assert get_number_env("TEST_SETTING", 0) == 4.0
+    monkeypatch.setenv("TEST_SETTING", "")
+    assert get_number_env("TEST_SETTING", 2, int) == 2
+    monkeypatch.setenv("TEST_SETTING", "many")
+    with pytest.raises(ValueError):
+        get_number_env("TEST_SETTING", 0, int)
@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+from unittest import mock
+
+import pytest
+
+import quartapp
+from quartapp.startup import StartupReport, _ImportTimer, get_preload_modules, preload
+
+
+def test_imports_are_timed(tmp_path, monkeypatch):
+    (tmp_path / "startup_outer.py").write_text("import time\nimport startup_inner\ntime.sleep(0.02)\n")
+    (tmp_path / "startup_inner.py").write_text("import time\ntime.sleep(0.05)\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    report = StartupReport(enabled=True)
+    report.start()
+    try:
+        import startup_outer  # noqa: F401
+    finally:
+        report.finish()
+        sys.modules.pop("startup_outer", None)
+        sys.modules.pop("startup_inner", None)
+
+    imports = {module: (self_seconds, cumulative) for module, self_seconds, cumulative in report.imports}
+    assert imports["startup_inner"][0] >= 0.05
+    assert 0.02 <= imports["startup_outer"][0] < 0.05
+    assert imports["startup_outer"][1] >= 0.07
+    assert not any(isinstance(finder, _ImportTimer) for finder in sys.meta_path)
+
+
+def test_disabled_report_only_times_phases(capsys):
+    report = StartupReport()
+    report.start()
+    with report.timed("configure"):
+        pass
+    report.add("total", 0.5)
+    report.finish()
+    assert report.imports == []
+    assert [phase for phase, _ in report.phases] == ["configure", "total"]
+    assert capsys.readouterr().err == ""
+
+
+def test_provider_imports_are_lazy():
+    # In a new interpreter, as other tests import these modules
+    code = "import sys, quartapp.chat; print(sorted(m for m in ('azure.identity.aio', 'numpy') if m in sys.modules))"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, env=env)
+    assert result.stdout.strip() == "[]"
+
+
+@pytest.mark.asyncio
+async def test_startup_report_is_printed(monkeypatch, capsys, mock_openai_responses, mock_defaultazurecredential):
+    with mock.patch.dict(os.environ, clear=True):
+        monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "test-openai-service.openai.azure.com")
+        monkeypatch.setenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT", "gpt-5.2")
+        monkeypatch.setenv("STARTUP_REPORT", "true")
+
+        quart_app = quartapp.create_app()
+
+        async with quart_app.test_app():
+            report = capsys.readouterr().err
+            assert "Startup report" in report
+            assert "import quartapp.chat" in report
+            assert "prefetch the Azure OpenAI token" in report
+            assert "configure_openai" in report
+
+
+def test_preload_modules(monkeypatch):
+    for name in ("AZURE_OPENAI_KEY", "OPENAICOM_API_KEY", "OPENAI_BACKENDS", "CHAT_RATE_LIMIT_BACKEND"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://test-openai-service.openai.azure.com")
+    monkeypatch.setenv("CHAT_SEMANTIC_CACHE_ENABLED", "false")
+    monkeypatch.setenv("CHAT_CONVERSATION_STORE", "memory")
+    assert "azure.identity.aio" in get_preload_modules()
+    assert "numpy" not in get_preload_modules()
+
+    monkeypatch.setenv("AZURE_OPENAI_KEY", "test-key")
+    monkeypatch.setenv("CHAT_SEMANTIC_CACHE_ENABLED", "true")
+    monkeypatch.setenv("CHAT_CONVERSATION_STORE", "redis")
+    modules = get_preload_modules()
+    assert "azure.identity.aio" not in modules
+    assert "numpy" in modules
+    assert "redis.asyncio" in modules
+
+
+def test_preload_compiles_templates(monkeypatch):
+    monkeypatch.setattr(
+        "quartapp.startup.get_preload_modules", lambda: ["openai.resources.responses", "missing_module"]
+    )
+    app = quartapp.create_app()
+    preload(app)
+    assert "openai.resources.responses" in sys.modules
+    assert any(name == "index.html" for _, name in app.jinja_env.cache.keys())
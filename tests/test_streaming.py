@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from quartapp.streaming import coalesce_frames, get_coalescing_settings
+
+
+async def frames_from(items, delay=0):
+    for item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_frames_by_size():
+    frames = [f'{{"delta": {{"content": "{i}"}}}}\n' for i in range(10)]
+    chunks = await collect(coalesce_frames(frames_from(frames), max_bytes=len(frames[0]) * 4, max_delay=10))
+    assert "".join(chunks) == "".join(frames)
+    assert [chunk.count("\n") for chunk in chunks] == [4, 4, 2]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_frames_by_time():
+    # Slow frames are flushed after max_delay even though the size threshold isn't reached
+    chunks = await collect(coalesce_frames(frames_from(["a\n", "b\n", "c\n"], delay=0.05), max_delay=0.01))
+    assert chunks == ["a\n", "b\n", "c\n"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_frames_passes_errors_through():
+    async def failing_frames():
+        yield "a\n"
+        raise ValueError("upstream failed")
+
+    chunks = coalesce_frames(failing_frames(), max_delay=10)
+    assert await anext(chunks) == "a\n"
+    with pytest.raises(ValueError, match="upstream failed"):
+        await anext(chunks)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_frames_closes_source():
+    closed = asyncio.Event()
+
+    async def endless_frames():
+        try:
+            while True:
+                yield "a\n"
+                await asyncio.sleep(0.01)
+        finally:
+            closed.set()
+
+    chunks = coalesce_frames(endless_frames(), max_bytes=1)
+    assert await anext(chunks) == "a\n"
+    await chunks.aclose()
+    await asyncio.wait_for(closed.wait(), timeout=1)
+
+
+def test_get_coalescing_settings(monkeypatch):
+    monkeypatch.delenv("CHAT_STREAM_COALESCE_BYTES", raising=False)
+    monkeypatch.delenv("CHAT_STREAM_COALESCE_MS", raising=False)
+    assert get_coalescing_settings() is None
+    monkeypatch.setenv("CHAT_STREAM_COALESCE_MS", "50")
+    assert get_coalescing_settings() == (1024, 0.05)
+    monkeypatch.setenv("CHAT_STREAM_COALESCE_BYTES", "4096")
+    assert get_coalescing_settings() == (4096, 0.05)
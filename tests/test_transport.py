@@ -0,0 +1,54 @@
+import httpx
+import openai
+import pytest
+
+from quartapp.transport import create_http_client, get_http_settings, pool_stats, warm_up
+
+
+def test_get_http_settings(monkeypatch):
+    monkeypatch.setenv("OPENAI_HTTP_MAX_CONNECTIONS", "50")
+    monkeypatch.setenv("OPENAI_HTTP_KEEPALIVE_EXPIRY", "15")
+    monkeypatch.setenv("OPENAI_HTTP_CONNECT_TIMEOUT", "2.5")
+    monkeypatch.setenv("OPENAI_HTTP2", "true")
+    settings = get_http_settings()
+    assert settings["limits"].max_connections == 50
+    assert settings["limits"].keepalive_expiry == 15
+    assert settings["timeout"].connect == 2.5
+    assert settings["http2"] is True
+    # Settings that aren't given keep the SDK's defaults
+    assert settings["limits"].max_keepalive_connections == openai.DEFAULT_CONNECTION_LIMITS.max_keepalive_connections
+    assert settings["timeout"].read == openai.DEFAULT_TIMEOUT.read
+    assert settings["timeout"].pool == openai.DEFAULT_TIMEOUT.pool
+
+    monkeypatch.setenv("OPENAI_HTTP_MAX_CONNECTIONS", "")
+    assert get_http_settings()["limits"].max_connections == openai.DEFAULT_CONNECTION_LIMITS.max_connections
+
+
+@pytest.mark.asyncio
+async def test_create_http_client(monkeypatch):
+    monkeypatch.setenv("OPENAI_HTTP_MAX_CONNECTIONS", "7")
+    async with create_http_client() as http_client:
+        assert http_client._transport._pool._max_connections == 7
+        assert pool_stats(http_client) == {
+            "connections": 0,
+            "idle": 0,
+            "http2": 0,
+            "active_requests": 0,
+            "queued_requests": 0,
+        }
+
+
+@pytest.mark.asyncio
+async def test_warm_up():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) == 2:
+            raise httpx.ConnectError("Connection refused")
+        return httpx.Response(401)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+        await warm_up(http_client, "https://test-openai-service.openai.azure.com/openai/v1/", connections=3)
+    assert len(requests) == 3
+    assert requests[0].method == "HEAD"
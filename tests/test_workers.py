@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from quartapp.workers import get_cpu_limit, get_worker_count, read_cgroup_cpu_quota
+
+
+@pytest.fixture
+def cgroup_v2(tmp_path):
+    def write(cpu_max):
+        (tmp_path / "cpu.max").write_text(cpu_max + "\n")
+        return str(tmp_path)
+
+    return write
+
+
+def test_cgroup_v2_quota(cgroup_v2):
+    assert read_cgroup_cpu_quota(cgroup_v2("150000 100000")) == 1.5
+    assert read_cgroup_cpu_quota(cgroup_v2("max 100000")) is None
+
+
+def test_cgroup_v1_quota(tmp_path):
+    (tmp_path / "cpu").mkdir()
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("50000\n")
+    (tmp_path / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    assert read_cgroup_cpu_quota(str(tmp_path)) == 0.5
+    (tmp_path / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+    assert read_cgroup_cpu_quota(str(tmp_path)) is None
+
+
+def test_no_cgroup(tmp_path):
+    assert read_cgroup_cpu_quota(str(tmp_path)) is None
+
+
+def test_cpu_limit_is_the_lower_of_affinity_and_quota(monkeypatch, cgroup_v2):
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(64)), raising=False)
+    assert get_cpu_limit(cgroup_v2("250000 100000")) == 2.5
+    assert get_cpu_limit(cgroup_v2("max 100000")) == 64
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: {0, 1}, raising=False)
+    assert get_cpu_limit(cgroup_v2("400000 100000")) == 2
+
+
+def test_worker_count(monkeypatch, cgroup_v2):
+    monkeypatch.delenv("GUNICORN_WORKERS", raising=False)
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(64)), raising=False)
+    assert get_worker_count(cgroup_v2("350000 100000")) == 4
+    # At least 2, so one keeps serving while the other is recycled
+    assert get_worker_count(cgroup_v2("50000 100000")) == 2
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    assert get_worker_count(cgroup_v2("150000 100000")) == 3
+    monkeypatch.setenv("GUNICORN_WORKERS", "5")
+    assert get_worker_count(cgroup_v2("150000 100000")) == 5